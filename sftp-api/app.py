@@ -1,13 +1,85 @@
+from __future__ import annotations
+
 import os
+import sys
+import io
+import errno
+import asyncio
+import math
+import fcntl
+import contextvars
+import shutil
+import tempfile
 import stat as pystat
 import posixpath
-import paramiko
-from typing import Optional
+import threading
+import time
+import random
+import bisect
+import hashlib
+import socket
+import shlex
+import subprocess
+import json
+import base64
+import queue
+import multiprocessing
+import zlib
+import sqlite3
+import mimetypes
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import asynccontextmanager, contextmanager
+import importlib.util
+import urllib.parse
+from typing import Dict, List, Optional, Protocol, Tuple
 from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Depends, Header, Query
-from fastapi.responses import StreamingResponse
+from fastapi.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from pydantic import BaseModel
 from pydantic_settings import BaseSettings
 
+def lazy_import(name: str):
+    """
+    Devuelve el módulo `name` sin ejecutarlo: se importa de verdad en el primer
+    acceso a un atributo. Paramiko (con cryptography) es ~100 ms del arranque y
+    solo hace falta al abrir la primera conexión SSH, no para servir /healthz.
+    """
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+paramiko = lazy_import("paramiko")
+
 # ------------- Settings -------------
+class ReplicaConfig(BaseModel):
+    """Réplica de solo lectura; los campos omitidos se heredan del primario."""
+    host: str
+    port: Optional[int] = None
+    user: Optional[str] = None
+    password: Optional[str] = None
+    key_file: Optional[str] = None
+    host_key: Optional[str] = None
+    base_dir: Optional[str] = None
+
+class BackendConfig(BaseModel):
+    """Servidor SFTP adicional (ver `SFTP_BACKENDS`)."""
+    host: str
+    driver: str = "sftp"  # "sftp" | "local" (base_dir es un directorio local) | "memory" (tests, benchmarks)
+    port: int = 22
+    user: str = "user"
+    password: str = "pass"
+    key_file: str = ""  # clave privada; si el servidor la rechaza se usa password
+    host_key: str = ""  # host key fijada: "<tipo> <base64>"
+    base_dir: str = ""  # vacío = BASE_DIR
+    local_dir: str = ""  # montaje local del mismo base_dir (API en el host SFTP o mirror NFS)
+    replicas: List[ReplicaConfig] = []
+
 class Settings(BaseSettings):
     API_KEY: str = "change-me"
     SFTP_HOST: str = "127.0.0.1"
@@ -15,6 +87,142 @@ class Settings(BaseSettings):
     SFTP_USER: str = "user"
     SFTP_PASS: str = "pass"
     BASE_DIR: str = "/home/user"
+    SFTP_DRIVER: str = "sftp"  # driver de storage del backend "default": sftp | local | memory
+
+    # Autenticación por clave y verificación de host key (vacío = solo password, sin verificar)
+    SFTP_KEY_FILE: str = ""  # clave privada (Ed25519, ECDSA o RSA) del backend "default"
+    SFTP_KEY_PASSPHRASE: str = ""
+    SFTP_USE_AGENT: bool = False  # probar también las claves de ssh-agent (SSH_AUTH_SOCK)
+    SFTP_HOST_KEY: str = ""  # host key fijada del backend "default": "<tipo> <base64>"
+    SFTP_KNOWN_HOSTS: str = ""  # archivo known_hosts para los backends sin host_key
+
+    # Espejo local del backend "default": /download y /upload van directo al disco
+    SFTP_LOCAL_DIR: str = ""  # vacío = todo por SFTP
+
+    # Coalescing de lecturas concurrentes idénticas (/list y /download)
+    COALESCE_READS: bool = True
+    COALESCE_MAX_LAG: int = 16 * 1024 * 1024  # bytes retenidos por el suscriptor más lento; más atrás, lee por su cuenta
+    DOWNLOAD_CHUNK_SIZE: int = 1024 * 1024
+
+    # Multi-backend: el servidor SFTP_* es el backend "default"; SFTP_BACKENDS
+    # agrega (o reemplaza) backends con nombre, en JSON.
+    SFTP_BACKENDS: Dict[str, BackendConfig] = {}
+    SFTP_ROUTING: str = "prefix"  # "prefix" | "hash"
+    SFTP_ROUTES: Dict[str, str] = {}  # prefijo -> backend (modo prefix)
+    SFTP_DEFAULT_BACKEND: str = "default"
+    SFTP_POOL_SIZE: int = 4
+
+    # Transporte SSH: orden de preferencia (vacío = defaults de Paramiko)
+    SSH_CIPHERS: List[str] = []  # p. ej. ["aes128-gcm@openssh.com", "aes128-ctr"]
+    SSH_KEX: List[str] = []  # p. ej. ["curve25519-sha256@libssh.org"]
+    SSH_MACS: List[str] = []  # p. ej. ["hmac-sha2-256-etm@openssh.com"]
+    SSH_COMPRESSION: bool = False  # zlib; solo si el servidor también lo acepta
+    SSH_WINDOW_SIZE: int = 0  # bytes; 0 = default de Paramiko (2 MiB)
+    SSH_MAX_PACKET_SIZE: int = 0  # bytes; 0 = default de Paramiko (32 KiB)
+
+    # Multi-worker (gunicorn.conf.py / uvicorn --workers)
+    WEB_CONCURRENCY: int = 1  # workers; lo leen gunicorn.conf.py y uvicorn
+    SFTP_SESSION_BUDGET: int = 0  # sesiones por nodo SFTP entre todos los workers; 0 = SFTP_POOL_SIZE por worker
+
+    # Procesos dedicados a transferencias grandes (cifrado SSH fuera del GIL del proceso API)
+    TRANSFER_WORKERS: int = 0  # 0 = deshabilitado
+    TRANSFER_MIN_BYTES: int = 8 * 1024 * 1024  # por debajo, la transferencia se hace en el proceso API
+    TRANSFER_RING_SLOTS: int = 4  # chunks leídos por adelantado por transferencia (slots del ring en uploads); 0 = lockstep
+    TRANSFER_RING_POOL: int = 8  # rings ociosos que se conservan para reusar sus buffers
+    SFTP_POOL_TIMEOUT: float = 30.0
+    SFTP_HEALTHCHECK_INTERVAL: float = 30.0  # 0 = sin health checks
+
+    # Réplicas de lectura (/download, /list, /stat) del backend "default"
+    SFTP_REPLICAS: List[ReplicaConfig] = []
+    SFTP_READ_STRATEGY: str = "least_outstanding"  # "least_outstanding" | "latency"
+    SFTP_READ_FROM_PRIMARY: bool = True
+    SFTP_BREAKER_THRESHOLD: int = 3
+    SFTP_BREAKER_COOLDOWN: float = 30.0
+
+    # Checksums (/checksum y hash inline en /upload)
+    CHECKSUM_REMOTE_EXEC: bool = True  # probar `sha256sum` remoto si no hay check-file
+    CHECKSUM_EXEC_TIMEOUT: float = 60.0
+
+    # Subidas delta (/upload/delta)
+    DELTA_MIN_BLOCK_SIZE: int = 4 * 1024
+    DELTA_MAX_BLOCK_SIZE: int = 16 * 1024 * 1024
+
+    # Sync / mirror (/sync/plan, /sync/apply)
+    SYNC_WALK_CONCURRENCY: int = 8
+    SYNC_APPLY_PARALLELISM: int = 4
+    SYNC_MTIME_TOLERANCE: float = 2.0
+
+    # Índice local de metadatos (SQLite) para /search y /list?max_age
+    INDEX_DB: str = ""  # vacío = deshabilitado
+    INDEX_CRAWL_INTERVAL: float = 3600.0  # 0 = solo al arrancar
+    INDEX_CRAWL_CONCURRENCY: int = 4
+    INDEX_INCREMENTAL_INTERVAL: float = 60.0  # re-escaneo por mtime de directorios; 0 = deshabilitado
+    CHANGES_RETENTION: int = 100000  # eventos retenidos para /changes
+    CHANGES_MAX_WAIT: float = 60.0  # máximo long-poll de /changes
+
+    # Warmup al arrancar (y periódico) antes de declararse listo en /readyz
+    WARMUP_POOL_CONNECTIONS: int = 1  # conexiones abiertas por nodo (máximo SFTP_POOL_SIZE)
+    WARMUP_PATHS: List[str] = []  # directorios calientes: se listan y se cachean sus stats
+    WARMUP_FILES: List[str] = []  # archivos calientes: se copian a FILE_CACHE_DIR
+    WARMUP_INTERVAL: float = 300.0  # 0 = solo al arrancar
+    LAZY_STARTUP: bool = False  # claves SSH y transfer workers se preparan en el thread de warmup (no bloquean el arranque)
+    OPENAPI_SCHEMA_FILE: str = ""  # schema OpenAPI pregenerado (ver write_openapi_schema); vacío = se genera al primer /openapi.json
+    METADATA_CACHE_TTL: float = 0.0  # cache de listados/stats en segundos; 0 = deshabilitado
+    METADATA_CACHE_SHARED: str = ""  # SQLite compartido entre workers (p. ej. /dev/shm/sftp-api-cache.db)
+    FILE_CACHE_DIR: str = ""  # vacío = sin cache local de archivos
+    FILE_CACHE_MAX_BYTES: int = 1024 * 1024 * 1024
+
+    # /readyz: probe de los primarios y umbrales para declararse no listo
+    READYZ_PROBE_INTERVAL: float = 5.0  # el resultado del stat se reutiliza este tiempo
+    READYZ_PROBE_TIMEOUT: float = 2.0  # espera máxima por una conexión del pool
+    READYZ_WINDOW: float = 60.0  # ventana de latencias/errores SFTP
+    READYZ_MIN_SAMPLES: int = 20  # por debajo no se evalúan p99 ni tasa de error
+    READYZ_MAX_P99_MS: float = 2000.0
+    READYZ_MAX_ERROR_RATE: float = 0.25
+    READYZ_MAX_POOL_SATURATION: float = 1.0  # in_use / size
+
+    # Admission control por API key: "meta" (listados, stat, ...) y "bulk" (transferencias)
+    ADMISSION_ENABLED: bool = True
+    ADMISSION_META_CONCURRENCY: int = 32  # requests meta en curso (global)
+    ADMISSION_META_QUEUE: int = 128  # requests meta esperando turno; más allá, 503
+    ADMISSION_META_RATE: float = 0.0  # requests/s por key; 0 = sin límite
+    ADMISSION_META_BURST: int = 100
+    ADMISSION_BULK_CONCURRENCY: int = 4  # transferencias en curso (global)
+    ADMISSION_BULK_PER_KEY: int = 2  # transferencias en curso por cliente (API key + dirección)
+    ADMISSION_BULK_QUEUE: int = 16
+    ADMISSION_BULK_RATE: float = 0.0
+    ADMISSION_BULK_BURST: int = 20
+    ADMISSION_STREAM_PER_KEY: int = 8  # streams SSE abiertos por key (fuera del gate meta)
+    ADMISSION_QUEUE_TIMEOUT: float = 10.0  # espera máxima en cola antes de responder 503
+
+    # Ancho de banda de uploads/downloads en bytes/s; 0 = sin límite
+    BANDWIDTH_PER_TRANSFER: int = 0
+    BANDWIDTH_PER_KEY: int = 0
+    BANDWIDTH_GLOBAL: int = 0
+    BANDWIDTH_INTERACTIVE_BYTES: int = 1024 * 1024  # una transferencia pasa a "bulk" tras este volumen
+    BANDWIDTH_BULK_SHARE: float = 0.2  # fracción del límite que usa bulk mientras hay tráfico interactivo
+
+    # Content-Encoding negociado para /download, /list y /search
+    COMPRESSION_ENABLED: bool = True
+    COMPRESSION_ENCODINGS: List[str] = ["zstd", "br", "gzip"]  # preferencia del servidor; zstd/br si están instalados
+    COMPRESSION_MIN_BYTES: int = 4096  # respuestas más chicas van sin comprimir
+    COMPRESSION_TYPES: List[str] = [  # prefijos de content-type (adivinado por extensión) que se comprimen
+        "text/", "application/json", "application/xml", "application/x-ndjson",
+        "application/javascript", "application/x-yaml", "image/svg+xml",
+    ]
+    COMPRESSION_CACHE_VARIANTS: bool = False  # guarda la versión comprimida en FILE_CACHE_DIR
+
+    # Pipeline de /upload: corre sobre los mismos chunks que se escriben al backend
+    UPLOAD_HASHES: List[str] = []  # algoritmos calculados siempre (además de `checksum`)
+    UPLOAD_SNIFF: bool = True  # detecta el content-type por magic bytes
+    UPLOAD_MAX_BYTES: int = 0  # 413 al superarlo; 0 = sin límite
+    UPLOAD_SCAN_COMMAND: str = ""  # antivirus que lee el archivo por stdin, p. ej. "clamdscan --no-summary -"
+    UPLOAD_SCAN_TIMEOUT: float = 60.0  # espera del veredicto tras el último chunk
+    UPLOAD_SIDECAR_SUFFIX: str = ""  # p. ej. ".meta.json": guarda los resultados junto al archivo; vacío = no
+    UPLOAD_REMOTE_CHECKSUM: bool = True  # content_hash sin hash en cache: preguntarlo al servidor (check-file/exec, nunca descargando)
+    IDEMPOTENCY_TTL: float = 86400.0  # segundos que se recuerda el resultado de cada Idempotency-Key; 0 = deshabilitado
+    PROGRESS_INTERVAL: float = 1.0  # segundos entre eventos de /transfers/{id}/progress
+    PROGRESS_RETENTION: float = 300.0  # segundos que se conserva el estado final de una transferencia
 
     class Config:
         env_file = ".env"
@@ -33,9 +241,78 @@ def set_settings_for_testing(test_settings):
     """Permite inyectar settings para testing."""
     global _settings_instance
     _settings_instance = test_settings
+    reset_backends()
+    reset_index()
+    _metadata_cache.clear()
+    reset_shared_cache()
+    _warmup.reset()
+    _readiness.reset()
+    sftp_latency.clear()
+    _admission.reset()
+    _bandwidth.reset()
+    stop_transfer_pool()
+    reset_ssh_credentials()
+    reset_memory_stores()
+    reset_idempotency()
+    reset_transfers()
+    with _checksum_unsupported_lock:
+        _checksum_unsupported.clear()
+
+# ------------- JSON -------------
+# orjson serializa listados grandes ~7x más rápido que json; msgpack habilita
+# /list?format=msgpack. Ambos son opcionales.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+def json_dumps(content) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode()
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse serializado con `json_dumps`."""
+
+    def render(self, content) -> bytes:
+        return json_dumps(content)
+
+def prepare_startup():
+    """Lo que el proceso necesita antes de declararse listo: claves SSH parseadas y transfer workers."""
+    preload_ssh_credentials()
+    start_transfer_pool()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    settings = get_settings()
+    checker = HealthChecker(settings.SFTP_HEALTHCHECK_INTERVAL)
+    crawler = IndexCrawler(settings.INDEX_CRAWL_INTERVAL, settings.INDEX_INCREMENTAL_INTERVAL)
+    warmer = Warmer(settings.WARMUP_INTERVAL)
+    if settings.LAZY_STARTUP:
+        # El proceso atiende /healthz de inmediato; /readyz espera a que termine la preparación
+        warmer.prepare = prepare_startup
+    else:
+        prepare_startup()
+    checker.start()
+    crawler.start()
+    warmer.start()
+    try:
+        yield
+    finally:
+        warmer.stop()
+        stop_transfer_pool()
+        crawler.stop()
+        checker.stop()
+        reset_backends()
+        reset_index()
 
-settings = get_settings()
 app = FastAPI(
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse,
     title="SFTP API",
     version="1.2.0",
     description="""
@@ -69,6 +346,671 @@ app = FastAPI(
     }
 )
 
+def openapi_schema() -> dict:
+    """Schema OpenAPI: de OPENAPI_SCHEMA_FILE si existe; si no, FastAPI lo genera al primer pedido."""
+    if app.openapi_schema is None:
+        path = get_settings().OPENAPI_SCHEMA_FILE
+        if path and os.path.exists(path):
+            with open(path, "rb") as f:
+                app.openapi_schema = json.loads(f.read())
+        else:
+            FastAPI.openapi(app)
+    return app.openapi_schema
+
+def write_openapi_schema(path: str):
+    """Genera el schema OpenAPI en `path` (paso de build del Dockerfile)."""
+    with open(path, "wb") as f:
+        f.write(json_dumps(FastAPI.openapi(app)))
+
+app.openapi = openapi_schema
+
+# ------------- Admission control -------------
+# Transferencias, y lecturas del archivo entero (checksum, firmas delta): ocupan una
+# sesión SFTP y un thread durante toda la lectura
+BULK_PATHS = {"/upload", "/upload/delta", "/upload/delta/plan", "/download", "/checksum", "/sync/apply"}
+# Sin autenticación ni acceso a SFTP (probes del balanceador, documentación)
+ADMISSION_EXEMPT_PATHS = {"/healthz", "/readyz", "/docs", "/redoc", "/openapi.json", "/docs/oauth2-redirect"}
+# Streams de larga duración: fuera del gate meta (lo agotarían), con su propio límite por key
+STREAM_PATHS = {"/changes/stream"}
+STREAM_PREFIXES = ("/transfers/",)
+# Long-polls (`/changes?wait=`): esperan hasta CHANGES_MAX_WAIT, cuentan como stream
+LONG_POLL_PATHS = {"/changes"}
+
+class Rejected(Exception):
+    def __init__(self, status_code: int, detail: str, retry_after: float):
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+class TokenBucket:
+    """`rate` tokens por segundo hasta un máximo de `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def take(self) -> float:
+        """Consume un token; retorna 0 si había, o los segundos hasta el próximo."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+class Gate:
+    """
+    Límite de concurrencia con cola acotada. Los waiters son futures de su propio
+    event loop, así el gate funciona aunque cada request corra en un loop distinto.
+    """
+
+    def __init__(self, name: str, limit: int, max_queue: int):
+        self.name = name
+        self.limit = limit
+        self.max_queue = max_queue
+        self.active = 0
+        self._waiters = deque()
+        self._lock = threading.Lock()
+
+    async def acquire(self, timeout: float):
+        with self._lock:
+            if self.active < self.limit and not self._waiters:
+                self.active += 1
+                return
+            if len(self._waiters) >= self.max_queue:
+                raise Rejected(503, f"Demasiados requests en cola ({self.name})", 1)
+            waiter = _Waiter(asyncio.get_running_loop())
+            self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter.future), timeout)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as exc:
+            with self._lock:
+                granted = waiter.granted
+                if not granted:
+                    self._waiters.remove(waiter)
+            if granted:
+                self.release()  # el slot llegó justo al vencer: se devuelve
+            if isinstance(exc, asyncio.CancelledError):
+                raise
+            raise Rejected(503, f"Tiempo de espera agotado en cola ({self.name})", max(1, timeout))
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # El slot pasa directo al primer waiter (active no cambia)
+                waiter = self._waiters.popleft()
+                waiter.granted = True
+                waiter.loop.call_soon_threadsafe(_grant, waiter.future)
+                return
+            self.active -= 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"limit": self.limit, "active": self.active, "queued": len(self._waiters)}
+
+class _Waiter:
+    __slots__ = ("loop", "future", "granted")
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.future = loop.create_future()
+        self.granted = False
+
+def _grant(future):
+    if not future.done():
+        future.set_result(None)
+
+# Con una key de admisión por cliente, buckets y gates inactivos se descartan pasado este número
+ADMISSION_MAX_KEYS = 4096
+
+class AdmissionState:
+    """Buckets y gates por clase y por key de admisión; se recrean al cambiar settings."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._buckets = {}
+        self._gates = {}
+
+    def bucket(self, key: str, cls: str, rate: float, burst: int) -> TokenBucket:
+        with self._lock:
+            bucket = self._buckets.get((key, cls))
+            if bucket is None:
+                if len(self._buckets) >= ADMISSION_MAX_KEYS:
+                    # Un bucket que ya se repuso entero equivale a uno nuevo
+                    now = time.monotonic()
+                    self._buckets = {
+                        k: b for k, b in self._buckets.items() if b.tokens + (now - b.updated) * b.rate < b.burst
+                    }
+                bucket = self._buckets[(key, cls)] = TokenBucket(rate, burst)
+            return bucket
+
+    def gate(self, name: str, limit: int, max_queue: int) -> Gate:
+        with self._lock:
+            gate = self._gates.get(name)
+            if gate is None:
+                if len(self._gates) >= ADMISSION_MAX_KEYS:
+                    self._gates = {n: g for n, g in self._gates.items() if g.active or g._waiters}
+                gate = self._gates[name] = Gate(name, limit, max_queue)
+            return gate
+
+    def stats(self) -> dict:
+        with self._lock:
+            gates = list(self._gates.values())
+        return {gate.name: gate.stats() for gate in gates}
+
+_admission = AdmissionState()
+
+def admission_key(scope) -> str:
+    """
+    Key de admisión: con la API key válida, la dirección del cliente (hay una sola
+    API_KEY, así que la key sola no distingue a quién llama); todas las inválidas
+    comparten bucket. Detrás de un proxy, uvicorn toma la dirección de
+    X-Forwarded-For si el proxy está en FORWARDED_ALLOW_IPS.
+    """
+    value = None
+    for name, raw in scope["headers"]:
+        if name == b"x-api-key":
+            value = raw.decode("latin-1")
+            break
+    if value is None or value != get_settings().API_KEY:
+        return "invalid"
+    client = scope.get("client")
+    return f"valid:{client[0] if client else '-'}"
+
+def is_long_poll(scope) -> bool:
+    if scope["path"] not in LONG_POLL_PATHS:
+        return False
+    wait = urllib.parse.parse_qs(scope["query_string"].decode("latin-1")).get("wait", ["0"])[-1]
+    try:
+        return float(wait) > 0
+    except ValueError:
+        return False
+
+class AdmissionMiddleware:
+    """
+    Middleware ASGI (no BaseHTTPMiddleware, para retener el slot hasta que termina
+    el stream de la respuesta) que aplica, por API key y clase de request, un
+    token bucket (429) y límites de concurrencia con cola acotada (503).
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        settings = get_settings()
+        if scope["type"] != "http" or not settings.ADMISSION_ENABLED or scope["path"] in ADMISSION_EXEMPT_PATHS:
+            if scope["type"] == "http":
+                _client_key.set(admission_key(scope))
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        cls = ("bulk" if path in BULK_PATHS
+               else "stream" if path in STREAM_PATHS or path.startswith(STREAM_PREFIXES) or is_long_poll(scope)
+               else "meta")
+        key = admission_key(scope)
+        _client_key.set(key)
+        acquired = []
+        try:
+            if cls == "bulk":
+                rate, burst = settings.ADMISSION_BULK_RATE, settings.ADMISSION_BULK_BURST
+                gates = [
+                    _admission.gate(f"bulk:{key}", settings.ADMISSION_BULK_PER_KEY, settings.ADMISSION_BULK_QUEUE),
+                    _admission.gate("bulk", settings.ADMISSION_BULK_CONCURRENCY, settings.ADMISSION_BULK_QUEUE),
+                ]
+            elif cls == "stream":
+                # Sin cola: un stream esperando turno no sirve de nada, se rechaza de inmediato
+                rate, burst = settings.ADMISSION_META_RATE, settings.ADMISSION_META_BURST
+                gates = [_admission.gate(f"stream:{key}", settings.ADMISSION_STREAM_PER_KEY, 0)]
+            else:
+                rate, burst = settings.ADMISSION_META_RATE, settings.ADMISSION_META_BURST
+                gates = [_admission.gate("meta", settings.ADMISSION_META_CONCURRENCY, settings.ADMISSION_META_QUEUE)]
+            if rate > 0:
+                wait_for = _admission.bucket(key, cls, rate, burst).take()
+                if wait_for:
+                    raise Rejected(429, "Límite de requests excedido", wait_for)
+            deadline = time.monotonic() + settings.ADMISSION_QUEUE_TIMEOUT
+            for gate in gates:
+                await gate.acquire(max(0.0, deadline - time.monotonic()))
+                acquired.append(gate)
+        except Rejected as exc:
+            for gate in reversed(acquired):
+                gate.release()
+            metrics.incr(f"admission.rejected.{cls}.{exc.status_code}")
+            response = JSONResponse(
+                status_code=exc.status_code,
+                content={"detail": exc.detail},
+                headers={"Retry-After": str(math.ceil(exc.retry_after))},
+            )
+            await response(scope, receive, send)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            for gate in reversed(acquired):
+                gate.release()
+
+app.add_middleware(AdmissionMiddleware)
+
+# ------------- Ancho de banda -------------
+# Key de admisión del request en curso (la fija AdmissionMiddleware)
+_client_key = contextvars.ContextVar("client_key", default=None)
+
+class ByteBucket:
+    """Token bucket de bytes que admite deuda: quien se pasa espera a que se reponga."""
+
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.burst = rate  # hasta 1 s de ráfaga
+        self.tokens = float(rate)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, amount: float) -> float:
+        """Descuenta `amount`; retorna los segundos a esperar (0 si alcanzaba)."""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+class BandwidthState:
+    """Buckets por key y global, y cuántas transferencias interactivas hay en curso."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self._lock = threading.Lock()
+        self._keys = {}
+        self._global = None
+        self._global_rate = None
+        self.interactive = 0
+
+    def key_bucket(self, key: str, rate: int) -> ByteBucket:
+        with self._lock:
+            bucket = self._keys.get(key)
+            if bucket is None or bucket.rate != rate:
+                bucket = self._keys[key] = ByteBucket(rate)
+            return bucket
+
+    def global_bucket(self, rate: int) -> ByteBucket:
+        with self._lock:
+            if self._global is None or self._global_rate != rate:
+                self._global, self._global_rate = ByteBucket(rate), rate
+            return self._global
+
+    def add_interactive(self, delta: int):
+        with self._lock:
+            self.interactive += delta
+
+_bandwidth = BandwidthState()
+
+class Shaper:
+    """
+    Limita una transferencia según BANDWIDTH_PER_TRANSFER, BANDWIDTH_PER_KEY y
+    BANDWIDTH_GLOBAL. Empieza como interactiva y pasa a bulk al superar
+    BANDWIDTH_INTERACTIVE_BYTES; mientras haya interactivas en curso, cada byte bulk
+    cuesta 1/BANDWIDTH_BULK_SHARE en los buckets compartidos, así las transferencias
+    chicas le ganan el ancho de banda a las grandes. Si el request registró su
+    progreso (X-Transfer-Id), cada chunk suma ahí sus bytes.
+    """
+
+    def __init__(self, key: Optional[str] = None):
+        settings = get_settings()
+        key = key if key is not None else _client_key.get()
+        self.progress = _transfer_progress.get()
+        self.own = ByteBucket(settings.BANDWIDTH_PER_TRANSFER) if settings.BANDWIDTH_PER_TRANSFER > 0 else None
+        self.shared = []
+        if settings.BANDWIDTH_PER_KEY > 0 and key is not None:
+            self.shared.append(_bandwidth.key_bucket(key, settings.BANDWIDTH_PER_KEY))
+        if settings.BANDWIDTH_GLOBAL > 0:
+            self.shared.append(_bandwidth.global_bucket(settings.BANDWIDTH_GLOBAL))
+        self.enabled = self.own is not None or bool(self.shared)
+        self.interactive_bytes = settings.BANDWIDTH_INTERACTIVE_BYTES
+        self.bulk_cost = 1 / max(settings.BANDWIDTH_BULK_SHARE, 0.01)
+        self.moved = 0
+        self.interactive = False
+
+    def throttle(self, n: int):
+        if self.progress is not None:
+            self.progress.bytes += n
+        if not self.enabled:
+            return
+        if self.moved == 0 and n <= self.interactive_bytes:
+            # Se registra al mover el primer chunk: un stream que nunca arranca no cuenta
+            self.interactive = True
+            _bandwidth.add_interactive(1)
+        self.moved += n
+        if self.interactive and self.moved > self.interactive_bytes:
+            self._leave_interactive()
+        cost = n if self.interactive or _bandwidth.interactive == 0 else n * self.bulk_cost
+        delay = self.own.consume(n) if self.own is not None else 0.0
+        for bucket in self.shared:
+            delay = max(delay, bucket.consume(cost))
+        if delay > 0:
+            metrics.incr("bandwidth.throttled_ms", int(delay * 1000))
+            time.sleep(delay)
+
+    def _leave_interactive(self):
+        self.interactive = False
+        _bandwidth.add_interactive(-1)
+
+    def close(self):
+        if self.interactive:
+            self._leave_interactive()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def shaped(body, shaper: Shaper):
+    """Envuelve el iterador de una descarga aplicando `shaper` a cada chunk; al terminar cierra su progreso."""
+    completed = False
+    try:
+        for chunk in body:
+            shaper.throttle(len(chunk))
+            yield chunk
+        completed = True
+    finally:
+        shaper.close()
+        if shaper.progress is not None:
+            shaper.progress.finish(None if completed else "Transferencia interrumpida")
+        close = getattr(body, "close", None)
+        if close is not None:
+            close()
+
+class TransferResponse(StreamingResponse):
+    """
+    StreamingResponse de una descarga. Cierra el progreso del request (X-Transfer-Id)
+    aunque el body nunca se itere, p. ej. si el cliente se fue antes de que empiece:
+    si no, la entrada quedaría abierta para siempre y su id respondería 409.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.progress = _transfer_progress.get()
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            # Sin efecto si `shaped` ya lo cerró al terminar el body
+            if self.progress is not None:
+                self.progress.finish("Transferencia interrumpida")
+
+# ------------- Progreso de transferencias -------------
+# Con el header X-Transfer-Id, /upload, /download y /delete-dir registran su avance
+# y /transfers/{id}/progress lo emite como Server-Sent Events. Los loops de copia
+# solo suman a un contador (desde Shaper.throttle); el stream lo muestrea cada
+# PROGRESS_INTERVAL y calcula ahí tasa y ETA.
+_transfer_progress = contextvars.ContextVar("transfer_progress", default=None)
+
+class TransferProgress:
+    """Avance de una transferencia: bytes movidos (o liberados, en /delete-dir) e items."""
+
+    def __init__(self, transfer_id: str, kind: str, path: str, total: Optional[int] = None):
+        self.id = transfer_id
+        self.kind = kind
+        self.path = path
+        self.total = total
+        # Un solo escritor por transferencia: sin lock en el loop de copia
+        self.bytes = 0
+        self.items = 0
+        self.started = time.monotonic()
+        self.finished_at = None
+        self.error = None
+        self.done = threading.Event()
+        self._lock = threading.Lock()
+
+    def add_item(self, size: int = 0):
+        # /delete-dir borra en varios backends a la vez
+        with self._lock:
+            self.items += 1
+            self.bytes += size
+
+    async def wait_done(self, timeout: float) -> bool:
+        """Espera a que termine, hasta `timeout` segundos, sondeando en el event loop (sin retener un thread)."""
+        deadline = time.monotonic() + timeout
+        while not self.done.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            await asyncio.sleep(min(remaining, 0.05))
+        return True
+
+    def finish(self, error: Optional[str] = None):
+        if self.done.is_set():
+            return
+        self.error = error
+        self.finished_at = time.monotonic()
+        self.done.set()
+
+    def snapshot(self) -> dict:
+        elapsed = (self.finished_at or time.monotonic()) - self.started
+        return {
+            "id": self.id, "kind": self.kind, "path": self.path, "bytes": self.bytes, "items": self.items,
+            "total": self.total, "elapsed": round(elapsed, 3),
+            "avg_rate": round(self.bytes / elapsed) if elapsed > 0 else 0,
+            "done": self.done.is_set(), "error": self.error,
+        }
+
+class TransferRegistry:
+    """Transferencias por id; las terminadas se conservan PROGRESS_RETENTION segundos."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._transfers: Dict[str, TransferProgress] = {}
+
+    def start(self, transfer_id: str, kind: str, path: str, total: Optional[int] = None) -> TransferProgress:
+        with self._lock:
+            self._prune()
+            current = self._transfers.get(transfer_id)
+            if current is not None and not current.done.is_set():
+                raise HTTPException(409, "Ya hay una transferencia en curso con ese X-Transfer-Id")
+            progress = self._transfers[transfer_id] = TransferProgress(transfer_id, kind, path, total)
+        metrics.incr("transfers.tracked")
+        return progress
+
+    async def get(self, transfer_id: str, wait: float = 0.0) -> Optional[TransferProgress]:
+        """
+        La transferencia `transfer_id`, esperando hasta `wait` segundos a que empiece.
+        Sondea en el event loop: un cliente esperando no retiene un thread del pool.
+        """
+        deadline = time.monotonic() + wait
+        while True:
+            with self._lock:
+                progress = self._transfers.get(transfer_id)
+            remaining = deadline - time.monotonic()
+            if progress is not None or remaining <= 0:
+                return progress
+            await asyncio.sleep(min(remaining, 0.1))
+
+    def _prune(self):
+        cutoff = time.monotonic() - get_settings().PROGRESS_RETENTION
+        for transfer_id, progress in list(self._transfers.items()):
+            if progress.finished_at is not None and progress.finished_at < cutoff:
+                del self._transfers[transfer_id]
+
+    def reset(self):
+        with self._lock:
+            self._transfers.clear()
+
+_transfers = TransferRegistry()
+
+def reset_transfers():
+    _transfers.reset()
+
+def validate_transfer_id(transfer_id: str) -> str:
+    if not transfer_id or len(transfer_id) > 128 or not all(c.isascii() and (c.isalnum() or c in "._-") for c in transfer_id):
+        raise HTTPException(400, "X-Transfer-Id: hasta 128 caracteres [A-Za-z0-9._-]")
+    return transfer_id
+
+@contextmanager
+def track_transfer(transfer_id: Optional[str], kind: str, rel: str, total: Optional[int] = None, finish: bool = True):
+    """
+    Registra el progreso del request en curso si trae X-Transfer-Id (si no, da None).
+    Los Shaper creados adentro suman sus bytes. Un error lo cierra con su detalle;
+    con `finish=False` el éxito lo cierra quien consume el stream (`shaped`) y, si el
+    body nunca se itera, TransferResponse al cerrarse.
+    """
+    if not transfer_id:
+        yield None
+        return
+    progress = _transfers.start(validate_transfer_id(transfer_id), kind, rel, total)
+    token = _transfer_progress.set(progress)
+    try:
+        yield progress
+    except BaseException as exc:
+        progress.finish(exc.detail if isinstance(exc, HTTPException) else str(exc) or type(exc).__name__)
+        raise
+    else:
+        if finish:
+            progress.finish()
+    finally:
+        _transfer_progress.reset(token)
+
+# ------------- Compresión HTTP -------------
+# zstd y brotli son opcionales (pip install zstandard brotli); gzip siempre está.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class _BrotliEncoder:
+    """Adapta brotli.Compressor a la interfaz compress/flush de zlib."""
+
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=4)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+# Niveles pensados para comprimir en streaming: buena relación sin frenar el envío
+ENCODERS = {"gzip": lambda: zlib.compressobj(6, zlib.DEFLATED, 31)}
+if zstandard is not None:
+    ENCODERS["zstd"] = lambda: zstandard.ZstdCompressor(level=3).compressobj()
+if brotli is not None:
+    ENCODERS["br"] = _BrotliEncoder
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Primera codificación de COMPRESSION_ENCODINGS que el cliente acepta (q > 0), o None."""
+    settings = get_settings()
+    if not settings.COMPRESSION_ENABLED or not accept_encoding:
+        return None
+    weights = {}
+    for part in accept_encoding.split(","):
+        name, _, params = part.partition(";")
+        weight = 1.0
+        for param in params.split(";"):
+            key, _, value = param.strip().partition("=")
+            if key == "q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[name.strip().lower()] = weight
+    for encoding in settings.COMPRESSION_ENCODINGS:
+        if encoding in ENCODERS and weights.get(encoding, weights.get("*", 0.0)) > 0:
+            return encoding
+    return None
+
+def compressible(filename: str) -> bool:
+    """Si el tipo adivinado por la extensión está en COMPRESSION_TYPES (desconocido = no)."""
+    media_type = mimetypes.guess_type(filename)[0]
+    return media_type is not None and any(media_type.startswith(prefix) for prefix in get_settings().COMPRESSION_TYPES)
+
+def compressed(body, encoding: str, cache_path: Optional[str] = None):
+    """
+    Comprime el iterador de una descarga chunk a chunk. Corre dentro del generador
+    síncrono de la respuesta, o sea en el threadpool y no en el event loop.
+    Con `cache_path` guarda la salida y la publica solo si el stream terminó completo.
+    """
+    encoder = ENCODERS[encoding]()
+    tmp = f"{cache_path}.{threading.get_ident()}.tmp" if cache_path else None
+    out = open(tmp, "wb") if tmp else None
+    raw = wire = 0
+    try:
+        for chunk in body:
+            raw += len(chunk)
+            data = encoder.compress(chunk)
+            if data:
+                wire += len(data)
+                if out:
+                    out.write(data)
+                yield data
+        data = encoder.flush()
+        wire += len(data)
+        if out:
+            out.write(data)
+            out.close()
+            os.replace(tmp, cache_path)
+            out = None
+        yield data
+    finally:
+        metrics.incr(f"compression.{encoding}.bytes_in", raw)
+        metrics.incr(f"compression.{encoding}.bytes_out", wire)
+        if out:
+            out.close()
+            os.remove(tmp)
+        close = getattr(body, "close", None)
+        if close is not None:
+            close()
+
+def encoded_response(body: bytes, media_type: str, accept_encoding: Optional[str]) -> Response:
+    """Respuesta comprimida con la codificación negociada si supera COMPRESSION_MIN_BYTES."""
+    encoding = negotiate_encoding(accept_encoding) if len(body) >= get_settings().COMPRESSION_MIN_BYTES else None
+    if encoding is None:
+        return Response(body, media_type=media_type)
+    encoder = ENCODERS[encoding]()
+    data = encoder.compress(body) + encoder.flush()
+    metrics.incr(f"compression.{encoding}.bytes_in", len(body))
+    metrics.incr(f"compression.{encoding}.bytes_out", len(data))
+    return Response(data, media_type=media_type, headers={"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+
+def encoded_json(content: dict, accept_encoding: Optional[str]) -> Response:
+    return encoded_response(json_dumps(content), "application/json", accept_encoding)
+
+LISTING_FORMATS = ("objects", "columnar", "msgpack")
+
+def columnar(items: List[dict]) -> dict:
+    """Listado en columnas: una lista por campo en vez de un objeto por entrada (~2x más chico)."""
+    # Hay pocos modos distintos: parsear cada uno una vez y no una vez por entrada
+    modes = {mode: int(mode, 8) if mode else None for mode in {item["mode"] for item in items}}
+    return {
+        "names": [item["name"] for item in items],
+        "sizes": [item["size"] for item in items],
+        "mtimes": [item["mtime"] for item in items],
+        "modes": [modes[item["mode"]] for item in items],
+        "dirs": [item["is_dir"] for item in items],
+    }
+
+def listing_response(payload: dict, items: List[dict], fmt: str, accept_encoding: Optional[str]) -> Response:
+    """Respuesta de /list en el formato pedido: `objects` (una entrada por objeto), `columnar` o `msgpack` (columnar)."""
+    if fmt == "objects":
+        return encoded_json({**payload, "items": items}, accept_encoding)
+    content = {**payload, "format": "columnar", "count": len(items), **columnar(items)}
+    if fmt == "msgpack":
+        return encoded_response(msgpack.packb(content), "application/msgpack", accept_encoding)
+    return encoded_json(content, accept_encoding)
+
 # ------------- Auth -------------
 def require_api_key(x_api_key: Optional[str] = Header(None)):
     settings = get_settings()
@@ -77,11 +1019,169 @@ def require_api_key(x_api_key: Optional[str] = Header(None)):
     return True
 
 # ------------- SFTP helpers -------------
-def sftp_connect() -> paramiko.SFTPClient:
+def _preferred(requested: List[str], supported: Tuple[str, ...], kind: str) -> Tuple[str, ...]:
+    """Los algoritmos pedidos que Paramiko soporta, en el orden pedido."""
+    chosen = tuple(name for name in requested if name in supported)
+    if not chosen:
+        raise ValueError(f"Ningún {kind} de {requested} está soportado; disponibles: {', '.join(supported)}")
+    return chosen
+
+# Claves y host keys se parsean una vez por proceso: descifrar una clave con
+# passphrase o leer known_hosts en cada conexión del pool es trabajo repetido.
+_KEY_PREFERENCE = ("ssh-ed25519", "ecdsa-sha2-nistp256", "ecdsa-sha2-nistp384", "ecdsa-sha2-nistp521", "ssh-rsa")
+_ssh_lock = threading.Lock()
+_private_keys: Dict[Tuple[str, str], paramiko.PKey] = {}
+_pinned_host_keys: Dict[str, paramiko.PKey] = {}
+_known_hosts: Dict[str, paramiko.HostKeys] = {}
+_agent: Optional[paramiko.Agent] = None
+_agent_lock = threading.Lock()  # el socket del agente no admite requests concurrentes
+
+def _key_rank(key: paramiko.PKey) -> int:
+    name = key.get_name()
+    return _KEY_PREFERENCE.index(name) if name in _KEY_PREFERENCE else len(_KEY_PREFERENCE)
+
+def load_private_key(path: str, passphrase: str = "") -> paramiko.PKey:
+    with _ssh_lock:
+        key = _private_keys.get((path, passphrase))
+        if key is None:
+            key = _private_keys[(path, passphrase)] = paramiko.PKey.from_path(path, passphrase.encode() if passphrase else None)
+        return key
+
+def parse_host_key(line: str) -> paramiko.PKey:
+    """`<tipo> <base64> [comentario]`, como en known_hosts o en un `.pub`."""
+    with _ssh_lock:
+        key = _pinned_host_keys.get(line)
+        if key is None:
+            parts = line.split()
+            if len(parts) < 2:
+                raise ValueError(f"Host key inválida: {line!r}")
+            key = _pinned_host_keys[line] = paramiko.PKey.from_type_string(parts[0], base64.b64decode(parts[1]))
+        return key
+
+def known_hosts(path: str) -> paramiko.HostKeys:
+    with _ssh_lock:
+        hosts = _known_hosts.get(path)
+        if hosts is None:
+            hosts = _known_hosts[path] = paramiko.HostKeys(path)
+        return hosts
+
+def expected_host_key(config: BackendConfig) -> Optional[paramiko.PKey]:
+    """Host key que debe presentar el servidor, o None si no se verifica."""
+    if config.host_key:
+        return parse_host_key(config.host_key)
+    path = get_settings().SFTP_KNOWN_HOSTS
+    if not path:
+        return None
+    name = config.host if config.port == 22 else f"[{config.host}]:{config.port}"
+    entries = known_hosts(path).lookup(name)
+    if not entries:
+        raise paramiko.SSHException(f"{name} no figura en {path}")
+    # Fijar un solo tipo también acota la negociación al algoritmo de esa clave
+    return min(entries.values(), key=_key_rank)
+
+def agent_keys() -> List[paramiko.PKey]:
+    global _agent
+    with _ssh_lock:
+        if _agent is None:
+            _agent = paramiko.Agent()
+        return sorted(_agent.get_keys(), key=_key_rank)
+
+def ssh_auth_keys(config: BackendConfig) -> List[paramiko.PKey]:
+    """Claves a probar en orden: la del backend y después las del agente (Ed25519 primero)."""
+    settings = get_settings()
+    keys = [load_private_key(config.key_file, settings.SFTP_KEY_PASSPHRASE)] if config.key_file else []
+    if settings.SFTP_USE_AGENT:
+        keys.extend(agent_keys())
+    return keys
+
+def authenticate(transport: paramiko.Transport, config: BackendConfig):
+    for key in ssh_auth_keys(config):
+        try:
+            if isinstance(key, paramiko.AgentKey):
+                with _agent_lock:
+                    transport.auth_publickey(config.user, key)
+            else:
+                transport.auth_publickey(config.user, key)
+            return
+        except paramiko.AuthenticationException:
+            continue
+    if not config.password:
+        raise paramiko.AuthenticationException(f"Ninguna clave SSH fue aceptada por {config.host}")
+    transport.auth_password(config.user, config.password)
+
+def _all_backend_configs() -> List[BackendConfig]:
+    configs = [default_backend_config(), *get_settings().SFTP_BACKENDS.values()]
+    return [
+        node
+        for config in configs
+        for node in [config, *(config.model_copy(update=r.model_dump(exclude_none=True)) for r in config.replicas)]
+    ]
+
+def preload_ssh_credentials():
+    """Parsea claves y host keys al arrancar: una config rota falla acá y no en el primer request."""
     settings = get_settings()
-    transport = paramiko.Transport((settings.SFTP_HOST, settings.SFTP_PORT))
-    transport.connect(username=settings.SFTP_USER, password=settings.SFTP_PASS)
-    return paramiko.SFTPClient.from_transport(transport)
+    for config in _all_backend_configs():
+        if config.driver != "sftp":
+            continue
+        if config.key_file:
+            load_private_key(config.key_file, settings.SFTP_KEY_PASSPHRASE)
+        expected_host_key(config)
+    if settings.SFTP_USE_AGENT:
+        agent_keys()
+
+def reset_ssh_credentials():
+    global _agent
+    with _ssh_lock:
+        _private_keys.clear()
+        _pinned_host_keys.clear()
+        _known_hosts.clear()
+        if _agent is not None:
+            _agent.close()
+            _agent = None
+
+def sftp_connect(config: Optional[BackendConfig] = None) -> paramiko.SFTPClient:
+    config = config or default_backend_config()
+    settings = get_settings()
+    window = {}
+    if settings.SSH_WINDOW_SIZE > 0:
+        window["default_window_size"] = settings.SSH_WINDOW_SIZE
+    if settings.SSH_MAX_PACKET_SIZE > 0:
+        window["default_max_packet_size"] = settings.SSH_MAX_PACKET_SIZE
+    transport = paramiko.Transport((config.host, config.port), **window)
+    options = transport.get_security_options()
+    if settings.SSH_CIPHERS:
+        options.ciphers = _preferred(settings.SSH_CIPHERS, options.ciphers, "cipher")
+    if settings.SSH_KEX:
+        options.kex = _preferred(settings.SSH_KEX, options.kex, "KEX")
+    if settings.SSH_MACS:
+        options.digests = _preferred(settings.SSH_MACS, options.digests, "MAC")
+    transport.use_compression(settings.SSH_COMPRESSION)
+    try:
+        transport.connect(hostkey=expected_host_key(config))
+        authenticate(transport, config)
+    except Exception:
+        transport.close()
+        raise
+    return paramiko.SFTPClient.from_transport(
+        transport,
+        window_size=window.get("default_window_size"),
+        max_packet_size=window.get("default_max_packet_size"),
+    )
+
+def default_backend_config() -> BackendConfig:
+    settings = get_settings()
+    return BackendConfig(
+        driver=settings.SFTP_DRIVER,
+        host=settings.SFTP_HOST,
+        port=settings.SFTP_PORT,
+        user=settings.SFTP_USER,
+        password=settings.SFTP_PASS,
+        key_file=settings.SFTP_KEY_FILE,
+        host_key=settings.SFTP_HOST_KEY,
+        base_dir=settings.BASE_DIR,
+        local_dir=settings.SFTP_LOCAL_DIR,
+        replicas=settings.SFTP_REPLICAS,
+    )
 
 def safe_join(base: str, path: str) -> str:
     base_norm = posixpath.normpath(base)
@@ -90,7 +1190,7 @@ def safe_join(base: str, path: str) -> str:
         raise HTTPException(400, "Ruta fuera de BASE_DIR")
     return target
 
-def mkdirs_sftp(sftp: paramiko.SFTPClient, remote_dir: str):
+def mkdirs_sftp(sftp: "StorageClient", remote_dir: str):
     parts = remote_dir.strip("/").split("/")
     cur = "/"
     for part in parts:
@@ -102,25 +1202,30 @@ def mkdirs_sftp(sftp: paramiko.SFTPClient, remote_dir: str):
         except FileNotFoundError:
             sftp.mkdir(cur)
 
-def is_dir(sftp: paramiko.SFTPClient, remote_path: str) -> bool:
+def is_dir(sftp: "StorageClient", remote_path: str) -> bool:
     st = sftp.stat(remote_path)
     return pystat.S_ISDIR(st.st_mode)
 
-def listdir_info(sftp: paramiko.SFTPClient, remote_dir: str):
-    items = []
-    for f in sftp.listdir_attr(remote_dir):
-        items.append({
-            "name": f.filename,
-            "size": f.st_size,
-            "mode": oct(f.st_mode),
-            "is_dir": pystat.S_ISDIR(f.st_mode),
-            "mtime": f.st_mtime,
-        })
-    return items
-
-def rmtree_sftp(sftp: paramiko.SFTPClient, target: str):
+def entry_info(attr: paramiko.SFTPAttributes, name: Optional[str] = None) -> dict:
+    return {
+        "name": name if name is not None else attr.filename,
+        "size": attr.st_size,
+        "mode": oct(attr.st_mode),
+        "is_dir": pystat.S_ISDIR(attr.st_mode),
+        "mtime": attr.st_mtime,
+    }
+
+def file_etag(size: int, mtime) -> str:
+    """ETag de un archivo: cambia con el tamaño o el mtime (lo que el servidor SFTP expone)."""
+    return f'"{size:x}-{int(mtime or 0):x}"'
+
+def listdir_info(sftp: "StorageClient", remote_dir: str):
+    return [entry_info(f) for f in sftp.listdir_attr(remote_dir)]
+
+def rmtree_sftp(sftp: "StorageClient", target: str, base_dir: Optional[str] = None,
+                progress: Optional["TransferProgress"] = None):
     settings = get_settings()
-    base = posixpath.normpath(settings.BASE_DIR)
+    base = posixpath.normpath(base_dir or settings.BASE_DIR)
     target_norm = posixpath.normpath(target)
     if target_norm == base:
         raise HTTPException(400, "No se puede eliminar BASE_DIR")
@@ -130,144 +1235,4221 @@ def rmtree_sftp(sftp: paramiko.SFTPClient, target: str):
     for entry in sftp.listdir_attr(target_norm):
         child = posixpath.join(target_norm, entry.filename)
         if pystat.S_ISDIR(entry.st_mode):
-            rmtree_sftp(sftp, child)
+            rmtree_sftp(sftp, child, base, progress)
         else:
             sftp.remove(child)
+            if progress is not None:
+                progress.add_item(entry.st_size or 0)
     sftp.rmdir(target_norm)
+    if progress is not None:
+        progress.add_item()
 
-# ------------- Endpoints -------------
-@app.get(
-    "/healthz",
-    tags=["Health"],
-    summary="Health Check",
-    description="Verifica que el servicio está funcionando correctamente. No requiere autenticación.",
-    response_description="Estado del servicio"
-)
-def healthz():
-    """
-    Endpoint de healthcheck simple.
-    
-    Retorna:
-    - **ok**: True si el servicio está funcionando
-    - **service**: Nombre del servicio
-    """
-    return {"ok": True, "service": "sftp-api"}
+# ------------- Storage drivers -------------
+# Todo lo que está arriba del cliente (pools, breakers, réplicas, coalescing,
+# cachés, transfer workers) habla con un StorageClient: el subconjunto de
+# paramiko.SFTPClient que usa la API. Cada backend elige su driver; los errores
+# siguen la convención de Paramiko (FileNotFoundError y demás OSError).
+STORAGE_DRIVERS = ("sftp", "local", "memory")
 
-@app.get(
-    "/list",
-    tags=["Directorios"],
-    summary="Listar contenido de directorio",
-    description="Lista archivos y subdirectorios de una ruta específica. Retorna nombre, tamaño, permisos y timestamp de cada elemento.",
-    dependencies=[Depends(require_api_key)]
-)
-def list_dir(path: str = Query("/", description="Ruta relativa a BASE_DIR", example="/")):
-    settings = get_settings()
-    sftp = sftp_connect()
-    try:
-        target = safe_join(settings.BASE_DIR, path)
-        return {"path": target, "items": listdir_info(sftp, target)}
-    finally:
-        sftp.close()
+class StorageClient(Protocol):
+    def listdir(self, path: str) -> List[str]: ...
+    def listdir_attr(self, path: str) -> List[paramiko.SFTPAttributes]: ...
+    def stat(self, path: str) -> paramiko.SFTPAttributes: ...
+    def open(self, path: str, mode: str = "r"): ...
+    def mkdir(self, path: str, mode: int = 0o777): ...
+    def rmdir(self, path: str): ...
+    def remove(self, path: str): ...
+    def rename(self, oldpath: str, newpath: str): ...
+    def chmod(self, path: str, mode: int): ...
+    def truncate(self, path: str, size: int): ...
+    def close(self): ...
 
-@app.post(
-    "/mkdir",
-    tags=["Directorios"],
-    summary="Crear directorio",
-    description="Crea un directorio recursivamente (equivalente a `mkdir -p`). Si los directorios padre no existen, se crean automáticamente.",
-    dependencies=[Depends(require_api_key)]
-)
-def mkdir(path: str = Form(..., description="Directorio a crear (relativo a BASE_DIR)", example="/uploads/2025")):
-    settings = get_settings()
-    sftp = sftp_connect()
-    try:
-        target = safe_join(settings.BASE_DIR, path)
-        mkdirs_sftp(sftp, target)
-        return {"ok": True, "created": target}
-    finally:
-        sftp.close()
+class LocalStorageClient:
+    """StorageClient sobre el filesystem local: los paths del backend son paths locales."""
 
-@app.post(
-    "/upload",
-    tags=["Archivos"],
-    summary="Subir archivo",
-    description="Sube UN archivo al servidor SFTP. Solo acepta archivos individuales, no directorios. La ruta NO debe terminar en `/`.",
-    dependencies=[Depends(require_api_key)]
-)
-def upload(
-    remote_path: str = Form(..., description="Ruta destino del archivo (relativa a BASE_DIR)", example="/uploads/document.pdf"),
-    file: UploadFile = File(..., description="Archivo a subir")
-):
-    settings = get_settings()
-    sftp = sftp_connect()
-    try:
-        if remote_path.endswith("/"):
-            raise HTTPException(400, "remote_path debe ser un ARCHIVO (no terminar en /)")
-        target = safe_join(settings.BASE_DIR, remote_path)
-        remote_dir = posixpath.dirname(target)
-        mkdirs_sftp(sftp, remote_dir)
+    def listdir(self, path: str) -> List[str]:
+        return os.listdir(path)
 
-        # Evita sobreescribir un directorio por error
-        try:
-            if is_dir(sftp, target):
-                raise HTTPException(400, "remote_path apunta a un directorio; usa un nombre de archivo")
-        except FileNotFoundError:
-            pass
+    def listdir_attr(self, path: str) -> List[paramiko.SFTPAttributes]:
+        items = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                attr = paramiko.SFTPAttributes.from_stat(entry.stat(follow_symlinks=False), entry.name)
+                items.append(attr)
+        return items
 
-        with sftp.open(target, "wb") as dst:
-            while True:
-                chunk = file.file.read(1024 * 1024)  # 1MB
-                if not chunk:
-                    break
-                dst.write(chunk)
-        sftp.chmod(target, 0o640)
-        return {"ok": True, "path": target}
-    finally:
-        sftp.close()
+    def stat(self, path: str) -> paramiko.SFTPAttributes:
+        return paramiko.SFTPAttributes.from_stat(os.stat(path), posixpath.basename(path))
 
-@app.get(
-    "/download",
-    tags=["Archivos"],
-    summary="Descargar archivo",
-    description="Descarga un archivo del servidor SFTP. Retorna el archivo como stream.",
-    dependencies=[Depends(require_api_key)]
-)
-def download(remote_path: str = Query(..., description="Ruta del archivo a descargar (relativa a BASE_DIR)", example="/uploads/document.pdf")):
-    settings = get_settings()
-    sftp = sftp_connect()
-    try:
-        target = safe_join(settings.BASE_DIR, remote_path)
-        f = sftp.open(target, "rb")
-        filename = posixpath.basename(target)
-        return StreamingResponse(
-            f,
-            media_type="application/octet-stream",
-            headers={"Content-Disposition": f'attachment; filename="{filename}"'}
-        )
-    except FileNotFoundError:
-        raise HTTPException(404, "No existe")
-    finally:
-        sftp.close()
+    def open(self, path: str, mode: str = "r"):
+        return open(path, mode if "b" in mode else mode + "b")
 
-@app.delete(
-    "/delete-file",
-    tags=["Archivos"],
-    summary="Eliminar archivo",
-    description="Elimina un archivo del servidor SFTP. Si la ruta apunta a un directorio, retorna error.",
-    dependencies=[Depends(require_api_key)]
-)
-def delete_file(remote_path: str = Query(..., description="Ruta del archivo a eliminar (relativa a BASE_DIR)", example="/uploads/document.pdf")):
+    def mkdir(self, path: str, mode: int = 0o777):
+        os.mkdir(path, mode)
+
+    def rmdir(self, path: str):
+        os.rmdir(path)
+
+    def remove(self, path: str):
+        os.remove(path)
+
+    def rename(self, oldpath: str, newpath: str):
+        os.rename(oldpath, newpath)
+
+    def chmod(self, path: str, mode: int):
+        os.chmod(path, mode)
+
+    def truncate(self, path: str, size: int):
+        os.truncate(path, size)
+
+    def close(self):
+        pass
+
+class _MemoryEntry:
+    __slots__ = ("mode", "data", "mtime")
+
+    def __init__(self, mode: int, data: Optional[bytes] = None):
+        self.mode = mode
+        self.data = data
+        self.mtime = time.time()
+
+    def attrs(self, name: str) -> paramiko.SFTPAttributes:
+        attr = paramiko.SFTPAttributes()
+        attr.filename = name
+        attr.st_size = len(self.data) if self.data is not None else 0
+        attr.st_mode = self.mode
+        attr.st_uid = attr.st_gid = 0
+        attr.st_atime = attr.st_mtime = int(self.mtime)
+        return attr
+
+class MemoryStore:
+    """Árbol de archivos en memoria, compartido por todas las conexiones a un mismo host `memory`."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = {"/": _MemoryEntry(pystat.S_IFDIR | 0o755)}
+        self._children = {"/": set()}
+
+    def _get(self, path: str) -> _MemoryEntry:
+        entry = self._entries.get(path)
+        if entry is None:
+            raise FileNotFoundError(errno.ENOENT, "No such file", path)
+        return entry
+
+    def _parent_dir(self, path: str) -> str:
+        parent = posixpath.dirname(path)
+        if not pystat.S_ISDIR(self._get(parent).mode):
+            raise NotADirectoryError(errno.ENOTDIR, "Not a directory", parent)
+        return parent
+
+    def _add(self, path: str, entry: _MemoryEntry):
+        self._children[self._parent_dir(path)].add(posixpath.basename(path))
+        self._entries[path] = entry
+        if pystat.S_ISDIR(entry.mode):
+            self._children.setdefault(path, set())
+
+    def _drop(self, path: str):
+        del self._entries[path]
+        self._children.pop(path, None)
+        self._children[posixpath.dirname(path)].discard(posixpath.basename(path))
+
+    def listdir_attr(self, path: str) -> List[paramiko.SFTPAttributes]:
+        path = posixpath.normpath(path)
+        with self._lock:
+            if not pystat.S_ISDIR(self._get(path).mode):
+                raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+            return [self._entries[posixpath.join(path, name)].attrs(name) for name in sorted(self._children[path])]
+
+    def stat(self, path: str) -> paramiko.SFTPAttributes:
+        path = posixpath.normpath(path)
+        with self._lock:
+            return self._get(path).attrs(posixpath.basename(path))
+
+    def read(self, path: str) -> bytes:
+        path = posixpath.normpath(path)
+        with self._lock:
+            entry = self._get(path)
+            if entry.data is None:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory", path)
+            return entry.data
+
+    def write(self, path: str, data: bytes):
+        path = posixpath.normpath(path)
+        with self._lock:
+            entry = self._entries.get(path)
+            if entry is None:
+                self._add(path, _MemoryEntry(pystat.S_IFREG | 0o644, data))
+            elif entry.data is None:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory", path)
+            else:
+                entry.data, entry.mtime = data, time.time()
+
+    def mkdir(self, path: str, mode: int = 0o777):
+        path = posixpath.normpath(path)
+        with self._lock:
+            if path in self._entries:
+                raise FileExistsError(errno.EEXIST, "File exists", path)
+            self._add(path, _MemoryEntry(pystat.S_IFDIR | (mode & 0o7777)))
+
+    def rmdir(self, path: str):
+        path = posixpath.normpath(path)
+        with self._lock:
+            if not pystat.S_ISDIR(self._get(path).mode):
+                raise NotADirectoryError(errno.ENOTDIR, "Not a directory", path)
+            if self._children[path]:
+                raise OSError(errno.ENOTEMPTY, "Directory not empty", path)
+            self._drop(path)
+
+    def remove(self, path: str):
+        path = posixpath.normpath(path)
+        with self._lock:
+            if self._get(path).data is None:
+                raise IsADirectoryError(errno.EISDIR, "Is a directory", path)
+            self._drop(path)
+
+    def rename(self, oldpath: str, newpath: str):
+        oldpath, newpath = posixpath.normpath(oldpath), posixpath.normpath(newpath)
+        with self._lock:
+            self._get(oldpath)
+            if newpath in self._entries:
+                raise FileExistsError(errno.EEXIST, "File exists", newpath)
+            moved = sorted(p for p in self._entries if p == oldpath or p.startswith(oldpath + "/"))
+            entries = {p: self._entries[p] for p in moved}
+            for p in reversed(moved):
+                self._drop(p)
+            for p in moved:
+                self._add(newpath + p[len(oldpath):], entries[p])
+
+    def chmod(self, path: str, mode: int):
+        path = posixpath.normpath(path)
+        with self._lock:
+            entry = self._get(path)
+            entry.mode = pystat.S_IFMT(entry.mode) | (mode & 0o7777)
+
+    def truncate(self, path: str, size: int):
+        data = self.read(path)
+        self.write(path, data[:size].ljust(size, b"\0"))
+
+class _MemoryFile(io.BytesIO):
+    """Archivo abierto en un MemoryStore; las escrituras se publican al cerrar."""
+
+    def __init__(self, store: MemoryStore, path: str, data: bytes, writable: bool, append: bool):
+        super().__init__(data)
+        self._store, self._path, self._writable = store, path, writable
+        if append:
+            self.seek(0, io.SEEK_END)
+
+    def close(self):
+        if self._writable and not self.closed:
+            self._store.write(self._path, self.getvalue())
+        super().close()
+
+class MemoryStorageClient:
+    """StorageClient sobre un MemoryStore (sin red ni disco: aísla el costo de la API)."""
+
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def listdir(self, path: str) -> List[str]:
+        return [attr.filename for attr in self.store.listdir_attr(path)]
+
+    def listdir_attr(self, path: str) -> List[paramiko.SFTPAttributes]:
+        return self.store.listdir_attr(path)
+
+    def stat(self, path: str) -> paramiko.SFTPAttributes:
+        return self.store.stat(path)
+
+    def open(self, path: str, mode: str = "r"):
+        mode = mode.replace("b", "")
+        if mode == "r":
+            return _MemoryFile(self.store, path, self.store.read(path), writable=False, append=False)
+        if mode == "w":
+            self.store.write(path, b"")
+            return _MemoryFile(self.store, path, b"", writable=True, append=False)
+        if mode in ("r+", "a"):
+            try:
+                data = self.store.read(path)
+            except FileNotFoundError:
+                if mode == "r+":
+                    raise
+                data = b""
+            return _MemoryFile(self.store, path, data, writable=True, append=mode == "a")
+        raise ValueError(f"Modo no soportado: {mode}")
+
+    def mkdir(self, path: str, mode: int = 0o777):
+        self.store.mkdir(path, mode)
+
+    def rmdir(self, path: str):
+        self.store.rmdir(path)
+
+    def remove(self, path: str):
+        self.store.remove(path)
+
+    def rename(self, oldpath: str, newpath: str):
+        self.store.rename(oldpath, newpath)
+
+    def chmod(self, path: str, mode: int):
+        self.store.chmod(path, mode)
+
+    def truncate(self, path: str, size: int):
+        self.store.truncate(path, size)
+
+    def close(self):
+        pass
+
+_memory_stores: Dict[str, MemoryStore] = {}
+_memory_stores_lock = threading.Lock()
+
+def memory_store(name: str) -> MemoryStore:
+    with _memory_stores_lock:
+        store = _memory_stores.get(name)
+        if store is None:
+            store = _memory_stores[name] = MemoryStore()
+        return store
+
+def reset_memory_stores():
+    with _memory_stores_lock:
+        _memory_stores.clear()
+
+def storage_connect(config: Optional[BackendConfig] = None) -> StorageClient:
+    """Abre un cliente del driver de `config` (el pool llama a esto por cada conexión nueva)."""
+    config = config or default_backend_config()
+    if config.driver == "sftp":
+        return sftp_connect(config)
+    if config.driver == "local":
+        return LocalStorageClient()
+    if config.driver == "memory":
+        store = memory_store(config.host)
+        mkdirs_sftp(MemoryStorageClient(store), posixpath.normpath(config.base_dir or get_settings().BASE_DIR))
+        return MemoryStorageClient(store)
+    raise ValueError(f"Driver de storage desconocido: {config.driver}")
+
+# ------------- Métricas -------------
+class Metrics:
+    """Contadores simples en memoria, seguros entre threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def get(self, name: str) -> int:
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counters)
+
+metrics = Metrics()
+
+class LatencyWindow:
+    """Últimas operaciones SFTP (latencia o error) para calcular p99 y tasa de error recientes."""
+
+    def __init__(self, maxlen: int = 10000):
+        self._lock = threading.Lock()
+        self._samples = deque(maxlen=maxlen)  # (monotonic, ms | None si falló)
+
+    def record(self, elapsed_ms: float):
+        with self._lock:
+            self._samples.append((time.monotonic(), elapsed_ms))
+
+    def record_error(self):
+        with self._lock:
+            self._samples.append((time.monotonic(), None))
+
+    def summary(self, window: float) -> dict:
+        since = time.monotonic() - window
+        with self._lock:
+            recent = [ms for t, ms in self._samples if t >= since]
+        latencies = sorted(ms for ms in recent if ms is not None)
+        errors = len(recent) - len(latencies)
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(p * len(latencies)))], 2)
+
+        return {
+            "samples": len(recent),
+            "errors": errors,
+            "error_rate": round(errors / len(recent), 4) if recent else 0.0,
+            "p50_ms": percentile(0.5),
+            "p99_ms": percentile(0.99),
+        }
+
+    def clear(self):
+        with self._lock:
+            self._samples.clear()
+
+sftp_latency = LatencyWindow()
+
+# ------------- Coalescing (single-flight) -------------
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Agrupa llamadas concurrentes con la misma clave: solo la primera ejecuta
+    `fn`, el resto espera y recibe el mismo resultado (o la misma excepción).
+    """
+
+    def __init__(self, name: str, track: bool = True):
+        self.name = name
+        self.track = track
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, fn):
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if self.track:
+                metrics.incr(f"coalesced.{self.name}")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        if self.track:
+            metrics.incr(f"flights.{self.name}")
+        try:
+            flight.result = fn()
+            return flight.result
+        except BaseException as exc:
+            flight.error = exc
+            raise
+        finally:
+            with self._lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+class SharedStream:
+    """
+    Lectura de un archivo remoto compartida por varios suscriptores.
+
+    El suscriptor que llega al final de lo ya leído trae el siguiente chunk
+    desde la fuente; los demás lo reciben del buffer. Los chunks que todos
+    ya consumieron se descartan, y desde ese momento el stream deja de
+    aceptar suscriptores nuevos (no podrían recibir el archivo completo).
+
+    El buffer se acota a `max_lag` chunks detrás del más adelantado: pasado
+    ese límite, los suscriptores rezagados se desprenden y siguen con su
+    propia lectura desde `reopen(offset) -> (fuente, cleanup)`. Sin `reopen`,
+    quien lee espera a que los rezagados avancen.
+    """
+
+    def __init__(self, source, chunk_size: int, on_close=None, max_lag: int = 0, reopen=None):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._on_close = on_close
+        self._max_lag = max_lag
+        self._reopen = reopen
+        self._cond = threading.Condition()
+        self._chunks = []
+        self._base = 0          # índice absoluto del primer chunk retenido
+        self._base_offset = 0   # bytes de los chunks ya descartados
+        self._positions = {}    # id de suscriptor -> próximo índice absoluto
+        self._detached = {}     # id de suscriptor desprendido -> offset en bytes desde el que sigue
+        self._next_id = 0
+        self._reading = False
+        self._done = False
+        self._error = None
+        self._closed = False
+
+    def subscribe(self):
+        """Retorna un iterador de chunks, o None si el stream ya no es unible."""
+        with self._cond:
+            if self._closed or self._base > 0:
+                return None
+            sub_id = self._next_id
+            self._next_id += 1
+            self._positions[sub_id] = 0
+            return _StreamSubscriber(self, sub_id)
+
+    @property
+    def subscribers(self) -> int:
+        with self._cond:
+            return len(self._positions)
+
+    def _next_chunk(self, sub_id):
+        """El próximo chunk, None al terminar, o `_Detached` si el suscriptor debe seguir por su cuenta."""
+        while True:
+            with self._cond:
+                while True:
+                    if sub_id in self._detached:
+                        return _Detached(self._detached.pop(sub_id))
+                    pos = self._positions[sub_id]
+                    if pos < self._base + len(self._chunks):
+                        chunk = self._chunks[pos - self._base]
+                        self._positions[sub_id] = pos + 1
+                        if self._trim() and self._max_lag:
+                            self._cond.notify_all()  # quien lee puede estar esperando a este rezagado
+                        return chunk
+                    if self._error is not None:
+                        raise self._error
+                    if self._done:
+                        return None
+                    if not self._reading and self._lagging():
+                        if self._reopen is None:
+                            self._cond.wait()  # contrapresión: el rezagado marca el paso
+                            continue
+                        self._detach_laggards()
+                    if not self._reading:
+                        self._reading = True
+                        break
+                    self._cond.wait()
+            # Lectura fuera del lock para no bloquear a los demás suscriptores
+            data, error = None, None
+            try:
+                data = self._source.read(self._chunk_size)
+            except Exception as exc:
+                error = exc
+            with self._cond:
+                self._reading = False
+                if error is not None:
+                    self._error = error
+                elif not data:
+                    self._done = True
+                else:
+                    self._chunks.append(data)
+                self._cond.notify_all()
+
+    def _lagging(self) -> bool:
+        return self._max_lag > 0 and len(self._chunks) >= self._max_lag
+
+    def _detach_laggards(self):
+        head = self._base + len(self._chunks)
+        for sub_id, pos in list(self._positions.items()):
+            if head - pos >= self._max_lag:
+                offset = self._base_offset + sum(len(c) for c in self._chunks[:pos - self._base])
+                del self._positions[sub_id]
+                self._detached[sub_id] = offset
+                metrics.incr("coalesced.detached")
+        self._trim()
+
+    def _trim(self) -> int:
+        """Descarta los chunks que todos consumieron; retorna cuántos."""
+        if not self._positions:
+            return 0
+        drop = min(self._positions.values()) - self._base
+        if drop > 0:
+            self._base_offset += sum(len(c) for c in self._chunks[:drop])
+            del self._chunks[:drop]
+            self._base += drop
+        return max(drop, 0)
+
+    def _unsubscribe(self, sub_id):
+        with self._cond:
+            self._detached.pop(sub_id, None)
+            if self._positions.pop(sub_id, None) is None:
+                return
+            self._trim()
+            self._cond.notify_all()  # quien lee puede estar esperando a este rezagado
+            if self._positions or self._closed:
+                return
+            self._closed = True
+            self._chunks = []
+        try:
+            self._source.close()
+        finally:
+            if self._on_close:
+                self._on_close()
+
+class _Detached:
+    __slots__ = ("offset",)
+
+    def __init__(self, offset: int):
+        self.offset = offset
+
+class _StreamSubscriber:
+    """Iterador de un suscriptor; libera su posición al terminar o al ser descartado."""
+
+    def __init__(self, stream: SharedStream, sub_id: int):
+        self._stream = stream
+        self._sub_id = sub_id
+        self._closed = False
+        self._own = None  # lectura propia tras desprenderse del stream compartido
+        self.shared = sub_id > 0  # True si se unió a una lectura ya iniciada
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._closed:
+            raise StopIteration
+        try:
+            if self._own is not None:
+                chunk = next(self._own, None)
+            else:
+                chunk = self._stream._next_chunk(self._sub_id)
+                if isinstance(chunk, _Detached):
+                    source, cleanup = self._stream._reopen(chunk.offset)
+                    self._own = SharedStream(source, self._stream._chunk_size, on_close=cleanup).subscribe()
+                    chunk = next(self._own, None)
+        except BaseException:
+            self.close()
+            raise
+        if chunk is None:
+            self.close()
+            raise StopIteration
+        return chunk
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            try:
+                self._stream._unsubscribe(self._sub_id)
+            finally:
+                if self._own is not None:
+                    self._own.close()
+
+    def __del__(self):
+        self.close()
+
+class StreamCoalescer:
+    """Comparte una misma lectura remota entre descargas concurrentes del mismo path."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self._lock = threading.Lock()
+        self._streams = {}
+        self._opening = SingleFlight(f"{name}.open", track=False)
+
+    def open(self, key, opener, chunk_size: int, max_lag: int = 0, reopen=None):
+        """
+        `opener()` debe retornar `(fuente, cleanup)`; `cleanup` se ejecuta cuando
+        el último suscriptor termina. `max_lag` y `reopen` como en SharedStream.
+        """
+        while True:
+            with self._lock:
+                stream = self._streams.get(key)
+            if stream is None:
+                stream = self._opening.do(key, lambda: self._start(key, opener, chunk_size, max_lag, reopen))
+            sub = stream.subscribe()
+            if sub is not None:
+                if sub.shared:
+                    metrics.incr(f"coalesced.{self.name}")
+                return sub
+            with self._lock:
+                if self._streams.get(key) is stream:
+                    del self._streams[key]
+
+    def _start(self, key, opener, chunk_size, max_lag, reopen):
+        source, cleanup = opener()
+        metrics.incr(f"flights.{self.name}")
+
+        def on_close():
+            with self._lock:
+                if self._streams.get(key) is stream:
+                    del self._streams[key]
+            if cleanup:
+                cleanup()
+
+        stream = SharedStream(source, chunk_size, on_close=on_close, max_lag=max_lag, reopen=reopen)
+        with self._lock:
+            self._streams[key] = stream
+        return stream
+
+_list_flights = SingleFlight("list")
+_download_flights = StreamCoalescer("download")
+
+# ------------- Ring de buffers -------------
+# Desacopla los dos lados de una transferencia: un thread lee la fuente (el body de
+# un upload, el archivo remoto de un download) a slots preasignados mientras quien
+# consume escribe los anteriores, así la latencia de un lado se solapa con la del
+# otro en vez de sumarse. Los slots se reusan entre transferencias.
+class BufferRing:
+    """`slots` buffers de `slot_size` bytes, asignados una sola vez."""
+
+    def __init__(self, slots: int, slot_size: int):
+        self.slot_size = slot_size
+        self.views = [memoryview(bytearray(slot_size)) for _ in range(slots)]
+
+_ring_pool: Dict[Tuple[int, int], List[BufferRing]] = {}
+_ring_pool_lock = threading.Lock()
+
+def acquire_ring(slots: int, slot_size: int) -> BufferRing:
+    with _ring_pool_lock:
+        idle = _ring_pool.get((slots, slot_size))
+        if idle:
+            metrics.incr("ring.reused")
+            return idle.pop()
+    return BufferRing(slots, slot_size)
+
+def release_ring(ring: BufferRing):
+    with _ring_pool_lock:
+        if sum(map(len, _ring_pool.values())) < get_settings().TRANSFER_RING_POOL:
+            _ring_pool.setdefault((len(ring.views), ring.slot_size), []).append(ring)
+
+class RingReader:
+    """
+    Lee `source` por adelantado en un thread, a los slots de un BufferRing. Con
+    `chunks()` se recorren los slots sin copiar (cada memoryview vale hasta pedir la
+    siguiente); `read()` copia, para quien necesita bytes propios. `on_chunk` corre
+    en el thread lector, solapado con la escritura del consumidor; sus errores, como
+    los de la fuente, se lanzan en el consumidor.
+    """
+
+    def __init__(self, source, slot_size: int, slots: int, on_chunk=None):
+        self._source = source
+        self._on_chunk = on_chunk
+        self._ring = acquire_ring(slots, slot_size)
+        self._free = queue.SimpleQueue()
+        self._filled = queue.SimpleQueue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._pending = None  # (slot, inicio, fin) a medio consumir por read()
+        self._done = False
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce, name="sftp-ring", daemon=True)
+        self._thread.start()
+
+    def _produce(self):
+        readinto = getattr(self._source, "readinto", None)
+        try:
+            while True:
+                slot = self._free.get()
+                if self._closed:
+                    return
+                view = self._ring.views[slot]
+                if readinto is not None:
+                    n = readinto(view)
+                else:
+                    data = self._source.read(len(view))
+                    n = len(data)
+                    view[:n] = data
+                if n and self._on_chunk is not None:
+                    self._on_chunk(view[:n])
+                self._filled.put((slot, n))
+                if not n:
+                    return
+        except BaseException as exc:
+            self._filled.put((None, exc))
+
+    def _next(self) -> Optional[Tuple[int, int]]:
+        """Próximo slot lleno `(slot, bytes)`, o None al final de la fuente."""
+        if self._error is not None:
+            raise self._error
+        if self._done:
+            return None
+        slot, n = self._filled.get()
+        if slot is None:
+            self._error = n
+            raise n
+        if not n:
+            self._done = True
+            return None
+        return slot, n
+
+    def chunks(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return
+            slot, n = item
+            try:
+                yield self._ring.views[slot][:n]
+            finally:
+                self._free.put(slot)
+
+    def read(self, size: int = -1) -> bytes:
+        """Hasta `size` bytes, sin pasar del slot en curso (como una lectura raw); b"" al final."""
+        if self._pending is None:
+            item = self._next()
+            if item is None:
+                return b""
+            self._pending = (item[0], 0, item[1])
+        slot, start, end = self._pending
+        stop = end if size is None or size < 0 else min(end, start + size)
+        data = bytes(self._ring.views[slot][start:stop])
+        if stop == end:
+            self._pending = None
+            self._free.put(slot)
+        else:
+            self._pending = (slot, stop, end)
+        return data
+
+    def close(self):
+        """Detiene el thread lector (termina la lectura en curso) y devuelve el ring al pool. No cierra `source`."""
+        if self._closed:
+            return
+        self._closed = True
+        self._free.put(0)  # despierta al lector si espera un slot libre
+        self._thread.join()
+        release_ring(self._ring)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@contextmanager
+def body_chunks(fileobj, chunk_size: int, on_chunk=None):
+    """
+    Chunks de `fileobj` para escribirlos en otro lado: leídos por adelantado en un
+    RingReader, o en lockstep con TRANSFER_RING_SLOTS=0. `on_chunk` ve cada uno
+    antes que el consumidor.
+    """
+    slots = get_settings().TRANSFER_RING_SLOTS
+    if slots <= 0:
+        def lockstep():
+            while True:
+                chunk = fileobj.read(chunk_size)
+                if not chunk:
+                    return
+                if on_chunk is not None:
+                    on_chunk(chunk)
+                yield chunk
+        yield lockstep()
+        return
+    with RingReader(fileobj, chunk_size, slots, on_chunk) as reader:
+        yield reader.chunks()
+
+class ReadAhead:
+    """
+    Lee `source` por adelantado en un thread, hasta `depth` chunks en cola. A
+    diferencia de RingReader no usa slots: `read()` entrega los mismos bytes que
+    devolvió la fuente, sin copiarlos. Es para consumidores que retienen los chunks
+    (SharedStream), donde un slot reusable obligaría a copiar cada uno.
+    """
+
+    def __init__(self, source, chunk_size: int, depth: int):
+        self._source = source
+        self._chunk_size = chunk_size
+        self._queue = queue.Queue(maxsize=depth)
+        self._pending = b""  # resto de un chunk leído con un `size` menor
+        self._done = False
+        self._error = None
+        self._closed = False
+        self._thread = threading.Thread(target=self._produce, name="sftp-read-ahead", daemon=True)
+        self._thread.start()
+
+    def _produce(self):
+        try:
+            while not self._closed:
+                data = self._source.read(self._chunk_size)
+                self._queue.put(data)
+                if not data:
+                    return
+        except BaseException as exc:
+            self._queue.put(exc)
+
+    def read(self, size: int = -1) -> bytes:
+        """Hasta `size` bytes, sin pasar del chunk en curso (como una lectura raw); b"" al final."""
+        if not self._pending:
+            if self._error is not None:
+                raise self._error
+            if self._done:
+                return b""
+            item = self._queue.get()
+            if isinstance(item, BaseException):
+                self._error = item
+                raise item
+            if not item:
+                self._done = True
+                return b""
+            self._pending = item
+        data = self._pending
+        if size is not None and 0 <= size < len(data):
+            data, self._pending = data[:size], data[size:]
+        else:
+            self._pending = b""
+        return data
+
+    def close(self):
+        """Detiene el thread lector (termina la lectura en curso). No cierra `source`."""
+        if self._closed:
+            return
+        self._closed = True
+        while self._thread.is_alive():
+            try:
+                self._queue.get(timeout=0.05)  # libera lugar si el lector espera en put()
+            except queue.Empty:
+                pass
+        self._thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def read_ahead(f, cleanup, chunk_size: int):
+    """
+    `(archivo, cleanup)` de un open_read -> lo mismo, leído por adelantado (hasta
+    TRANSFER_RING_SLOTS chunks) para que SharedStream lo consuma.
+    """
+    slots = get_settings().TRANSFER_RING_SLOTS
+    if slots <= 0:
+        return f, cleanup
+    reader = ReadAhead(f, chunk_size, slots)
+
+    def close():
+        try:
+            f.close()
+        finally:
+            cleanup()
+
+    return reader, close
+
+# ------------- Backends SFTP (pools, routing, health) -------------
+def _connection_errors() -> tuple:
+    """Errores que indican una conexión rota: el cliente se descarta del pool."""
+    return (EOFError, ConnectionError, socket.timeout, paramiko.SSHException)
+
+def _client_alive(client) -> bool:
+    get_channel = getattr(client, "get_channel", None)
+    if get_channel is None:
+        return True
+    chan = get_channel()
+    if chan is None or chan.closed:
+        return False
+    transport = chan.get_transport()
+    return transport is not None and transport.is_active()
+
+def _worker_session_share(settings) -> int:
+    return max(1, settings.SFTP_SESSION_BUDGET // max(1, settings.WEB_CONCURRENCY))
+
+def transfer_worker_count(settings) -> int:
+    """
+    Transfer workers de este proceso. Cada uno retiene una sesión por nodo, que sale
+    de la misma parte de SFTP_SESSION_BUDGET que el pool (que conserva al menos una).
+    """
+    if settings.SFTP_SESSION_BUDGET <= 0:
+        return settings.TRANSFER_WORKERS
+    return max(0, min(settings.TRANSFER_WORKERS, _worker_session_share(settings) - 1))
+
+def worker_pool_size(settings) -> int:
+    """Tamaño del pool de cada nodo en este worker, repartiendo SFTP_SESSION_BUDGET entre los workers."""
+    if settings.SFTP_SESSION_BUDGET <= 0:
+        return settings.SFTP_POOL_SIZE
+    return max(1, _worker_session_share(settings) - transfer_worker_count(settings))
+
+class SFTPPool:
+    """Pool acotado de clientes SFTP reutilizables."""
+
+    def __init__(self, connect, size: int, timeout: float):
+        self._connect = connect
+        self.size = size
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(size)
+        self._lock = threading.Lock()
+        self._idle = []
+        self.in_use = 0
+        self.created = 0
+
+    def acquire(self, timeout: Optional[float] = None):
+        if not self._slots.acquire(timeout=self.timeout if timeout is None else timeout):
+            raise HTTPException(503, "Pool SFTP agotado, reintenta más tarde")
+        try:
+            client = None
+            while client is None:
+                with self._lock:
+                    candidate = self._idle.pop() if self._idle else None
+                if candidate is None:
+                    client = self._connect()
+                    with self._lock:
+                        self.created += 1
+                elif _client_alive(candidate):
+                    client = candidate
+                else:
+                    self._discard(candidate)
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self.in_use += 1
+        return client
+
+    def release(self, client, broken: bool = False):
+        with self._lock:
+            self.in_use -= 1
+            if not broken:
+                self._idle.append(client)
+        if broken:
+            self._discard(client)
+        self._slots.release()
+
+    @contextmanager
+    def session(self):
+        client = self.acquire()
+        broken = False
+        try:
+            yield client
+        except _connection_errors():
+            broken = True
+            raise
+        finally:
+            self.release(client, broken)
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for client in idle:
+            self._discard(client)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": self.size, "in_use": self.in_use, "idle": len(self._idle), "created": self.created}
+
+    def prefill(self, count: int):
+        """Deja al menos `count` conexiones abiertas (y vivas) en el pool."""
+        clients = []
+        try:
+            for _ in range(min(count, self.size)):
+                clients.append(self.acquire())
+        finally:
+            for client in clients:
+                self.release(client)
+
+    @staticmethod
+    def _discard(client):
+        try:
+            client.close()
+        except Exception:
+            pass
+
+class CircuitBreaker:
+    """
+    Saca de servicio un nodo tras `threshold` fallas de conexión seguidas.
+    Pasado `cooldown`, deja pasar un único intento (half-open) para probarlo.
+    """
+
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._lock = threading.Lock()
+        self.failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            if self._opened_at is None:
+                return "closed"
+            if self._trial or time.monotonic() - self._opened_at >= self.cooldown:
+                return "half-open"
+            return "open"
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if not self._trial and time.monotonic() - self._opened_at >= self.cooldown:
+                self._trial = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.failures = 0
+            self._opened_at = None
+            self._trial = False
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                self._opened_at = time.monotonic()
+                self._trial = False
+
+    def trip(self):
+        with self._lock:
+            self.failures = max(self.failures, self.threshold)
+            self._opened_at = time.monotonic()
+            self._trial = False
+
+class Node:
+    """Un host SFTP concreto (primario o réplica) con su pool y circuit breaker."""
+
+    def __init__(self, role: str, config: BackendConfig, settings):
+        self.role = role
+        self.config = config
+        self.base_dir = posixpath.normpath(config.base_dir or settings.BASE_DIR)
+        # `storage_connect` se resuelve en cada conexión (permite override en tests)
+        self.pool = SFTPPool(lambda: storage_connect(self.config), worker_pool_size(settings), settings.SFTP_POOL_TIMEOUT)
+        self.breaker = CircuitBreaker(settings.SFTP_BREAKER_THRESHOLD, settings.SFTP_BREAKER_COOLDOWN)
+        self._lock = threading.Lock()
+        self.outstanding = 0
+        self.latency_ms = None  # EWMA de operaciones exitosas
+        self.last_check = None
+        self.last_error = None
+
+    def join(self, rel: str) -> str:
+        return posixpath.normpath(posixpath.join(self.base_dir, rel.lstrip("/")))
+
+    @property
+    def healthy(self) -> bool:
+        return self.breaker.state != "open"
+
+    def acquire(self):
+        with self._lock:
+            self.outstanding += 1
+        try:
+            return self.pool.acquire()
+        except BaseException as exc:
+            with self._lock:
+                self.outstanding -= 1
+            if isinstance(exc, HTTPException) or not isinstance(exc, Exception):
+                raise
+            self._record_error(exc)
+            raise HTTPException(503, f"No se pudo conectar a {self.config.host}:{self.config.port}") from exc
+
+    def release(self, client, error: Optional[BaseException] = None):
+        broken = isinstance(error, _connection_errors())
+        self.pool.release(client, broken)
+        with self._lock:
+            self.outstanding -= 1
+        if broken:
+            self._record_error(error)
+        else:
+            self.breaker.record_success()
+
+    @contextmanager
+    def session(self):
+        client = self.acquire()
+        start = time.monotonic()
+        error = None
+        try:
+            yield client
+        except BaseException as exc:
+            error = exc
+            raise
+        finally:
+            self.release(client, error)
+            if error is None:
+                self.observe((time.monotonic() - start) * 1000)
+
+    def observe(self, elapsed_ms: float):
+        sftp_latency.record(elapsed_ms)
+        with self._lock:
+            self.latency_ms = elapsed_ms if self.latency_ms is None else 0.8 * self.latency_ms + 0.2 * elapsed_ms
+
+    def _record_error(self, exc: BaseException):
+        sftp_latency.record_error()
+        self.last_error = str(exc) or type(exc).__name__
+        self.breaker.record_failure()
+
+    def check_health(self):
+        """
+        Health check periódico. Como `probe`, espera poco por una conexión: un pool
+        agotado es un nodo ocupado, no caído, y no abre el breaker.
+        """
+        start = time.monotonic()
+        self.last_check = time.time()
+        try:
+            client = self.pool.acquire(timeout=get_settings().READYZ_PROBE_TIMEOUT)
+        except HTTPException:
+            metrics.incr("health.busy")
+            return
+        except Exception as exc:
+            self.last_error = str(exc) or type(exc).__name__
+            self.breaker.trip()
+            return
+        error = None
+        try:
+            client.stat(self.base_dir)
+        except Exception as exc:
+            error = exc
+        finally:
+            self.pool.release(client, isinstance(error, _connection_errors()))
+        if error is not None:
+            self.last_error = str(error) or type(error).__name__
+            self.breaker.trip()
+        else:
+            self.last_error = None
+            self.breaker.record_success()
+            self.observe((time.monotonic() - start) * 1000)
+
+    def probe(self, timeout: float) -> dict:
+        """`stat` de base_dir con una conexión del pool, sin esperar más de `timeout` por ella."""
+        start = time.monotonic()
+        try:
+            client = self.pool.acquire(timeout=timeout)
+        except HTTPException as exc:
+            return {"ok": False, "error": exc.detail}
+        except Exception as exc:
+            self._record_error(exc)
+            return {"ok": False, "error": self.last_error}
+        error = None
+        try:
+            client.stat(self.base_dir)
+        except Exception as exc:
+            error = exc
+        finally:
+            self.pool.release(client, isinstance(error, _connection_errors()))
+        if error is not None:
+            if isinstance(error, _connection_errors()):
+                self._record_error(error)
+            return {"ok": False, "error": str(error) or type(error).__name__}
+        elapsed_ms = (time.monotonic() - start) * 1000
+        self.observe(elapsed_ms)
+        return {"ok": True, "latency_ms": round(elapsed_ms, 2)}
+
+    def saturation(self) -> float:
+        stats = self.pool.stats()
+        return stats["in_use"] / stats["size"] if stats["size"] else 1.0
+
+    def load(self, strategy: str) -> float:
+        """Costo estimado de mandarle una lectura más (menor es mejor)."""
+        if strategy == "latency":
+            return (self.latency_ms or 1.0) * (self.outstanding + 1)
+        return self.outstanding
+
+    def info(self) -> dict:
+        return {
+            "role": self.role,
+            "host": self.config.host,
+            "port": self.config.port,
+            "base_dir": self.base_dir,
+            "healthy": self.healthy,
+            "breaker": self.breaker.state,
+            "failures": self.breaker.failures,
+            "outstanding": self.outstanding,
+            "latency_ms": round(self.latency_ms, 2) if self.latency_ms is not None else None,
+            "last_check": self.last_check,
+            "last_error": self.last_error,
+            "pool": self.pool.stats(),
+        }
+
+class Backend:
+    """
+    Un namespace SFTP: un primario (recibe las escrituras) y réplicas opcionales
+    con el mismo contenido, entre las que se reparten las lecturas.
+    """
+
+    def __init__(self, name: str, config: BackendConfig, settings):
+        self.name = name
+        self.config = config
+        self.primary = Node("primary", config, settings)
+        self.replicas = [
+            Node("replica", config.model_copy(update={**replica.model_dump(exclude_none=True), "replicas": []}), settings)
+            for replica in config.replicas
+        ]
+        self.read_strategy = settings.SFTP_READ_STRATEGY
+        self.read_nodes = ([self.primary] if settings.SFTP_READ_FROM_PRIMARY or not self.replicas else []) + self.replicas
+        self.base_dir = self.primary.base_dir
+        self.local_dir = os.path.realpath(config.local_dir) if config.local_dir else None
+        # Los transfer workers son otros procesos: no ven un store en memoria
+        self.offloadable = config.driver != "memory"
+
+    @property
+    def nodes(self) -> List[Node]:
+        return [self.primary] + self.replicas
+
+    @property
+    def healthy(self) -> bool:
+        return self.primary.healthy
+
+    def join(self, rel: str) -> str:
+        return self.primary.join(rel)
+
+    def local_path(self, rel: str) -> Optional[str]:
+        """Ruta de `rel` en el montaje local, o None si el backend no tiene `local_dir`."""
+        if self.local_dir is None:
+            return None
+        path = os.path.join(self.local_dir, rel.lstrip("/"))
+        # realpath: un symlink dentro del montaje no puede apuntar fuera de él
+        real = os.path.realpath(path)
+        if real != self.local_dir and not real.startswith(self.local_dir + os.sep):
+            raise HTTPException(400, "Ruta fuera de BASE_DIR")
+        return real
+
+    def session(self):
+        """Sesión en el primario (escrituras)."""
+        if not self.primary.breaker.allow():
+            raise HTTPException(503, f"Backend SFTP '{self.name}' no disponible")
+        return self.primary.session()
+
+    def _read_candidates(self):
+        """Nodos de lectura del menos al más cargado, saltando los que tienen el breaker abierto."""
+        ranked = sorted(
+            self.read_nodes,
+            key=lambda node: (node.load(self.read_strategy), node.breaker.failures, random.random()),
+        )
+        for node in ranked:
+            # allow() se consulta recién al intentar el nodo: en half-open consume el único intento
+            if node.breaker.allow():
+                yield node
+
+    def read_node(self) -> Node:
+        """Nodo de lectura menos cargado (para lecturas que no pasan por el pool, como los transfer workers)."""
+        node = next(self._read_candidates(), None)
+        if node is None:
+            raise HTTPException(503, f"Backend SFTP '{self.name}' sin nodos de lectura disponibles")
+        return node
+
+    def read(self, rel: str, fn):
+        """
+        Ejecuta `fn(sftp, path)` en el nodo de lectura menos cargado. Ante una
+        falla de conexión reintenta en el siguiente nodo disponible.
+        """
+        last_error = None
+        for node in self._read_candidates():
+            try:
+                with node.session() as sftp:
+                    return fn(sftp, node.join(rel))
+            except _connection_errors() as exc:
+                last_error = exc
+            except HTTPException as exc:
+                if exc.status_code != 503:
+                    raise
+                last_error = exc
+            metrics.incr("replicas.failover")
+        raise HTTPException(503, f"Backend SFTP '{self.name}' sin nodos de lectura disponibles") from last_error
+
+    def open_read(self, rel: str):
+        """Abre `rel` para lectura en un nodo de lectura; retorna `(archivo, cleanup)`."""
+        last_error = None
+        for node in self._read_candidates():
+            start = time.monotonic()
+            try:
+                sftp = node.acquire()
+            except HTTPException as exc:
+                if exc.status_code != 503:
+                    raise
+                last_error = exc
+                metrics.incr("replicas.failover")
+                continue
+            try:
+                f = sftp.open(node.join(rel), "rb")
+            except BaseException as exc:
+                node.release(sftp, exc)
+                if isinstance(exc, _connection_errors()):
+                    last_error = exc
+                    metrics.incr("replicas.failover")
+                    continue
+                raise
+            node.observe((time.monotonic() - start) * 1000)
+            return f, lambda: node.release(sftp)
+        raise HTTPException(503, f"Backend SFTP '{self.name}' sin nodos de lectura disponibles") from last_error
+
+    def check_health(self):
+        for node in self.nodes:
+            node.check_health()
+
+    def warm(self, connections: int) -> List[str]:
+        """Pre-abre conexiones en cada nodo; retorna los errores de los nodos que fallaron."""
+        errors = []
+        for node in self.nodes:
+            try:
+                node.pool.prefill(connections)
+            except Exception as exc:
+                node.breaker.record_failure()
+                errors.append(f"{self.name}/{node.role}: {getattr(exc, 'detail', None) or exc or type(exc).__name__}")
+        return errors
+
+    def close(self):
+        for node in self.nodes:
+            node.pool.close()
+
+    def info(self) -> dict:
+        return {
+            "name": self.name,
+            "healthy": self.healthy,
+            "read_strategy": self.read_strategy,
+            "nodes": [node.info() for node in self.nodes],
+        }
+
+class HashRing:
+    """Consistent hashing de paths a backends (con nodos virtuales)."""
+
+    def __init__(self, names: List[str], vnodes: int = 64):
+        self._ring = sorted((self._hash(f"{name}#{i}"), name) for name in names for i in range(vnodes))
+        self._keys = [h for h, _ in self._ring]
+
+    @staticmethod
+    def _hash(key: str) -> int:
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+    def get(self, key: str) -> str:
+        idx = bisect.bisect(self._keys, self._hash(key)) % len(self._keys)
+        return self._ring[idx][1]
+
+class Router:
+    """
+    Mapea paths (relativos a BASE_DIR) a backends.
+
+    - `prefix`: el prefijo más largo de `SFTP_ROUTES` decide; si ninguno aplica,
+      va al backend por defecto. Cada subárbol vive entero en un backend.
+    - `hash`: cada archivo va al backend que indica el hash ring; los
+      directorios existen en todos los shards y los listados se combinan.
+    """
+
+    def __init__(self, settings):
+        configs = {"default": default_backend_config()}
+        configs.update(settings.SFTP_BACKENDS or {})
+        if settings.SFTP_DEFAULT_BACKEND not in configs:
+            raise ValueError(f"SFTP_DEFAULT_BACKEND desconocido: {settings.SFTP_DEFAULT_BACKEND}")
+        self.mode = settings.SFTP_ROUTING
+        if self.mode not in ("prefix", "hash"):
+            raise ValueError(f"SFTP_ROUTING inválido: {self.mode}")
+        if settings.SFTP_READ_STRATEGY not in ("least_outstanding", "latency"):
+            raise ValueError(f"SFTP_READ_STRATEGY inválido: {settings.SFTP_READ_STRATEGY}")
+        for name, cfg in configs.items():
+            if cfg.driver not in STORAGE_DRIVERS:
+                raise ValueError(f"Driver de storage desconocido en backend '{name}': {cfg.driver}")
+        self.backends = {
+            name: Backend(name, cfg, settings)
+            for name, cfg in configs.items()
+        }
+        self.default = self.backends[settings.SFTP_DEFAULT_BACKEND]
+        self.routes = []
+        for prefix, name in (settings.SFTP_ROUTES or {}).items():
+            if name not in self.backends:
+                raise ValueError(f"SFTP_ROUTES apunta a backend desconocido: {name}")
+            self.routes.append((posixpath.normpath("/" + prefix.strip("/")), self.backends[name]))
+        self.routes.sort(key=lambda r: len(r[0]), reverse=True)
+        self.ring = HashRing(sorted(self.backends)) if self.mode == "hash" else None
+
+    @property
+    def sharded(self) -> bool:
+        return self.mode == "hash" and len(self.backends) > 1
+
+    def backend_for(self, rel: str) -> Backend:
+        if self.ring is not None:
+            return self.backends[self.ring.get(rel)]
+        for prefix, backend in self.routes:
+            if prefix == "/" or rel == prefix or rel.startswith(prefix + "/"):
+                return backend
+        return self.default
+
+    def backends_for_dir(self, rel: str) -> List[Backend]:
+        """Backends que pueden tener contenido bajo el directorio `rel`."""
+        if self.sharded:
+            return list(self.backends.values())
+        return [self.backend_for(rel)]
+
+    def mounted_children(self, rel: str) -> List[str]:
+        """Nombres de subdirectorios de `rel` que son prefijos ruteados (modo prefix)."""
+        names = set()
+        base = "" if rel == "/" else rel
+        for prefix, _ in self.routes:
+            if prefix.startswith(base + "/") and prefix != rel:
+                names.add(prefix[len(base) + 1:].split("/", 1)[0])
+        return sorted(names)
+
+    def close(self):
+        for backend in self.backends.values():
+            backend.close()
+
+_router = None
+_router_lock = threading.Lock()
+_fanout_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="sftp-fanout")
+
+def get_router() -> Router:
+    global _router
+    with _router_lock:
+        if _router is None:
+            _router = Router(get_settings())
+        return _router
+
+def reset_backends():
+    """Cierra los pools y reconstruye el routing en el próximo uso."""
+    global _router
+    with _router_lock:
+        router, _router = _router, None
+    if router is not None:
+        router.close()
+
+def relative_path(path: str) -> str:
+    """Valida `path` contra BASE_DIR y lo retorna normalizado y relativo ("/a/b")."""
+    settings = get_settings()
+    base = posixpath.normpath(settings.BASE_DIR)
+    target = safe_join(base, path)
+    rel = target[len(base):] if base != "/" else target
+    return "/" + rel.lstrip("/")
+
+def fan_out(backends: List[Backend], fn):
+    """Ejecuta `fn(backend)` en paralelo y retorna los resultados en orden."""
+    if len(backends) == 1:
+        return [fn(backends[0])]
+    return list(_fanout_executor.map(fn, backends))
+
+def merge_listings(listings: List[list]) -> list:
+    """Combina listados de varios shards; un directorio presente en varios aparece una vez."""
+    merged = {}
+    for items in listings:
+        for item in items:
+            prev = merged.get(item["name"])
+            if prev is None or (item["mtime"] or 0) > (prev["mtime"] or 0):
+                merged[item["name"]] = item
+    return [merged[name] for name in sorted(merged)]
+
+def list_directory(rel: str, use_cache: bool = True) -> list:
+    """
+    Lista `rel` en todos los backends que corresponda (combinando shards), con coalescing.
+    Con METADATA_CACHE_TTL > 0 usa el cache de listados; `use_cache=False` fuerza el
+    listado remoto (y lo deja en el cache).
+    """
+    return listing_snapshot(rel, use_cache)[1]
+
+def listing_snapshot(rel: str, use_cache: bool = True) -> Tuple[float, list, bool]:
+    """
+    Como list_directory, pero retorna `(listed_at, items, cached)`: cuándo se listó en
+    el servidor (también si viene del cache) y si salió del cache.
+    """
+    settings = get_settings()
+    if use_cache and settings.METADATA_CACHE_TTL > 0:
+        cached = metadata_cache().get(("list", rel))
+        if cached is not None:
+            metrics.incr("cache.list_hits")
+            return cached[0], list(cached[1]), True
+    router = get_router()
+    backends = router.backends_for_dir(rel)
+
+    def list_one(backend):
+        try:
+            return backend.read(rel, listdir_info)
+        except FileNotFoundError:
+            if len(backends) > 1:
+                return None
+            raise
+
+    def load():
+        listed_at = time.time()
+        listings = [items for items in fan_out(backends, list_one) if items is not None]
+        if not listings:
+            raise HTTPException(404, "No existe")
+        items = merge_listings(listings) if len(listings) > 1 else listings[0]
+        names = {item["name"] for item in items}
+        for name in router.mounted_children(rel):
+            if name not in names:
+                items.append({"name": name, "size": 0, "mode": oct(pystat.S_IFDIR | 0o750), "is_dir": True, "mtime": None})
+        return listed_at, items
+
+    key = (tuple(b.name for b in backends), rel)
+    listed_at, items = _list_flights.do(key, load) if settings.COALESCE_READS else load()
+    if settings.METADATA_CACHE_TTL > 0:
+        metadata_cache().set(("list", rel), (listed_at, list(items)), settings.METADATA_CACHE_TTL)
+    return listed_at, items, False
+
+def stat_entry(rel: str, use_cache: bool = True) -> dict:
+    """entry_info de `rel` (buscando en los shards que corresponda), con cache de stats."""
+    settings = get_settings()
+    if use_cache and settings.METADATA_CACHE_TTL > 0:
+        cached = metadata_cache().get(("stat", rel))
+        if cached is not None:
+            metrics.incr("cache.stat_hits")
+            return dict(cached)
+    router = get_router()
+    primary = router.backend_for(rel)
+    # En modo hash un directorio puede existir solo en algunos shards
+    candidates = [primary] + [b for b in router.backends_for_dir(rel) if b is not primary]
+    for backend in candidates:
+        try:
+            info = backend.read(rel, lambda sftp, p: entry_info(sftp.stat(p), posixpath.basename(p)))
+        except FileNotFoundError:
+            continue
+        if settings.METADATA_CACHE_TTL > 0:
+            metadata_cache().set(("stat", rel), dict(info), settings.METADATA_CACHE_TTL)
+        return info
+    raise HTTPException(404, "No existe")
+
+def store_file(rel: str, fileobj, pipeline: Optional["UploadPipeline"] = None, shaper: Optional[Shaper] = None,
+               size: Optional[int] = None) -> Tuple["Backend", str, dict]:
+    """
+    Copia `fileobj` a `rel` en su backend (creando directorios padre) y aplica
+    chmod 0640. Si se pasa `pipeline`, ve cada chunk y su resultado (hashes, que
+    quedan en el cache de checksums, content-type, ...) se retorna y, con
+    UPLOAD_SIDECAR_SUFFIX, se guarda junto al archivo. Si el pipeline puede
+    rechazar el upload se escribe a un temporal que se renombra al aceptarlo. El
+    copiado respeta los límites de ancho de banda (`shaper`, por defecto uno para
+    la key del request en curso). Si se conoce `size` y supera
+    TRANSFER_MIN_BYTES, escribe un transfer worker.
+    """
+    backend = get_router().backend_for(rel)
+    target = backend.join(rel)
+    sidecar = get_settings().UPLOAD_SIDECAR_SUFFIX if pipeline is not None else ""
+    local = backend.local_path(rel)
+    if local is not None:
+        st, result = write_local(local, fileobj, pipeline, shaper)
+        cache_upload_hashes(backend, rel, st, result)
+        index_written(rel, st)
+        if sidecar:
+            with open(local + sidecar, "wb") as f:
+                f.write(json_dumps(result))
+            index_written(rel + sidecar, paramiko.SFTPAttributes.from_stat(os.stat(local + sidecar)))
+        result["etag"] = file_etag(st.st_size, st.st_mtime)
+        return backend, target, result
+    with backend.session() as sftp:
+        remote_dir = posixpath.dirname(target)
+        mkdirs_sftp(sftp, remote_dir)
+
+        # Evita sobreescribir un directorio por error
+        try:
+            if is_dir(sftp, target):
+                raise HTTPException(400, "remote_path apunta a un directorio; usa un nombre de archivo")
+        except FileNotFoundError:
+            pass
+
+        dest = staging_path(target) if pipeline is not None and pipeline.rejects else target
+        transfers = get_transfer_pool() if backend.offloadable else None
+        dst = None
+        try:
+            if transfers is not None and size is not None and size >= get_settings().TRANSFER_MIN_BYTES:
+                dst = transfers.open_write(backend, dest)
+            # El pipeline corre en el thread que lee el body, mientras este escribe
+            with dst or sftp.open(dest, "wb") as dst, (shaper or Shaper()) as shaper, \
+                    body_chunks(fileobj, 1024 * 1024, pipeline.update if pipeline is not None else None) as chunks:
+                for chunk in chunks:
+                    shaper.throttle(len(chunk))
+                    dst.write(chunk)
+            result = pipeline.finish() if pipeline is not None else {}
+            sftp.chmod(dest, 0o640)
+            if dest != target:
+                replace_file(sftp, dest, target)
+        except BaseException:
+            if dest != target:
+                try:
+                    sftp.remove(dest)
+                except OSError:
+                    pass
+            raise
+        st = sftp.stat(target) if pipeline is not None or get_index() is not None else None
+        cache_upload_hashes(backend, rel, st, result)
+        if sidecar:
+            with sftp.open(target + sidecar, "wb") as f:
+                f.write(json_dumps(result))
+            if get_index() is not None:
+                index_written(rel + sidecar, sftp.stat(target + sidecar))
+            else:
+                metadata_cache().invalidate(rel + sidecar)
+    if st is not None:
+        index_written(rel, st)
+        result["etag"] = file_etag(st.st_size, st.st_mtime)
+    else:
+        metadata_cache().invalidate(rel)
+    return backend, target, result
+
+def cache_upload_hashes(backend: "Backend", rel: str, st, result: dict):
+    """Los hashes calculados al subir quedan en el cache de checksums (clave: tamaño y mtime)."""
+    for algorithm, digest in result.get("hashes", {}).items():
+        _checksum_cache.set((backend.name, rel, st.st_size, st.st_mtime, algorithm), digest)
+
+def make_dirs(rel: str):
+    """mkdir -p de `rel` en todos los backends que lo necesitan."""
+    def mkdir_one(backend):
+        with backend.session() as sftp:
+            mkdirs_sftp(sftp, backend.join(rel))
+
+    fan_out(get_router().backends_for_dir(rel), mkdir_one)
+    index_written(rel, None)
+
+def remove_path(rel: str, recursive_dir: bool = False) -> bool:
+    """Elimina un archivo, o un directorio completo si `recursive_dir`. Retorna False si no existía."""
+    router = get_router()
+    if not recursive_dir:
+        backend = router.backend_for(rel)
+        try:
+            with backend.session() as sftp:
+                sftp.remove(backend.join(rel))
+        except FileNotFoundError:
+            return False
+        index_removed(rel)
+        return True
+
+    def remove_one(backend):
+        with backend.session() as sftp:
+            try:
+                rmtree_sftp(sftp, backend.join(rel), backend.base_dir)
+                return True
+            except FileNotFoundError:
+                return False
+
+    removed = any(fan_out(router.backends_for_dir(rel), remove_one))
+    if removed:
+        index_removed(rel)
+    return removed
+
+class HealthChecker:
+    """Thread que revisa periódicamente cada backend con un `stat` de su base_dir."""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.interval <= 0:
+            return
+        self._thread = threading.Thread(target=self._run, name="sftp-health", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            for backend in list(get_router().backends.values()):
+                backend.check_health()
+            self._stop.wait(self.interval)
+
+# ------------- Espejo local -------------
+# Con `local_dir` el backend tiene el mismo contenido montado en este host: las
+# transferencias van directo al disco. Listados, stats y borrados siguen por SFTP.
+LOCAL_COPY_CHUNK = 8 * 1024 * 1024
+
+def _disk_fileno(fileobj) -> Optional[int]:
+    """Descriptor de `fileobj` si está respaldado por un archivo en disco (no en memoria)."""
+    if isinstance(fileobj, tempfile.SpooledTemporaryFile) and not fileobj._rolled:
+        return None
+    try:
+        return fileobj.fileno()
+    except (AttributeError, OSError):
+        return None
+
+def write_local(path: str, fileobj, pipeline: Optional["UploadPipeline"] = None,
+                shaper: Optional[Shaper] = None) -> Tuple[paramiko.SFTPAttributes, dict]:
+    """
+    Escribe `fileobj` en el montaje local (creando directorios padre) con chmod 0640.
+    Si el origen es un archivo en disco (un UploadFile grande ya volcado a disco) y no
+    hay pipeline, copia con copy_file_range sin pasar los bytes por Python; si no, con
+    escrituras de 1 MiB. Retorna el stat en formato SFTP para el índice y los cachés,
+    y el resultado del pipeline.
+    """
+    if os.path.isdir(path):
+        raise HTTPException(400, "remote_path apunta a un directorio; usa un nombre de archivo")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    dest = staging_path(path) if pipeline is not None and pipeline.rejects else path
+    try:
+        result = _copy_local(dest, fileobj, pipeline, shaper)
+        os.chmod(dest, 0o640)
+        if dest != path:
+            os.replace(dest, path)
+    except BaseException:
+        if dest != path and os.path.exists(dest):
+            os.remove(dest)
+        raise
+    return paramiko.SFTPAttributes.from_stat(os.stat(path)), result
+
+def _copy_local(path: str, fileobj, pipeline: Optional["UploadPipeline"], shaper: Optional[Shaper]) -> dict:
+    # Si ninguna etapa necesita ver todos los bytes, el pipeline recibe al final la cabecera y el tamaño
+    direct = pipeline is None or not pipeline.streaming
+    fd = src = _disk_fileno(fileobj) if direct and hasattr(os, "copy_file_range") else None
+    start = offset = fileobj.tell() if fd is not None else 0
+    with open(path, "wb") as dst, (shaper or Shaper()) as shaper:
+        if src is not None:
+            try:
+                while True:
+                    copied = os.copy_file_range(src, dst.fileno(), LOCAL_COPY_CHUNK, offset_src=offset)
+                    if not copied:
+                        break
+                    offset += copied
+                    shaper.throttle(copied)
+                metrics.incr("local.copy_file_range")
+            except OSError:
+                # Filesystems sin soporte (EXDEV, EINVAL...): seguir con read/write desde donde quedó
+                fileobj.seek(offset)
+                src = None
+        if src is None:
+            while True:
+                chunk = fileobj.read(1024 * 1024)
+                if not chunk:
+                    break
+                if pipeline is not None and fd is None:
+                    pipeline.update(chunk)
+                offset += len(chunk)
+                shaper.throttle(len(chunk))
+                dst.write(chunk)
+    if pipeline is None:
+        return {}
+    if fd is not None:
+        pipeline.copied(os.pread(fd, SNIFF_BYTES, start), offset - start)
+    return pipeline.finish()
+
+def local_download(path: str, filename: str, accept_encoding: Optional[str]) -> Response:
+    """
+    /download desde el montaje local. Sin compresión ni límites de ancho de banda
+    responde con FileResponse (Range, ETag; zero-copy con servidores que ofrecen la
+    extensión ASGI `http.response.pathsend`); si no, pasa por el mismo pipeline de streaming.
+    """
+    settings = get_settings()
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        raise HTTPException(404, "No existe")
+    if pystat.S_ISDIR(st.st_mode):
+        raise HTTPException(400, "Es un directorio")
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+    encoding = negotiate_encoding(accept_encoding) if compressible(filename) else None
+    if encoding and st.st_size < settings.COMPRESSION_MIN_BYTES:
+        encoding = None
+    shaper = Shaper()
+    if shaper.progress is not None:
+        shaper.progress.total = st.st_size
+    # FileResponse no pasa por Python: con progreso registrado se usa el stream
+    if encoding is None and not shaper.enabled and shaper.progress is None:
+        metrics.incr("local.file_responses")
+        response = FileResponse(path, media_type="application/octet-stream", headers=headers, stat_result=st)
+        response.chunk_size = settings.DOWNLOAD_CHUNK_SIZE
+        return response
+    f = open(path, "rb")
+    body = SharedStream(f, settings.DOWNLOAD_CHUNK_SIZE, on_close=f.close).subscribe()
+    if encoding:
+        headers.update({"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+        body = compressed(body, encoding)
+    return TransferResponse(shaped(body, shaper), media_type="application/octet-stream", headers=headers)
+
+# ------------- Transfer workers -------------
+# Protocolo por Pipe (un mensaje = send_bytes, primer byte = tipo):
+#   S: archivo abierto   D<datos>: chunk   Z: fin   O<json>: upload ok   E<json>: error
+# El job en sí (op, config del nodo, path, chunk_size) viaja con send().
+
+def _worker_error(exc: BaseException) -> bytes:
+    kind = "not_found" if isinstance(exc, FileNotFoundError) else \
+        "permission" if isinstance(exc, PermissionError) else "error"
+    return b"E" + json.dumps({"kind": kind, "message": str(exc) or type(exc).__name__}).encode()
+
+def _raise_worker_error(payload: bytes):
+    error = json.loads(payload)
+    exc_type = {"not_found": FileNotFoundError, "permission": PermissionError}.get(error["kind"], IOError)
+    raise exc_type(error["message"])
+
+def transfer_worker_main(conn, clients: Optional[dict] = None):
+    """
+    Loop de un transfer worker: atiende jobs de a uno con sus propias conexiones
+    SFTP (una por host/usuario, reutilizadas entre jobs). Corre en un proceso
+    aparte; en los tests, en un thread.
+    """
+    clients = {} if clients is None else clients
+    while True:
+        try:
+            job = conn.recv()
+        except (EOFError, OSError):
+            break
+        if job is None:
+            break
+        if job == ("cancel",):
+            continue  # cancelación que llegó cuando el job ya había terminado
+        op, config, path, chunk_size = job
+        key = (config["host"], config["port"], config["user"])
+        try:
+            sftp = clients.get(key)
+            if sftp is None or not _client_alive(sftp):
+                sftp = clients[key] = storage_connect(BackendConfig(**config))
+            if op == "download":
+                _worker_download(conn, sftp, path, chunk_size)
+            else:
+                _worker_upload(conn, sftp, path)
+        except (EOFError, BrokenPipeError):
+            break  # el proceso API cerró el pipe
+        except Exception as exc:
+            clients.pop(key, None)
+            conn.send_bytes(_worker_error(exc))
+    for sftp in clients.values():
+        try:
+            sftp.close()
+        except Exception:
+            pass
+
+def _worker_download(conn, sftp, path: str, chunk_size: int):
+    try:
+        f = sftp.open(path, "rb")
+    except Exception as exc:
+        conn.send_bytes(_worker_error(exc))
+        return
+    with f:
+        if hasattr(f, "prefetch"):
+            f.prefetch(sftp.stat(path).st_size)  # lecturas pipelineadas: no espera cada round-trip
+        conn.send_bytes(b"S")
+        try:
+            while True:
+                if conn.poll():  # cancelación: el cliente dejó de leer
+                    conn.recv()
+                    break
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                conn.send_bytes(b"D" + data)
+        except (EOFError, BrokenPipeError):
+            raise
+        except Exception as exc:
+            conn.send_bytes(_worker_error(exc))
+            return
+    conn.send_bytes(b"Z")
+
+def _worker_upload(conn, sftp, path: str):
+    try:
+        f = sftp.open(path, "wb")
+    except Exception as exc:
+        conn.send_bytes(_worker_error(exc))  # el proceso API espera la "S" antes de mandar datos
+        return
+    conn.send_bytes(b"S")
+    error = None
+    with f:
+        if hasattr(f, "set_pipelined"):
+            f.set_pipelined(True)
+        while True:
+            message = conn.recv_bytes()
+            if message[:1] == b"Z":
+                break
+            if error is None:
+                try:
+                    f.write(message[1:])
+                except Exception as exc:
+                    error = exc
+    if error is not None:
+        conn.send_bytes(_worker_error(error))
+        return
+    st = sftp.stat(path)
+    conn.send_bytes(b"O" + json.dumps({"size": st.st_size, "mtime": st.st_mtime}).encode())
+
+class _TransferWorker:
+    def __init__(self, conn, runner):
+        self.conn = conn
+        self.runner = runner  # Process (o Thread en los tests)
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except (OSError, ValueError):
+            pass
+        self.conn.close()
+        self.runner.join(timeout=5)
+        if hasattr(self.runner, "kill") and self.runner.is_alive():
+            self.runner.kill()
+
+def spawn_transfer_worker() -> _TransferWorker:
+    # spawn y no fork: el proceso API tiene threads y transports Paramiko abiertos
+    ctx = multiprocessing.get_context("spawn")
+    parent, child = ctx.Pipe()
+    process = ctx.Process(target=transfer_worker_main, args=(child,), name="sftp-transfer", daemon=True)
+    process.start()
+    child.close()
+    return _TransferWorker(parent, process)
+
+class _WorkerReader:
+    """Archivo de solo lectura cuyos datos manda un transfer worker (fuente de SharedStream)."""
+
+    def __init__(self, pool: "TransferPool", worker: _TransferWorker):
+        self._pool = pool
+        self._worker = worker
+        self._done = False
+
+    def read(self, size: int = -1) -> bytes:
+        if self._done:
+            return b""
+        try:
+            message = self._worker.conn.recv_bytes()
+        except (EOFError, OSError) as exc:
+            self._finish(broken=True)
+            raise ConnectionError("El transfer worker terminó inesperadamente") from exc
+        tag = message[:1]
+        if tag == b"D":
+            return message[1:]
+        self._finish()
+        if tag == b"E":
+            _raise_worker_error(message[1:])
+        return b""
+
+    def close(self):
+        if self._done:
+            return
+        try:
+            # Cancelar y descartar lo que el worker ya haya mandado hasta su "Z"/"E"
+            self._worker.conn.send(("cancel",))
+            while self._worker.conn.recv_bytes()[:1] not in (b"Z", b"E"):
+                pass
+        except (EOFError, OSError):
+            self._finish(broken=True)
+            return
+        self._finish()
+
+    def _finish(self, broken: bool = False):
+        if not self._done:
+            self._done = True
+            self._pool.release(self._worker, broken)
+
+class _WorkerWriter:
+    """Archivo de solo escritura que un transfer worker vuelca al servidor SFTP."""
+
+    def __init__(self, pool: "TransferPool", worker: _TransferWorker):
+        self._pool = pool
+        self._worker = worker
+
+    def write(self, data: bytes):
+        self._worker.conn.send_bytes(b"D" + bytes(data))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            self._worker.conn.send_bytes(b"Z")
+            reply = self._worker.conn.recv_bytes()
+        except (EOFError, OSError) as err:
+            self._pool.release(self._worker, broken=True)
+            if exc is None:
+                raise ConnectionError("El transfer worker terminó inesperadamente") from err
+            return False
+        self._pool.release(self._worker)
+        if reply[:1] == b"E" and exc is None:
+            _raise_worker_error(reply[1:])
+        return False
+
+class TransferPool:
+    """
+    Procesos dedicados a transferencias grandes, cada uno con sus propias
+    conexiones SFTP: el cifrado y el framing de Paramiko corren fuera del
+    proceso API, que solo mueve bytes por un Pipe. Si no hay un worker libre
+    la transferencia se hace en el proceso API como siempre.
+    """
+
+    def __init__(self, size: int, start_worker=spawn_transfer_worker):
+        self.size = size
+        self._start_worker = start_worker
+        self._idle = queue.SimpleQueue()
+        for _ in range(size):
+            self._idle.put(start_worker())
+
+    def _acquire(self) -> Optional[_TransferWorker]:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            metrics.incr("transfers.no_worker")
+            return None
+
+    def release(self, worker: _TransferWorker, broken: bool = False):
+        if broken:
+            metrics.incr("transfers.worker_restarts")
+            worker.stop()
+            worker = self._start_worker()
+        self._idle.put(worker)
+
+    def _start_job(self, op: str, node: "Node", path: str, chunk_size: int = 0) -> Optional[_TransferWorker]:
+        """Entrega el job a un worker libre y espera a que abra el archivo; None si no hay worker."""
+        worker = self._acquire()
+        if worker is None:
+            return None
+        try:
+            worker.conn.send((op, node.config.model_dump(), path, chunk_size))
+            first = worker.conn.recv_bytes()
+        except (EOFError, OSError):
+            self.release(worker, broken=True)
+            return None
+        if first[:1] != b"S":
+            self.release(worker)
+            if json.loads(first[1:])["kind"] == "error":
+                # Falla de conexión u otra: el proceso API lo reintenta con sus pools y breakers
+                metrics.incr("transfers.worker_errors")
+                return None
+            _raise_worker_error(first[1:])
+        metrics.incr(f"transfers.offloaded.{op}")
+        return worker
+
+    def open_read(self, backend: "Backend", rel: str, chunk_size: int):
+        """Como Backend.open_read pero leído por un worker; None si no hay worker libre."""
+        node = backend.read_node()
+        worker = self._start_job("download", node, node.join(rel), chunk_size)
+        if worker is None:
+            return None
+        reader = _WorkerReader(self, worker)
+        return reader, reader.close
+
+    def open_write(self, backend: "Backend", target: str) -> Optional[_WorkerWriter]:
+        """Writer para `target` (path absoluto en el primario); None si no hay worker libre."""
+        worker = self._start_job("upload", backend.primary, target)
+        return _WorkerWriter(self, worker) if worker is not None else None
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().stop()
+            except queue.Empty:
+                break
+
+_transfer_pool = None
+
+def get_transfer_pool() -> Optional[TransferPool]:
+    return _transfer_pool
+
+def start_transfer_pool(start_worker=spawn_transfer_worker):
+    global _transfer_pool
+    stop_transfer_pool()
+    workers = transfer_worker_count(get_settings())
+    if workers > 0:
+        _transfer_pool = TransferPool(workers, start_worker)
+
+def stop_transfer_pool():
+    global _transfer_pool
+    pool, _transfer_pool = _transfer_pool, None
+    if pool is not None:
+        pool.close()
+
+# ------------- Checksums -------------
+CHECKSUM_ALGORITHMS = ("md5", "sha1", "sha256", "sha512")
+
+class LRUCache:
+    """Cache LRU acotado, seguro entre threads."""
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            value = self._data.get(key)
+            if value is not None:
+                self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_checksum_cache = LRUCache(10000)
+# Métodos server-side que un host rechazó de forma definitiva: ((host, port), método) -> vence.
+# Solo un "no soportado" explícito los marca, y por un tiempo: el servidor puede cambiar
+CHECKSUM_UNSUPPORTED_TTL = 3600.0
+_checksum_unsupported = {}
+_checksum_unsupported_lock = threading.Lock()
+
+class ChecksumUnsupported(Exception):
+    """El servidor respondió que no ofrece el método (no una falla transitoria)."""
+
+def _checksum_method_available(host_key, method: str) -> bool:
+    with _checksum_unsupported_lock:
+        expires = _checksum_unsupported.get((host_key, method))
+        if expires is not None and expires <= time.monotonic():
+            del _checksum_unsupported[(host_key, method)]
+            expires = None
+        return expires is None
+
+def _mark_checksum_unsupported(host_key, method: str):
+    metrics.incr(f"checksum.unsupported.{method}")
+    with _checksum_unsupported_lock:
+        _checksum_unsupported[(host_key, method)] = time.monotonic() + CHECKSUM_UNSUPPORTED_TTL
+
+def validate_algorithm(algorithm: str) -> str:
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise HTTPException(400, f"Algoritmo no soportado; usa uno de: {', '.join(CHECKSUM_ALGORITHMS)}")
+    return algorithm
+
+def _transport_of(sftp):
+    get_channel = getattr(sftp, "get_channel", None)
+    chan = get_channel() if get_channel else None
+    return chan.get_transport() if chan is not None else None
+
+def _checksum_check_file(sftp, path: str, algorithm: str) -> Optional[str]:
+    """Extensión SFTP `check-file`: el servidor calcula el hash sin transferir datos."""
+    with sftp.open(path, "rb") as f:
+        check = getattr(f, "check", None)
+        if check is None:
+            raise ChecksumUnsupported("el cliente no implementa check-file")
+        try:
+            return check(algorithm).hex()
+        except IOError as exc:
+            # SSH_FX_OP_UNSUPPORTED llega como IOError sin errno ("Operation unsupported")
+            if exc.errno is None and "unsupported" in str(exc).lower():
+                raise ChecksumUnsupported(str(exc)) from exc
+            raise
+
+def _checksum_exec(sftp, path: str, algorithm: str, timeout: float) -> Optional[str]:
+    """`<algo>sum` remoto por un canal exec sobre el mismo transporte SSH."""
+    transport = _transport_of(sftp)
+    if transport is None:
+        return None
+    try:
+        chan = transport.open_session(timeout=timeout)
+    except paramiko.ChannelException as exc:
+        raise ChecksumUnsupported("el servidor no admite canales exec") from exc
+    try:
+        chan.settimeout(timeout)
+        chan.exec_command(f"{algorithm}sum -- {shlex.quote(path)}")
+        output = b""
+        while True:
+            data = chan.recv(4096)
+            if not data:
+                break
+            output += data
+        status = chan.recv_exit_status()
+        if status in (126, 127):  # `<algo>sum` no existe o no es ejecutable
+            raise ChecksumUnsupported(f"{algorithm}sum no disponible (exit {status})")
+        if status != 0:
+            return None
+    finally:
+        chan.close()
+    digest = output.split(b" ", 1)[0].decode("ascii", "replace").lstrip("\\")
+    expected = hashlib.new(algorithm).digest_size * 2
+    return digest.lower() if len(digest) == expected else None
+
+def _checksum_stream(sftp, path: str, algorithm: str, size: int, chunk_size: int) -> str:
+    """Fallback: lee el archivo con lecturas pipelineadas (prefetch) y lo hashea aquí."""
+    hasher = hashlib.new(algorithm)
+    with sftp.open(path, "rb") as f:
+        prefetch = getattr(f, "prefetch", None)
+        if prefetch is not None:
+            prefetch(size)
+        while True:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+def remote_checksum(sftp, path: str, algorithm: str, size: int, stream: bool = True) -> Tuple[Optional[str], str]:
+    """
+    Retorna `(digest_hex, método)` probando check-file, exec remoto y por último
+    streaming. Con `stream=False` no lee el archivo: `(None, "none")` si el servidor no puede.
+    """
+    settings = get_settings()
+    transport = _transport_of(sftp)
+    host_key = transport.getpeername() if transport is not None else None
+    # Un error transitorio (permisos, timeout, canal caído) solo salta al siguiente método
+    if _checksum_method_available(host_key, "check-file"):
+        try:
+            digest = _checksum_check_file(sftp, path, algorithm)
+            if digest:
+                return digest, "check-file"
+        except FileNotFoundError:
+            raise
+        except ChecksumUnsupported:
+            _mark_checksum_unsupported(host_key, "check-file")
+        except (IOError, paramiko.SSHException):
+            pass
+    if settings.CHECKSUM_REMOTE_EXEC and _checksum_method_available(host_key, "exec"):
+        try:
+            digest = _checksum_exec(sftp, path, algorithm, settings.CHECKSUM_EXEC_TIMEOUT)
+            if digest:
+                return digest, "exec"
+        except ChecksumUnsupported:
+            _mark_checksum_unsupported(host_key, "exec")
+        except (IOError, paramiko.SSHException, socket.timeout):
+            pass
+    if not stream:
+        return None, "none"
+    return _checksum_stream(sftp, path, algorithm, size, settings.DOWNLOAD_CHUNK_SIZE), "stream"
+
+# ------------- Pipeline de upload -------------
+# /upload pasa cada chunk que escribe al backend por una serie de etapas (hashes,
+# sniffing del tipo, límite de tamaño, antivirus), así los resultados salen en la
+# respuesta sin otra pasada sobre los datos ni lecturas SFTP extra.
+class UploadStage:
+    """Etapa del pipeline: ve cada chunk en orden y aporta campos al resultado."""
+
+    # Puede rechazar el upload: el archivo se escribe a un temporal y se renombra al aceptarlo
+    rejects = False
+    # Necesita ver todos los bytes; si ninguna etapa lo necesita, el espejo local copia con copy_file_range
+    streaming = True
+
+    def update(self, chunk: bytes):
+        """`chunk` puede ser una memoryview sobre un buffer que se reusa: copiarlo si hay que retenerlo."""
+
+    def copied(self, head: bytes, size: int):
+        """En lugar de `update` cuando los bytes no pasaron por Python (solo si `streaming` es False)."""
+
+    def finish(self) -> dict:
+        return {}
+
+    def abort(self):
+        pass
+
+class SizeStage(UploadStage):
+    streaming = False
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.rejects = limit > 0
+        self.size = 0
+
+    def update(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.limit and self.size > self.limit:
+            raise HTTPException(413, f"El archivo supera el máximo de {self.limit} bytes")
+
+    def copied(self, head: bytes, size: int):
+        self.size = size
+        self.update(b"")
+
+    def finish(self) -> dict:
+        return {"size": self.size}
+
+class HashStage(UploadStage):
+    """Hashes del contenido; con `expected` ({algoritmo: hex}) rechaza el upload si no coinciden."""
+
+    def __init__(self, algorithms: List[str], expected: Optional[Dict[str, str]] = None):
+        self.expected = expected or {}
+        self.rejects = bool(self.expected)
+        self.hashers = {algorithm: hashlib.new(algorithm) for algorithm in dict.fromkeys([*algorithms, *self.expected])}
+
+    def update(self, chunk: bytes):
+        for hasher in self.hashers.values():
+            hasher.update(chunk)
+
+    def finish(self) -> dict:
+        hashes = {algorithm: hasher.hexdigest() for algorithm, hasher in self.hashers.items()}
+        for algorithm, digest in self.expected.items():
+            if hashes[algorithm] != digest:
+                metrics.incr("upload.hash_mismatch")
+                raise HTTPException(422, f"El contenido no coincide con content_hash ({algorithm})")
+        return {"hashes": hashes}
+
+# (offset, bytes, content-type); el primero que coincide gana
+MAGIC_SIGNATURES = [
+    (0, b"%PDF-", "application/pdf"),
+    (0, b"\x89PNG\r\n\x1a\n", "image/png"),
+    (0, b"\xff\xd8\xff", "image/jpeg"),
+    (0, b"GIF87a", "image/gif"),
+    (0, b"GIF89a", "image/gif"),
+    (8, b"WEBP", "image/webp"),
+    (8, b"WAVE", "audio/wav"),
+    (0, b"ID3", "audio/mpeg"),
+    (0, b"OggS", "audio/ogg"),
+    (0, b"fLaC", "audio/flac"),
+    (4, b"ftyp", "video/mp4"),
+    (0, b"\x1a\x45\xdf\xa3", "video/webm"),
+    (0, b"PK\x03\x04", "application/zip"),
+    (0, b"PK\x05\x06", "application/zip"),
+    (0, b"\x1f\x8b", "application/gzip"),
+    (0, b"BZh", "application/x-bzip2"),
+    (0, b"\xfd7zXZ\x00", "application/x-xz"),
+    (0, b"\x28\xb5\x2f\xfd", "application/zstd"),
+    (0, b"7z\xbc\xaf\x27\x1c", "application/x-7z-compressed"),
+    (257, b"ustar", "application/x-tar"),
+    (0, b"SQLite format 3\x00", "application/vnd.sqlite3"),
+    (0, b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1", "application/x-ole-storage"),
+    (0, b"\x7fELF", "application/x-executable"),
+    (0, b"MZ", "application/x-msdownload"),
+    (0, b"{\\rtf", "application/rtf"),
+    (0, b"%!PS", "application/postscript"),
+]
+SNIFF_BYTES = 4096
+# Contenedores genéricos (docx/xlsx/epub/jar son zip, doc/xls son OLE): la extensión precisa el tipo
+_CONTAINER_TYPES = {"application/zip", "application/x-ole-storage", "video/mp4"}
+_TEXT_TYPES = ("text/", "application/json", "application/xml", "application/javascript",
+               "application/x-yaml", "application/x-ndjson", "image/svg+xml")
+
+def sniff_content_type(head: bytes, filename: str) -> str:
+    """Content-type por magic bytes de los primeros SNIFF_BYTES; la extensión solo desempata."""
+    guessed = mimetypes.guess_type(filename)[0]
+    for offset, magic, content_type in MAGIC_SIGNATURES:
+        if head[offset:offset + len(magic)] == magic:
+            if content_type in _CONTAINER_TYPES and guessed and guessed != content_type:
+                return guessed
+            return content_type
+    if not head or b"\0" in head:
+        return "application/octet-stream"
+    try:
+        head.decode("utf-8")
+    except UnicodeDecodeError as exc:
+        # Un carácter multibyte cortado al final de la muestra no descarta el texto
+        if exc.start < len(head) - 3:
+            return "application/octet-stream"
+    if guessed and guessed.startswith(_TEXT_TYPES):
+        return guessed
+    return "text/plain"
+
+class SniffStage(UploadStage):
+    streaming = False
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.head = bytearray()
+
+    def update(self, chunk: bytes):
+        if len(self.head) < SNIFF_BYTES:
+            self.head += chunk[:SNIFF_BYTES - len(self.head)]
+
+    def copied(self, head: bytes, size: int):
+        self.head = bytearray(head[:SNIFF_BYTES])
+
+    def finish(self) -> dict:
+        return {"content_type": sniff_content_type(bytes(self.head), self.filename)}
+
+class ScanStage(UploadStage):
+    """
+    Antivirus externo (UPLOAD_SCAN_COMMAND) que recibe el archivo por stdin mientras
+    se sube. Convención de clamscan/clamdscan: exit 0 = limpio, 1 = infectado, otro = error.
+    """
+
+    rejects = True
+    MAX_OUTPUT = 64 * 1024
+
+    def __init__(self, command: str, timeout: float):
+        self.timeout = timeout
+        self.process = subprocess.Popen(
+            shlex.split(command), stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        self.output = bytearray()
+        self.closed = False
+        # stdout se lee aparte: un escáner que escribe mucho no debe bloquear al upload
+        self._reader = threading.Thread(target=self._drain, name="upload-scan", daemon=True)
+        self._reader.start()
+
+    def _drain(self):
+        for line in self.process.stdout:
+            if len(self.output) < self.MAX_OUTPUT:
+                self.output += line
+
+    def update(self, chunk: bytes):
+        if self.closed:
+            return
+        try:
+            self.process.stdin.write(chunk)
+        except (BrokenPipeError, ValueError):
+            self.closed = True  # el escáner ya decidió; el exit code da el veredicto
+
+    def finish(self) -> dict:
+        try:
+            self.process.stdin.close()
+        except BrokenPipeError:
+            pass
+        try:
+            code = self.process.wait(self.timeout)
+        except subprocess.TimeoutExpired:
+            self.abort()
+            metrics.incr("upload.scan.errors")
+            raise HTTPException(504, "El antivirus no respondió a tiempo")
+        self._reader.join(timeout=5)
+        lines = [line.strip() for line in self.output.decode(errors="replace").splitlines() if line.strip()]
+        detail = lines[-1] if lines else ""
+        if code == 0:
+            metrics.incr("upload.scan.clean")
+            return {"scan": "clean"}
+        if code == 1:
+            metrics.incr("upload.scan.rejected")
+            raise HTTPException(422, f"Archivo rechazado por el antivirus: {detail}")
+        metrics.incr("upload.scan.errors")
+        raise HTTPException(502, f"Error del antivirus (exit {code}): {detail}")
+
+    def abort(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+
+class UploadPipeline:
+    def __init__(self, stages: List[UploadStage]):
+        self.stages = stages
+        self.rejects = any(stage.rejects for stage in stages)
+        self.streaming = any(stage.streaming for stage in stages)
+
+    def update(self, chunk: bytes):
+        for stage in self.stages:
+            stage.update(chunk)
+
+    def copied(self, head: bytes, size: int):
+        for stage in self.stages:
+            stage.copied(head, size)
+
+    def finish(self) -> dict:
+        result = {}
+        for stage in self.stages:
+            result.update(stage.finish())
+        return result
+
+    def abort(self):
+        for stage in self.stages:
+            stage.abort()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.abort()
+        return False
+
+# Fábricas extra `(filename) -> UploadStage`, registradas por código (p. ej. un validador propio)
+UPLOAD_STAGES: List = []
+
+def upload_pipeline(filename: str, algorithms: List[str] = (), size: Optional[int] = None,
+                    expected: Optional[Dict[str, str]] = None) -> UploadPipeline:
+    """
+    Arma el pipeline de un upload; con `size` conocido, el límite se valida antes de
+    leer nada. `expected` ({algoritmo: hex}) verifica el contenido contra el hash del cliente.
+    """
+    settings = get_settings()
+    if settings.UPLOAD_MAX_BYTES and size is not None and size > settings.UPLOAD_MAX_BYTES:
+        raise HTTPException(413, f"El archivo supera el máximo de {settings.UPLOAD_MAX_BYTES} bytes")
+    stages = [SizeStage(settings.UPLOAD_MAX_BYTES)]
+    hashes = list(dict.fromkeys([*algorithms, *(validate_algorithm(a) for a in settings.UPLOAD_HASHES)]))
+    if hashes or expected:
+        stages.append(HashStage(hashes, expected))
+    if settings.UPLOAD_SNIFF:
+        stages.append(SniffStage(filename))
+    stages += [factory(filename) for factory in UPLOAD_STAGES]
+    if settings.UPLOAD_SCAN_COMMAND:
+        stages.append(ScanStage(settings.UPLOAD_SCAN_COMMAND, settings.UPLOAD_SCAN_TIMEOUT))
+    return UploadPipeline(stages)
+
+def staging_path(path: str) -> str:
+    """Temporal oculto junto a `path` para uploads que todavía pueden ser rechazados."""
+    return posixpath.join(posixpath.dirname(path), f".{posixpath.basename(path)}.upload-{os.urandom(6).hex()}")
+
+def replace_file(sftp: StorageClient, src: str, dst: str):
+    """Renombra `src` sobre `dst` (SFTPv3 no pisa un destino existente: posix-rename o borrar antes)."""
+    posix_rename = getattr(sftp, "posix_rename", None)
+    if posix_rename is not None:
+        try:
+            posix_rename(src, dst)
+            return
+        except IOError:
+            pass  # servidor sin la extensión posix-rename@openssh.com
+    try:
+        sftp.rename(src, dst)
+    except OSError:
+        try:
+            sftp.remove(dst)
+        except FileNotFoundError:
+            pass
+        sftp.rename(src, dst)
+
+# ------------- Uploads condicionales e idempotentes -------------
+# If-Match / If-None-Match se evalúan contra un stat del primario (no de réplicas ni
+# del cache). Con content_hash, si el archivo remoto ya tiene ese tamaño y ese hash
+# (cacheado por tamaño y mtime, o calculado por el servidor) no se transfiere nada.
+# No hay lock sobre el servidor SFTP: un escritor ajeno a la API entre la evaluación
+# y el rename final no se detecta.
+def _etag_matches(header: str, etag: Optional[str]) -> bool:
+    if etag is None:
+        return False
+    if header.strip() == "*":
+        return True
+    # Comparación débil: W/"x" equivale a "x"
+    candidates = {tag.strip().removeprefix("W/") for tag in header.split(",")}
+    return etag in candidates
+
+def parse_content_hash(value: str) -> Tuple[str, str]:
+    """`algoritmo:hex` (p. ej. `sha256:9f86...`) -> (algoritmo, hex en minúsculas)."""
+    algorithm, sep, digest = value.partition(":")
+    algorithm = validate_algorithm(algorithm) if sep else ""
+    digest = digest.strip().lower()
+    if not algorithm or len(digest) != hashlib.new(algorithm).digest_size * 2 or not all(c in "0123456789abcdef" for c in digest):
+        raise HTTPException(400, "content_hash debe ser `algoritmo:hex`, p. ej. sha256:<64 hex>")
+    return algorithm, digest
+
+def check_upload_preconditions(rel: str, size: Optional[int], if_match: Optional[str], if_none_match: Optional[str],
+                               content_hash: Optional[Tuple[str, str]], algorithms: List[str] = ()) -> Optional[dict]:
+    """
+    412 si falla If-Match / If-None-Match. Si el archivo remoto ya tiene el contenido
+    de `content_hash` retorna el resultado del upload sin transferir (`skipped`), con
+    los hashes de `algorithms`; si alguno no se puede obtener sin leer el archivo, se sube.
+    """
+    if not (if_match or if_none_match or content_hash):
+        return None
+    settings = get_settings()
+    backend = get_router().backend_for(rel)
+    target = backend.join(rel)
+    with backend.session() as sftp:
+        try:
+            st = sftp.stat(target)
+        except FileNotFoundError:
+            st = None
+        if st is not None and pystat.S_ISDIR(st.st_mode):
+            raise HTTPException(400, "remote_path apunta a un directorio; usa un nombre de archivo")
+        etag = file_etag(st.st_size, st.st_mtime) if st is not None else None
+        if if_match and not _etag_matches(if_match, etag):
+            metrics.incr("upload.precondition_failed")
+            raise HTTPException(412, "If-Match no coincide con el archivo remoto")
+        if if_none_match and _etag_matches(if_none_match, etag):
+            metrics.incr("upload.precondition_failed")
+            raise HTTPException(412, "El archivo remoto ya existe" if if_none_match.strip() == "*" else "If-None-Match coincide con el archivo remoto")
+        if content_hash is None or st is None or (size is not None and st.st_size != size):
+            return None
+
+        def remote_digest(algorithm: str) -> Optional[str]:
+            key = (backend.name, rel, st.st_size, st.st_mtime, algorithm)
+            digest = _checksum_cache.get(key)
+            if digest is None and settings.UPLOAD_REMOTE_CHECKSUM:
+                digest, _ = remote_checksum(sftp, target, algorithm, st.st_size, stream=False)
+                if digest is not None:
+                    _checksum_cache.set(key, digest)
+            return digest
+
+        algorithm, digest = content_hash
+        if remote_digest(algorithm) != digest:
+            return None
+        hashes = {algorithm: digest}
+        for other in algorithms:
+            if other not in hashes:
+                hashes[other] = remote_digest(other)
+                if hashes[other] is None:
+                    return None
+    metrics.incr("upload.skipped")
+    return {"ok": True, "path": target, "skipped": True, "size": st.st_size, "hashes": hashes, "etag": etag}
+
+class IdempotencyStore:
+    """
+    Resultados de uploads por Idempotency-Key: un reintento recibe la respuesta
+    original sin tocar SFTP. Con METADATA_CACHE_SHARED se comparten entre workers;
+    la detección de un request todavía en curso es por proceso.
+    """
+
+    def __init__(self):
+        self._local = None
+        self._lock = threading.Lock()
+        self._inflight = set()
+
+    def _cache(self):
+        if get_settings().METADATA_CACHE_SHARED:
+            return metadata_cache()
+        if self._local is None:
+            self._local = MetadataCache()
+        return self._local
+
+    def begin(self, key: str, fingerprint: str) -> Optional[dict]:
+        """Resultado guardado para `key`, o None si hay que ejecutar el request (y se marca en curso)."""
+        stored = self._cache().get(("idempotency", key))
+        if stored is not None:
+            if stored["fingerprint"] != fingerprint:
+                raise HTTPException(422, "Idempotency-Key ya usada con otro request")
+            metrics.incr("idempotency.replays")
+            return stored["result"]
+        with self._lock:
+            if key in self._inflight:
+                raise HTTPException(409, "Hay un request en curso con esta Idempotency-Key")
+            self._inflight.add(key)
+        return None
+
+    def finish(self, key: str, fingerprint: str, result: Optional[dict]):
+        """Libera `key`; con `result` (request exitoso) lo guarda para los reintentos."""
+        if result is not None:
+            self._cache().set(("idempotency", key), {"fingerprint": fingerprint, "result": result},
+                              get_settings().IDEMPOTENCY_TTL)
+        with self._lock:
+            self._inflight.discard(key)
+
+    def reset(self):
+        if self._local is not None:
+            self._local.clear()
+        with self._lock:
+            self._inflight.clear()
+
+_idempotency = IdempotencyStore()
+
+def reset_idempotency():
+    _idempotency.reset()
+
+# ------------- Delta uploads -------------
+class DeltaBlock(BaseModel):
+    weak: int     # adler32 del bloque
+    strong: str   # hash fuerte (hex) del bloque
+
+class DeltaManifest(BaseModel):
+    """Firmas por bloque del archivo NUEVO, calculadas por el cliente."""
+    block_size: int
+    size: int
+    algorithm: str = "sha256"
+    blocks: List[DeltaBlock]
+
+def parse_delta_manifest(raw: str) -> DeltaManifest:
+    settings = get_settings()
+    try:
+        manifest = DeltaManifest.model_validate_json(raw)
+    except ValueError as exc:
+        raise HTTPException(400, f"Manifest inválido: {exc}")
+    manifest.algorithm = validate_algorithm(manifest.algorithm)
+    if not settings.DELTA_MIN_BLOCK_SIZE <= manifest.block_size <= settings.DELTA_MAX_BLOCK_SIZE:
+        raise HTTPException(400, f"block_size debe estar entre {settings.DELTA_MIN_BLOCK_SIZE} y {settings.DELTA_MAX_BLOCK_SIZE}")
+    expected = -(-manifest.size // manifest.block_size)
+    if manifest.size < 0 or len(manifest.blocks) != expected:
+        raise HTTPException(400, f"El manifest debe tener {expected} bloques para size={manifest.size}")
+    return manifest
+
+def block_length(manifest: DeltaManifest, index: int) -> int:
+    return min(manifest.block_size, manifest.size - index * manifest.block_size)
+
+def block_matches(data: bytes, block: DeltaBlock, algorithm: str) -> bool:
+    # adler32 descarta rápido los bloques distintos; el hash fuerte solo se calcula si coincide
+    return zlib.adler32(data) == block.weak and hashlib.new(algorithm, data).hexdigest() == block.strong
+
+def diff_blocks(sftp, path: str, manifest: DeltaManifest, remote_size: int) -> List[int]:
+    """Índices de bloques del manifest que difieren del archivo remoto (lectura pipelineada)."""
+    missing = []
+    with sftp.open(path, "rb") as f:
+        prefetch = getattr(f, "prefetch", None)
+        if prefetch is not None:
+            prefetch(remote_size)
+        for index, block in enumerate(manifest.blocks):
+            offset = index * manifest.block_size
+            if offset >= remote_size:
+                missing.extend(range(index, len(manifest.blocks)))
+                break
+            data = f.read(manifest.block_size)
+            if len(data) != block_length(manifest, index) or not block_matches(data, block, manifest.algorithm):
+                missing.append(index)
+    return missing
+
+def parse_block_indices(raw: str, manifest: DeltaManifest) -> List[int]:
+    try:
+        indices = [int(i) for i in json.loads(raw)]
+    except (ValueError, TypeError):
+        raise HTTPException(400, "blocks debe ser una lista JSON de índices")
+    if indices != sorted(set(indices)) or (indices and not 0 <= indices[0] <= indices[-1] < len(manifest.blocks)):
+        raise HTTPException(400, "blocks debe estar ordenado, sin repetidos y dentro del manifest")
+    return indices
+
+# ------------- Sync (mirror) -------------
+class SyncEntry(BaseModel):
+    path: str                     # relativo a `root`
+    size: int = 0
+    mtime: Optional[float] = None
+    hash: Optional[str] = None    # hex del algoritmo del request
+    is_dir: bool = False
+
+class SyncPlanRequest(BaseModel):
+    root: str = "/"
+    entries: List[SyncEntry]
+    delete: bool = True           # eliminar lo remoto que no está en el manifest
+    algorithm: str = "sha256"
+
+class SyncDelete(BaseModel):
+    path: str
+    is_dir: bool = False
+
+class SyncPlan(BaseModel):
+    root: str = "/"
+    deletes: List[SyncDelete] = []
+    mkdirs: List[str] = []
+    uploads: List[str] = []
+
+def sync_relpath(path: str) -> str:
+    """Normaliza un path del manifest ("a/b.txt"); rechaza rutas que salen de root."""
+    norm = posixpath.normpath("/" + path.strip("/"))
+    if norm == "/" or ".." in path.split("/"):
+        raise HTTPException(400, f"Path inválido en el manifest: {path!r}")
+    return norm.lstrip("/")
+
+def _ancestors(path: str):
+    """Directorios ancestros estrictos de "a/b/c" -> "a/b", "a"."""
+    while "/" in path:
+        path = path.rsplit("/", 1)[0]
+        yield path
+
+def _add_ancestors(path: str, into: set):
+    # Se detiene en el primer ancestro ya presente: con muchos archivos por
+    # directorio cada ancestro se recorre una sola vez.
+    for parent in _ancestors(path):
+        if parent in into:
+            return
+        into.add(parent)
+
+def walk_remote(root_rel: str, concurrency: int, on_dir=None, collect: bool = True) -> Dict[str, tuple]:
+    """
+    Recorre el árbol bajo `root_rel` listando directorios en paralelo.
+    Retorna {path relativo a root: (size, mtime, is_dir)}; vacío si root no existe.
+    `on_dir(path relativo, items)` se llama con el listado de cada directorio.
+    """
+    entries = {}
+    with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="sftp-walk") as pool:
+        pending = {pool.submit(list_directory, root_rel, False): ""}
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                prefix = pending.pop(future)
+                try:
+                    items = future.result()
+                except HTTPException as exc:
+                    if exc.status_code == 404:
+                        continue  # root inexistente o directorio borrado durante el recorrido
+                    raise
+                if on_dir is not None:
+                    on_dir(prefix, items)
+                for item in items:
+                    path = f"{prefix}/{item['name']}" if prefix else item["name"]
+                    if collect:
+                        entries[path] = (item["size"], item["mtime"], item["is_dir"])
+                    if item["is_dir"]:
+                        pending[pool.submit(list_directory, posixpath.join(root_rel, path), False)] = path
+    metrics.incr("sync.walked_entries", len(entries))
+    return entries
+
+def compute_sync_plan(root_rel: str, request: SyncPlanRequest, remote: Dict[str, tuple]) -> SyncPlan:
+    settings = get_settings()
+    router = get_router()
+    tolerance = settings.SYNC_MTIME_TOLERANCE
+    local_files, local_dirs = {}, set()
+    for entry in request.entries:
+        path = sync_relpath(entry.path)
+        if entry.is_dir:
+            local_dirs.add(path)
+        else:
+            local_files[path] = entry
+        _add_ancestors(path, local_dirs)
+
+    uploads, deletes, missing_dirs = [], {}, []
+    for path, entry in local_files.items():
+        current = remote.get(path)
+        if current is None:
+            uploads.append(path)
+            continue
+        size, mtime, remote_is_dir = current
+        if remote_is_dir:
+            deletes[path] = True
+            uploads.append(path)
+            continue
+        if entry.hash:
+            rel = posixpath.join(root_rel, path)
+            cached = _checksum_cache.get((router.backend_for(rel).name, rel, size, mtime, request.algorithm))
+            if cached is not None:
+                if cached != entry.hash.lower():
+                    uploads.append(path)
+                continue
+        if size != entry.size or (entry.mtime is not None and mtime is not None and entry.mtime > mtime + tolerance):
+            uploads.append(path)
+
+    for path in local_dirs:
+        current = remote.get(path)
+        if current is None:
+            missing_dirs.append(path)
+        elif not current[2]:
+            deletes[path] = False
+            missing_dirs.append(path)
+
+    if request.delete:
+        for path in sorted(remote):
+            if path in local_files or path in local_dirs or path in deletes:
+                continue
+            # Un ancestro ya se elimina completo: no hace falta listar sus hijos
+            if any(deletes.get(parent) for parent in _ancestors(path)):
+                continue
+            deletes[path] = remote[path][2]
+
+    # mkdir -p: basta con las hojas; los padres de cada upload los crea la subida
+    covered = set()
+    for path in uploads + missing_dirs:
+        _add_ancestors(path, covered)
+    mkdirs = sorted(set(missing_dirs) - covered)
+
+    return SyncPlan(
+        root=root_rel,
+        deletes=[SyncDelete(path=p, is_dir=d) for p, d in sorted(deletes.items())],
+        mkdirs=mkdirs,
+        uploads=sorted(uploads),
+    )
+
+# ------------- Índice de metadatos (SQLite) -------------
+class MetadataIndex:
+    """
+    Copia local de los metadatos del árbol bajo BASE_DIR (paths relativos,
+    "/a/b.txt"). La llena el crawler y la mantienen al día las escrituras
+    hechas por la API; `dirs.listed_at` indica cuándo se listó cada directorio.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY,
+            parent TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            mode INTEGER,
+            is_dir INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS entries_parent ON entries(parent);
+        CREATE INDEX IF NOT EXISTS entries_name ON entries(name);
+        CREATE INDEX IF NOT EXISTS entries_size ON entries(size);
+        CREATE INDEX IF NOT EXISTS entries_mtime ON entries(mtime);
+        CREATE TABLE IF NOT EXISTS dirs (
+            path TEXT PRIMARY KEY,
+            listed_at REAL,
+            mtime REAL
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            ts REAL NOT NULL,
+            op TEXT NOT NULL,
+            path TEXT NOT NULL,
+            size INTEGER,
+            mtime REAL,
+            is_dir INTEGER NOT NULL,
+            source TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value TEXT
+        );
+    """
+
+    def __init__(self, db_path: str, changes_retention: int = 100000):
+        self.db_path = db_path
+        self.changes_retention = changes_retention
+        self._lock = threading.Lock()
+        # Se notifica cada vez que se registran cambios (long-polling / SSE de /changes)
+        self.changed = threading.Condition()
+        self._async_waiters = set()  # (loop, asyncio.Event) de los streams SSE y long-polls en espera
+        self._db = sqlite3.connect(db_path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(self.SCHEMA)
+        self.last_crawl = None
+        self.last_incremental = None
+
+    @staticmethod
+    def _row(path: str, item: dict) -> tuple:
+        mode = int(item["mode"], 8) if isinstance(item.get("mode"), str) else item.get("mode")
+        return (path, posixpath.dirname(path), posixpath.basename(path), item["size"], item["mtime"], mode, int(item["is_dir"]))
+
+    @staticmethod
+    def _descendants(path: str) -> tuple:
+        # Rango de strings de los descendientes: "/a/" <= p < "/a0" ("0" sigue a "/")
+        base = "" if path == "/" else path
+        return base + "/", base + "0"
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def replace_dir(self, rel_dir: str, items: list, listed_at: Optional[float] = None,
+                    mtime: Optional[float] = None, source: str = "crawl"):
+        """
+        Reemplaza el contenido indexado de `rel_dir` por `items` (un listado completo)
+        y registra en el change feed las diferencias con lo que había. Antes de la
+        primera línea base (índice recién creado) no se registran cambios.
+        """
+        base = "" if rel_dir == "/" else rel_dir
+        rows = {f"{base}/{item['name']}": item for item in items}
+        changes = []
+        with self._lock, self._db:
+            emit = self._baseline_done()
+            current = {
+                path: (size, prev_mtime, bool(is_dir))
+                for path, size, prev_mtime, is_dir in self._db.execute(
+                    "SELECT path, size, mtime, is_dir FROM entries WHERE parent = ?", (rel_dir,)
+                )
+            }
+            for path, (size, prev_mtime, was_dir) in current.items():
+                if path in rows:
+                    item = rows[path]
+                    if emit and not was_dir and not item["is_dir"] and (size != item["size"] or prev_mtime != item["mtime"]):
+                        changes.append(("modified", path, item["size"], item["mtime"], False))
+                    continue
+                self._db.execute("DELETE FROM entries WHERE path = ?", (path,))
+                if was_dir:
+                    self._delete_tree(path)
+                if emit:
+                    changes.append(("deleted", path, size, prev_mtime, was_dir))
+            if emit:
+                changes += [
+                    ("created", path, item["size"], item["mtime"], bool(item["is_dir"]))
+                    for path, item in rows.items() if path not in current
+                ]
+            self._db.executemany(
+                "INSERT OR REPLACE INTO entries (path, parent, name, size, mtime, mode, is_dir) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [self._row(path, item) for path, item in rows.items()],
+            )
+            self._db.execute(
+                "INSERT OR REPLACE INTO dirs (path, listed_at, mtime) VALUES (?, ?, ?)",
+                (rel_dir, listed_at or time.time(), mtime),
+            )
+            self._log_changes(changes, source)
+        self._notify(changes)
+
+    def _delete_tree(self, path: str):
+        low, high = self._descendants(path)
+        self._db.execute("DELETE FROM entries WHERE path >= ? AND path < ?", (low, high))
+        self._db.execute("DELETE FROM dirs WHERE path = ? OR (path >= ? AND path < ?)", (path, low, high))
+
+    def record(self, rel: str, item: dict):
+        """Write-through de un archivo o directorio creado/modificado por la API."""
+        changes = []
+        with self._lock, self._db:
+            for parent in reversed(list(_ancestors(rel.lstrip("/")))):
+                inserted = self._db.execute(
+                    "INSERT OR IGNORE INTO entries (path, parent, name, size, mtime, mode, is_dir) VALUES (?, ?, ?, 0, NULL, NULL, 1)",
+                    ("/" + parent, posixpath.dirname("/" + parent), posixpath.basename(parent)),
+                ).rowcount
+                if inserted:
+                    changes.append(("created", "/" + parent, 0, None, True))
+            previous = self._db.execute("SELECT size, mtime, is_dir FROM entries WHERE path = ?", (rel,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (path, parent, name, size, mtime, mode, is_dir) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                self._row(rel, item),
+            )
+            if previous is None:
+                changes.append(("created", rel, item["size"], item["mtime"], bool(item["is_dir"])))
+            elif not item["is_dir"]:
+                changes.append(("modified", rel, item["size"], item["mtime"], False))
+            self._log_changes(changes, "api")
+        self._notify(changes)
+
+    def remove(self, rel: str):
+        with self._lock, self._db:
+            previous = self._db.execute("SELECT size, mtime, is_dir FROM entries WHERE path = ?", (rel,)).fetchone()
+            self._db.execute("DELETE FROM entries WHERE path = ?", (rel,))
+            self._delete_tree(rel)
+            changes = [("deleted", rel, previous[0] if previous else None, previous[1] if previous else None,
+                        bool(previous[2]) if previous else False)]
+            self._log_changes(changes, "api")
+        self._notify(changes)
+
+    # --- change feed ---
+    def _baseline_done(self) -> bool:
+        return self._db.execute("SELECT 1 FROM meta WHERE key = 'baseline_at'").fetchone() is not None
+
+    def mark_baseline(self):
+        with self._lock, self._db:
+            self._db.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('baseline_at', ?)", (str(time.time()),))
+
+    def _log_changes(self, changes: list, source: str):
+        if not changes:
+            return
+        now = time.time()
+        self._db.executemany(
+            "INSERT INTO changes (ts, op, path, size, mtime, is_dir, source) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(now, op, path, size, mtime, int(is_dir), source) for op, path, size, mtime, is_dir in changes],
+        )
+        self._db.execute(
+            "DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?", (self.changes_retention,)
+        )
+
+    def _notify(self, changes: list):
+        if changes:
+            metrics.incr("changes.recorded", len(changes))
+            with self.changed:
+                self.changed.notify_all()
+                for loop, event in self._async_waiters:
+                    try:
+                        loop.call_soon_threadsafe(event.set)
+                    except RuntimeError:
+                        pass  # loop ya cerrado
+
+    def cursor_bounds(self) -> Tuple[int, int]:
+        """(seq más antiguo retenido, seq más reciente); (0, 0) si no hay cambios."""
+        with self._lock:
+            low, high = self._db.execute("SELECT MIN(seq), MAX(seq) FROM changes").fetchone()
+        return low or 0, high or 0
+
+    def changes_since(self, since: int, limit: int, prefix: Optional[str] = None) -> list:
+        sql = "SELECT seq, ts, op, path, size, mtime, is_dir, source FROM changes WHERE seq > ?"
+        params = [since]
+        if prefix and prefix != "/":
+            low, high = self._descendants(prefix)
+            sql += " AND (path = ? OR (path >= ? AND path < ?))"
+            params += [prefix, low, high]
+        with self._lock:
+            rows = self._db.execute(sql + " ORDER BY seq LIMIT ?", params + [limit]).fetchall()
+        return [
+            {"cursor": str(seq), "ts": ts, "op": op, "path": path, "size": size, "mtime": mtime,
+             "is_dir": bool(is_dir), "source": source}
+            for seq, ts, op, path, size, mtime, is_dir, source in rows
+        ]
+
+    def wait_for_changes(self, since: int, timeout: float) -> bool:
+        """Bloquea hasta que haya cambios posteriores a `since` o venza `timeout`."""
+        deadline = time.monotonic() + timeout
+        with self.changed:
+            while self.cursor_bounds()[1] <= since:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                # En multi-worker las escrituras de otro proceso no notifican: se re-consulta seguido
+                self.changed.wait(min(remaining, 1.0))
+        return True
+
+    async def wait_for_changes_async(self, since: int, timeout: float) -> bool:
+        """Como wait_for_changes, pero espera en el event loop: un stream SSE o un long-poll no retiene un thread."""
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self.changed:
+            self._async_waiters.add(waiter)
+        try:
+            deadline = loop.time() + timeout
+            while True:
+                waiter[1].clear()
+                if (await asyncio.to_thread(self.cursor_bounds))[1] > since:
+                    return True
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    return False
+                # En multi-worker las escrituras de otro proceso no notifican: se re-consulta seguido
+                try:
+                    await asyncio.wait_for(waiter[1].wait(), min(remaining, 1.0))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            with self.changed:
+                self._async_waiters.discard(waiter)
+
+    # --- estado de directorios (crawler incremental) ---
+    def dir_state(self, rel_dir: str):
+        """(mtime, listed_at) del último listado de `rel_dir`, o None si nunca se listó."""
+        with self._lock:
+            return self._db.execute("SELECT mtime, listed_at FROM dirs WHERE path = ?", (rel_dir,)).fetchone()
+
+    def child_dirs(self, rel_dir: str) -> List[str]:
+        with self._lock:
+            return [row[0] for row in self._db.execute(
+                "SELECT path FROM entries WHERE parent = ? AND is_dir = 1", (rel_dir,)
+            )]
+
+    def listing(self, rel_dir: str, max_age: float):
+        """Listado de `rel_dir` si se listó hace menos de `max_age` segundos; si no, None."""
+        with self._lock:
+            row = self._db.execute("SELECT listed_at FROM dirs WHERE path = ?", (rel_dir,)).fetchone()
+            if row is None or row[0] is None or time.time() - row[0] > max_age:
+                return None
+            rows = self._db.execute(
+                "SELECT name, size, mode, is_dir, mtime FROM entries WHERE parent = ? ORDER BY name", (rel_dir,)
+            ).fetchall()
+        return row[0], [self._item(*r) for r in rows]
+
+    @staticmethod
+    def _item(name, size, mode, is_dir, mtime, path=None) -> dict:
+        item = {"name": name, "size": size, "mode": oct(mode) if mode is not None else None, "is_dir": bool(is_dir), "mtime": mtime}
+        if path is not None:
+            item["path"] = path
+        return item
+
+    def search(self, glob: Optional[str] = None, prefix: Optional[str] = None, min_size: Optional[int] = None,
+               max_size: Optional[int] = None, modified_after: Optional[float] = None,
+               modified_before: Optional[float] = None, kind: Optional[str] = None, limit: int = 1000) -> list:
+        clauses, params = [], []
+        if glob:
+            # Con "/" el patrón aplica al path completo; si no, solo al nombre
+            clauses.append("path GLOB ?" if "/" in glob else "name GLOB ?")
+            params.append(glob)
+        if prefix and prefix != "/":
+            low, high = self._descendants(prefix)
+            clauses.append("path >= ? AND path < ?")
+            params += [low, high]
+        for clause, value in (("size >= ?", min_size), ("size <= ?", max_size),
+                              ("mtime >= ?", modified_after), ("mtime <= ?", modified_before)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        if kind in ("file", "dir"):
+            clauses.append("is_dir = ?")
+            params.append(int(kind == "dir"))
+        where = " AND ".join(clauses) or "1"
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT name, size, mode, is_dir, mtime, path FROM entries WHERE {where} ORDER BY path LIMIT ?",
+                (*params, limit),
+            ).fetchall()
+        return [self._item(*r) for r in rows]
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            dirs = self._db.execute("SELECT COUNT(*) FROM dirs").fetchone()[0]
+        return {"entries": entries, "listed_dirs": dirs, "last_crawl": self.last_crawl,
+                "last_incremental": self.last_incremental}
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_index() -> Optional[MetadataIndex]:
+    """Índice de metadatos, o None si INDEX_DB no está configurado."""
+    global _index
+    settings = get_settings()
+    if not settings.INDEX_DB:
+        return None
+    with _index_lock:
+        if _index is None or _index.db_path != settings.INDEX_DB:
+            _index = MetadataIndex(settings.INDEX_DB, settings.CHANGES_RETENTION)
+        return _index
+
+def reset_index():
+    global _index
+    with _index_lock:
+        index, _index = _index, None
+    if index is not None:
+        index.close()
+
+def index_written(rel: str, attr):
+    """Hook de escritura: la API creó o modificó `rel` (attr = SFTPAttributes o None para directorio)."""
+    metadata_cache().invalidate(rel)
+    index = get_index()
+    if index is None:
+        return
+    if attr is None:
+        item = {"size": 0, "mtime": None, "mode": pystat.S_IFDIR | 0o750, "is_dir": True}
+    else:
+        item = {"size": attr.st_size, "mtime": attr.st_mtime, "mode": attr.st_mode, "is_dir": pystat.S_ISDIR(attr.st_mode)}
+    index.record(rel, item)
+
+def index_removed(rel: str):
+    """Hook de borrado: la API eliminó `rel` (y su contenido, si era directorio)."""
+    metadata_cache().invalidate(rel)
+    index = get_index()
+    if index is not None:
+        index.remove(rel)
+
+def dir_mtime(rel: str) -> Optional[float]:
+    """mtime de un directorio (el mayor entre shards); None si no existe en ninguno."""
+    backends = get_router().backends_for_dir(rel)
+
+    def stat_one(backend):
+        try:
+            return backend.read(rel, lambda sftp, path: sftp.stat(path).st_mtime)
+        except FileNotFoundError:
+            return None
+
+    mtimes = [m for m in fan_out(backends, stat_one) if m is not None]
+    return max(mtimes) if mtimes else None
+
+def crawl_index(root_rel: str = "/"):
+    """
+    Recorre el árbol remoto completo y reemplaza el índice directorio por directorio.
+    El primer recorrido completo fija la línea base del change feed.
+    """
+    index = get_index()
+    if index is None:
+        return
+    settings = get_settings()
+    base = "" if root_rel == "/" else root_rel
+    mtimes = {"": dir_mtime(root_rel)}
+
+    def on_dir(path, items):
+        for item in items:
+            if item["is_dir"]:
+                mtimes[f"{path}/{item['name']}" if path else item["name"]] = item["mtime"]
+        index.replace_dir(f"{base}/{path}" if path else root_rel, items, mtime=mtimes.pop(path, None))
+
+    walk_remote(root_rel, settings.INDEX_CRAWL_CONCURRENCY, on_dir=on_dir, collect=False)
+    index.mark_baseline()
+    index.last_crawl = time.time()
+    metrics.incr("index.crawls")
+
+def crawl_index_incremental(root_rel: str = "/"):
+    """
+    Re-escanea solo los directorios cuyo mtime cambió desde su último listado; del
+    resto solo se hace stat para bajar a sus subdirectorios. Detecta altas, bajas y
+    renombres, pero no reescrituras in-place de un archivo existente (no cambian el
+    mtime del directorio): esas las recoge el recorrido completo.
+    """
+    index = get_index()
+    if index is None:
+        return
+    settings = get_settings()
+
+    def visit(rel, mtime):
+        if mtime is None:
+            mtime = dir_mtime(rel)
+            if mtime is None:
+                return []  # borrado; lo registra el re-listado del padre
+        state = index.dir_state(rel)
+        # Con resolución de 1 s, un cambio en el mismo segundo del listado no se ve en el mtime
+        if state is None or state[0] is None or mtime != state[0] or state[0] >= state[1] - 1:
+            listed_at = time.time()
+            try:
+                items = list_directory(rel, use_cache=False)
+            except HTTPException as exc:
+                if exc.status_code == 404:
+                    return []
+                raise
+            index.replace_dir(rel, items, listed_at=listed_at, mtime=mtime)
+            metrics.incr("index.incremental_relisted")
+            base = "" if rel == "/" else rel
+            return [(f"{base}/{item['name']}", item["mtime"]) for item in items if item["is_dir"]]
+        return [(child, None) for child in index.child_dirs(rel)]
+
+    with ThreadPoolExecutor(max_workers=settings.INDEX_CRAWL_CONCURRENCY, thread_name_prefix="index-incr") as pool:
+        pending = {pool.submit(visit, root_rel, None)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                for child, mtime in future.result():
+                    pending.add(pool.submit(visit, child, mtime))
+    index.last_incremental = time.time()
+    metrics.incr("index.incremental_crawls")
+
+class WorkerLock:
+    """flock no bloqueante sobre un archivo: elige un único worker para tareas de fondo."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def try_acquire(self) -> bool:
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            os.close(self._fd)  # cerrar libera el flock
+            self._fd = None
+
+class IndexCrawler:
+    """
+    Thread que recorre el árbol al arrancar y luego cada INDEX_CRAWL_INTERVAL segundos;
+    entre recorridos completos hace uno incremental cada INDEX_INCREMENTAL_INTERVAL.
+    Con varios workers compartiendo INDEX_DB solo recorre el que tiene el lock; los
+    demás reintentan tomarlo por si ese worker muere.
+    """
+
+    LEADER_RETRY = 30.0
+
+    def __init__(self, interval: float, incremental_interval: float = 0):
+        self.interval = interval
+        self.incremental_interval = incremental_interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._leader = None
+
+    def start(self):
+        if get_index() is None:
+            return
+        self._leader = WorkerLock(get_settings().INDEX_DB + ".crawler.lock")
+        self._thread = threading.Thread(target=self._run, name="index-crawler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self._leader is not None:
+            self._leader.release()
+
+    def _run(self):
+        while not self._leader.try_acquire():
+            if self._stop.wait(self.LEADER_RETRY):
+                return
+        next_full = 0.0
+        while not self._stop.is_set():
+            full = time.monotonic() >= next_full
+            try:
+                crawl_index() if full else crawl_index_incremental()
+            except Exception:
+                metrics.incr("index.crawl_errors")
+            if full:
+                next_full = time.monotonic() + self.interval if self.interval > 0 else float("inf")
+            waits = [t for t in (self.incremental_interval, next_full - time.monotonic()) if 0 < t < float("inf")]
+            if not waits:
+                return
+            self._stop.wait(min(waits))
+
+# ------------- Warmup -------------
+class MetadataCache:
+    """Cache TTL de listados y stats por path relativo, seguro entre threads."""
+
+    def __init__(self, maxsize: int = 10000):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        self._data = OrderedDict()  # (kind, rel) -> (expira, valor)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl: float):
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, rel: str):
+        """
+        Descarta `rel`, lo que contenía si era un directorio y sus ancestros (una
+        escritura puede haber creado directorios padre).
+        """
+        ancestors = {"/", rel}
+        parent = posixpath.dirname(rel)
+        while parent not in ("/", ""):
+            ancestors.add(parent)
+            parent = posixpath.dirname(parent)
+        prefix = rel.rstrip("/") + "/"
+        with self._lock:
+            for key in list(self._data):
+                path = key[1]
+                if path in ancestors or path.startswith(prefix):
+                    del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_metadata_cache = MetadataCache()
+
+class SharedMetadataCache:
+    """
+    Misma interfaz que MetadataCache pero en un SQLite compartido entre workers
+    (METADATA_CACHE_SHARED, idealmente en /dev/shm): un listado hecho por un
+    worker le sirve a los demás y una escritura invalida en todos.
+    """
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._sets = 0
+        self._db = sqlite3.connect(db_path, check_same_thread=False, timeout=1.0)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=OFF")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS cache (kind TEXT, path TEXT, expires REAL, value TEXT, PRIMARY KEY (kind, path))"
+        )
+
+    def get(self, key):
+        try:
+            with self._lock:
+                row = self._db.execute(
+                    "SELECT value FROM cache WHERE kind = ? AND path = ? AND expires > ?", (*key, time.time())
+                ).fetchone()
+        except sqlite3.OperationalError:
+            return None  # base ocupada por otro worker: se trata como miss
+        return json.loads(row[0]) if row else None
+
+    def set(self, key, value, ttl: float):
+        try:
+            with self._lock, self._db:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache (kind, path, expires, value) VALUES (?, ?, ?, ?)",
+                    (*key, time.time() + ttl, json.dumps(value)),
+                )
+                self._sets += 1
+                if self._sets % 1000 == 0:
+                    self._db.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        except sqlite3.OperationalError:
+            metrics.incr("cache.shared_errors")
+
+    def invalidate(self, rel: str):
+        ancestors = {"/", rel}
+        parent = posixpath.dirname(rel)
+        while parent not in ("/", ""):
+            ancestors.add(parent)
+            parent = posixpath.dirname(parent)
+        prefix = rel.rstrip("/") + "/"
+        placeholders = ", ".join("?" * len(ancestors))
+        # Una invalidación perdida dejaría datos viejos hasta el TTL: se reintenta
+        for _ in range(3):
+            try:
+                with self._lock, self._db:
+                    self._db.execute(
+                        f"DELETE FROM cache WHERE path IN ({placeholders}) OR (path >= ? AND path < ?)",
+                        (*ancestors, prefix, prefix[:-1] + "0"),
+                    )
+                return
+            except sqlite3.OperationalError:
+                time.sleep(0.05)
+        metrics.incr("cache.shared_errors")
+
+    def clear(self):
+        with self._lock, self._db:
+            self._db.execute("DELETE FROM cache")
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+def metadata_cache():
+    """Cache de listados/stats: el compartido entre workers si hay METADATA_CACHE_SHARED, si no el local."""
+    global _shared_cache
+    path = get_settings().METADATA_CACHE_SHARED
+    if not path:
+        return _metadata_cache
+    with _shared_cache_lock:
+        if _shared_cache is None or _shared_cache.db_path != path:
+            _shared_cache = SharedMetadataCache(path)
+        return _shared_cache
+
+def reset_shared_cache():
+    global _shared_cache
+    with _shared_cache_lock:
+        cache, _shared_cache = _shared_cache, None
+    if cache is not None:
+        cache.close()
+
+def file_cache_path(backend: "Backend", rel: str, info: dict) -> str:
+    """Archivo local para una versión (tamaño, mtime) concreta de `rel`."""
+    key = f"{backend.name}:{rel}:{info['size']}:{info['mtime']}"
+    return os.path.join(get_settings().FILE_CACHE_DIR, hashlib.sha256(key.encode()).hexdigest())
+
+def cached_file(rel: str) -> Optional[str]:
+    """Copia local vigente de `rel` en FILE_CACHE_DIR, o None."""
+    if not get_settings().FILE_CACHE_DIR:
+        return None
+    try:
+        info = stat_entry(rel)
+    except HTTPException:
+        return None
+    path = file_cache_path(get_router().backend_for(rel), rel, info)
+    return path if os.path.exists(path) else None
+
+def prefetch_file(rel: str, budget: int) -> Tuple[str, int]:
+    """Copia `rel` a FILE_CACHE_DIR si entra en `budget`; retorna (archivo local, bytes)."""
+    info = stat_entry(rel, use_cache=False)
+    if info["is_dir"]:
+        raise HTTPException(400, "Es un directorio")
+    backend = get_router().backend_for(rel)
+    path = file_cache_path(backend, rel, info)
+    if os.path.exists(path):
+        return path, info["size"]
+    if info["size"] > budget:
+        raise HTTPException(507, f"No entra en FILE_CACHE_MAX_BYTES ({info['size']} bytes)")
+    f, cleanup = backend.open_read(rel)
+    tmp = f"{path}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as out:
+            shutil.copyfileobj(f, out, 1024 * 1024)
+        os.replace(tmp, path)
+    finally:
+        cleanup()
+        if os.path.exists(tmp):
+            os.remove(tmp)
+    metrics.incr("warmup.files_fetched")
+    return path, info["size"]
+
+class WarmupState:
+    """Resultado del último warmup; /readyz responde 200 desde que termina el primero."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.ready = False
+        self.runs = 0
+        self.last_run = None
+        self.last_duration_ms = None
+        self.errors = []
+
+    def info(self) -> dict:
+        return {
+            "ready": self.ready,
+            "runs": self.runs,
+            "last_run": self.last_run,
+            "last_duration_ms": self.last_duration_ms,
+            "errors": self.errors,
+        }
+
+_warmup = WarmupState()
+
+def run_warmup():
+    """
+    Pre-abre conexiones en los pools, lista los WARMUP_PATHS (llenando el cache de
+    listados y el de stats de cada hijo) y copia los WARMUP_FILES al cache local.
+    Falla (y el proceso no queda listo) solo si algún backend no pudo abrir ninguna
+    conexión; los errores de paths/archivos puntuales se reportan sin bloquear.
+    """
+    settings = get_settings()
+    router = get_router()
+    start = time.monotonic()
+    errors = []
+    for backend in router.backends.values():
+        failed = backend.warm(settings.WARMUP_POOL_CONNECTIONS) if settings.WARMUP_POOL_CONNECTIONS > 0 else []
+        if len(failed) == len(backend.nodes):
+            _warmup.errors = failed
+            raise HTTPException(503, f"Backend SFTP '{backend.name}' no disponible")
+        errors += failed
+
+    index = get_index()
+    for path in settings.WARMUP_PATHS:
+        try:
+            rel = relative_path(path)
+            items = list_directory(rel, use_cache=False)
+        except HTTPException as exc:
+            errors.append(f"{path}: {exc.detail}")
+            continue
+        if index is not None:
+            index.replace_dir(rel, items, source="list")
+        if settings.METADATA_CACHE_TTL > 0:
+            base = "" if rel == "/" else rel
+            for item in items:
+                if item["mtime"] is not None:
+                    metadata_cache().set(("stat", f"{base}/{item['name']}"), dict(item), settings.METADATA_CACHE_TTL)
+        metrics.incr("warmup.paths")
+
+    if settings.FILE_CACHE_DIR:
+        os.makedirs(settings.FILE_CACHE_DIR, exist_ok=True)
+        keep, budget = set(), settings.FILE_CACHE_MAX_BYTES
+        for path in settings.WARMUP_FILES:
+            try:
+                local, size = prefetch_file(relative_path(path), budget)
+            except (HTTPException, FileNotFoundError) as exc:
+                errors.append(f"{path}: {getattr(exc, 'detail', None) or 'No existe'}")
+                continue
+            keep.add(os.path.basename(local))
+            budget -= size
+        # Versiones viejas o archivos que ya no están en WARMUP_FILES
+        for name in os.listdir(settings.FILE_CACHE_DIR):
+            if name not in keep and not name.endswith(".tmp"):
+                os.remove(os.path.join(settings.FILE_CACHE_DIR, name))
+
+    _warmup.errors = errors
+    _warmup.runs += 1
+    _warmup.last_run = time.time()
+    _warmup.last_duration_ms = round((time.monotonic() - start) * 1000, 1)
+    _warmup.ready = True
+    metrics.incr("warmup.runs")
+
+class Warmer:
+    """Thread que corre el warmup al arrancar (reintentando hasta lograrlo) y cada WARMUP_INTERVAL."""
+
+    RETRY_DELAY = 5.0
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.prepare = None  # se corre (con reintentos) antes del primer warmup
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="warmup", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                if self.prepare is not None:
+                    self.prepare()
+                    self.prepare = None
+                run_warmup()
+            except Exception as exc:
+                if self.prepare is not None:
+                    _warmup.errors = [f"startup: {exc}"]
+                metrics.incr("warmup.errors")
+            if not _warmup.ready:
+                self._stop.wait(self.RETRY_DELAY)
+                continue
+            if self.interval <= 0:
+                return
+            self._stop.wait(self.interval)
+
+# ------------- Readiness -------------
+class ReadinessProbe:
+    """
+    Probe de los primarios para /readyz. El resultado se reutiliza durante
+    READYZ_PROBE_INTERVAL, así los chequeos del balanceador no agregan carga SFTP.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.checked_at = None
+        self.results = {}
+
+    def backends(self) -> Dict[str, dict]:
+        settings = get_settings()
+        with self._lock:
+            if self.checked_at is None or time.monotonic() - self.checked_at >= settings.READYZ_PROBE_INTERVAL:
+                router = get_router()
+                backends = list(router.backends.values())
+                results = fan_out(backends, lambda b: b.primary.probe(settings.READYZ_PROBE_TIMEOUT))
+                self.results = {backend.name: result for backend, result in zip(backends, results)}
+                self.checked_at = time.monotonic()
+                metrics.incr("readyz.probes")
+            return self.results
+
+_readiness = ReadinessProbe()
+
+def readiness() -> Tuple[bool, dict]:
+    """Evalúa warmup, probe SFTP, saturación de pools y latencia/errores recientes."""
+    settings = get_settings()
+    failures = []
+    if not _warmup.ready:
+        failures.append("warmup pendiente")
+
+    probes = _readiness.backends()
+    for name, result in probes.items():
+        if not result["ok"]:
+            failures.append(f"backend '{name}': {result['error']}")
+
+    nodes = [node for backend in get_router().backends.values() for node in backend.nodes]
+    saturation = max((node.saturation() for node in nodes), default=0.0)
+    if saturation >= settings.READYZ_MAX_POOL_SATURATION:
+        failures.append(f"pool saturado ({saturation:.0%})")
+
+    window = sftp_latency.summary(settings.READYZ_WINDOW)
+    if window["samples"] >= settings.READYZ_MIN_SAMPLES:
+        if window["p99_ms"] is not None and window["p99_ms"] > settings.READYZ_MAX_P99_MS:
+            failures.append(f"p99 SFTP {window['p99_ms']} ms > {settings.READYZ_MAX_P99_MS} ms")
+        if window["error_rate"] > settings.READYZ_MAX_ERROR_RATE:
+            failures.append(f"tasa de error SFTP {window['error_rate']:.0%} > {settings.READYZ_MAX_ERROR_RATE:.0%}")
+
+    return not failures, {
+        "failures": failures,
+        "backends": probes,
+        "pool_saturation": round(saturation, 4),
+        "sftp": window,
+        "warmup": _warmup.info(),
+    }
+
+# ------------- Endpoints -------------
+@app.get(
+    "/healthz",
+    tags=["Health"],
+    summary="Health Check",
+    description="Verifica que el servicio está funcionando correctamente. No requiere autenticación.",
+    response_description="Estado del servicio"
+)
+def healthz():
+    """
+    Endpoint de healthcheck simple.
+    
+    Retorna:
+    - **ok**: True si el servicio está funcionando
+    - **service**: Nombre del servicio
+    """
+    return {"ok": True, "service": "sftp-api"}
+
+@app.get(
+    "/readyz",
+    tags=["Health"],
+    summary="Readiness",
+    description="Responde 503 mientras el warmup no terminó, si el `stat` de BASE_DIR en algún primario falla, si un pool está saturado o si el p99/tasa de error SFTP recientes superan los umbrales READYZ_*. El probe se cachea READYZ_PROBE_INTERVAL segundos. `/healthz` sigue indicando solo que el proceso vive. No requiere autenticación."
+)
+def readyz():
+    ready, checks = readiness()
+    status = {"ready": ready, "service": "sftp-api", **checks}
+    if not ready:
+        return JSONResponse(status_code=503, content=status)
+    return status
+
+@app.get(
+    "/metrics",
+    tags=["Health"],
+    summary="Métricas internas",
+    description="Contadores del proceso: lecturas ejecutadas (`flights.*`) y requests agrupados en una lectura ya en curso (`coalesced.*`).",
+    dependencies=[Depends(require_api_key)]
+)
+def get_metrics():
+    return {"counters": metrics.snapshot(), "admission": _admission.stats()}
+
+@app.get(
+    "/backends",
+    tags=["Health"],
+    summary="Estado de los backends SFTP",
+    description="Lista los backends configurados con su estado de salud, latencia del último chequeo y uso del pool de conexiones.",
+    dependencies=[Depends(require_api_key)]
+)
+def list_backends():
+    router = get_router()
+    return {
+        "routing": router.mode,
+        "default": router.default.name,
+        "routes": {prefix: backend.name for prefix, backend in router.routes},
+        "backends": [backend.info() for backend in router.backends.values()],
+    }
+
+@app.get(
+    "/list",
+    tags=["Directorios"],
+    summary="Listar contenido de directorio",
+    description="Lista archivos y subdirectorios de una ruta específica. Retorna nombre, tamaño, permisos y timestamp de cada elemento. Con varios shards, combina el listado de todos.",
+    dependencies=[Depends(require_api_key)]
+)
+def list_dir(
+    path: str = Query("/", description="Ruta relativa a BASE_DIR", example="/"),
+    max_age: Optional[float] = Query(None, description="Si hay índice (INDEX_DB) y el directorio se indexó hace menos de estos segundos, responde desde el índice sin ir al servidor SFTP"),
+    format: str = Query("objects", description="`objects` (un objeto por entrada), `columnar` (listas `names`, `sizes`, `mtimes`, `modes`, `dirs`) o `msgpack` (columnar en MessagePack)"),
+    accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding")
+):
+    settings = get_settings()
+    if format not in LISTING_FORMATS:
+        raise HTTPException(400, f"format debe ser uno de: {', '.join(LISTING_FORMATS)}")
+    if format == "msgpack" and msgpack is None:
+        raise HTTPException(406, "MessagePack no disponible (pip install msgpack)")
+    target = safe_join(settings.BASE_DIR, path)
+    rel = relative_path(path)
+    index = get_index()
+    if index is not None:
+        cached = index.listing(rel, max_age) if max_age is not None else None
+        if cached is not None:
+            metrics.incr("index.list_hits")
+            indexed_at, items = cached
+            return listing_response({"path": target, "source": "index", "indexed_at": indexed_at}, items, format, accept_encoding)
+        # Un hit del cache ya quedó en el índice cuando se listó; re-registrarlo solo
+        # reescribiría SQLite y correría listed_at a un listado que no ocurrió
+        listed_at, items, from_cache = listing_snapshot(rel)
+        if not from_cache:
+            index.replace_dir(rel, items, listed_at=listed_at, source="list")
+        return listing_response({"path": target}, items, format, accept_encoding)
+    return listing_response({"path": target}, list_directory(rel), format, accept_encoding)
+
+@app.get(
+    "/search",
+    tags=["Directorios"],
+    summary="Buscar en el índice de metadatos",
+    description="Busca archivos y directorios en el índice local (requiere INDEX_DB) sin recorrer el servidor SFTP. `glob` aplica al nombre, o al path completo si contiene `/`.",
+    dependencies=[Depends(require_api_key)]
+)
+def search(
+    glob: Optional[str] = Query(None, description="Patrón glob, p. ej. `*.csv` o `/reports/*/2025-*.pdf`", example="*.csv"),
+    prefix: Optional[str] = Query(None, description="Solo bajo este directorio (relativo a BASE_DIR)"),
+    min_size: Optional[int] = Query(None, description="Tamaño mínimo en bytes"),
+    max_size: Optional[int] = Query(None, description="Tamaño máximo en bytes"),
+    modified_after: Optional[float] = Query(None, description="mtime mínimo (epoch)"),
+    modified_before: Optional[float] = Query(None, description="mtime máximo (epoch)"),
+    type: Optional[str] = Query(None, description="`file` o `dir`"),
+    limit: int = Query(1000, ge=1, le=100000, description="Máximo de resultados"),
+    accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding")
+):
+    index = get_index()
+    if index is None:
+        raise HTTPException(503, "Índice deshabilitado (configura INDEX_DB)")
+    if type is not None and type not in ("file", "dir"):
+        raise HTTPException(400, "type debe ser 'file' o 'dir'")
+    items = index.search(
+        glob=glob,
+        prefix=relative_path(prefix) if prefix else None,
+        min_size=min_size,
+        max_size=max_size,
+        modified_after=modified_after,
+        modified_before=modified_before,
+        kind=type,
+        limit=limit,
+    )
+    return encoded_json({"items": items, "count": len(items), "index": index.stats()}, accept_encoding)
+
+def parse_cursor(index: "MetadataIndex", since: Optional[str]) -> int:
+    """Valida un cursor de /changes; None = posición actual (solo cambios futuros)."""
+    low, high = index.cursor_bounds()
+    if since is None:
+        return high
+    try:
+        cursor = int(since)
+    except ValueError:
+        raise HTTPException(400, "Cursor inválido")
+    if cursor > high or (low and cursor < low - 1):
+        raise HTTPException(410, "Cursor expirado o desconocido; vuelve a listar y pide /changes sin since")
+    return cursor
+
+def read_changes(index: "MetadataIndex", cursor: int, limit: int, prefix: Optional[str]) -> Tuple[list, int]:
+    """Cambios posteriores a `cursor` y el cursor desde el que seguir."""
+    head = index.cursor_bounds()[1]
+    changes = index.changes_since(cursor, limit, prefix)
+    if changes:
+        return changes, int(changes[-1]["cursor"])
+    # Con filtro por prefijo puede no haber coincidencias: avanzar igual hasta el head leído
+    return changes, max(cursor, head)
+
+@app.get(
+    "/changes",
+    tags=["Directorios"],
+    summary="Cambios desde un cursor",
+    description="Retorna las altas, modificaciones y bajas registradas desde `since` (requiere INDEX_DB). Se alimenta de las escrituras hechas por la API y del crawler incremental. Sin `since` retorna el cursor actual. Con `wait` hace long-polling hasta que haya cambios.",
+    dependencies=[Depends(require_api_key)]
+)
+async def changes(
+    since: Optional[str] = Query(None, description="Cursor retornado por la llamada anterior"),
+    prefix: Optional[str] = Query(None, description="Solo cambios bajo este directorio (relativo a BASE_DIR)"),
+    limit: int = Query(1000, ge=1, le=10000, description="Máximo de cambios por respuesta"),
+    wait: float = Query(0, ge=0, description="Segundos a esperar (long-poll) si no hay cambios; máximo CHANGES_MAX_WAIT")
+):
+    index = get_index()
+    if index is None:
+        raise HTTPException(503, "Índice deshabilitado (configura INDEX_DB)")
+    rel_prefix = relative_path(prefix) if prefix else None
+    cursor = await asyncio.to_thread(parse_cursor, index, since)
+    items, next_cursor = await asyncio.to_thread(read_changes, index, cursor, limit, rel_prefix)
+    deadline = time.monotonic() + min(wait, get_settings().CHANGES_MAX_WAIT)
+    # El long-poll espera en el event loop, como /changes/stream: no retiene un thread del pool
+    while not items and since is not None and time.monotonic() < deadline:
+        if await index.wait_for_changes_async(next_cursor, deadline - time.monotonic()):
+            items, next_cursor = await asyncio.to_thread(read_changes, index, next_cursor, limit, rel_prefix)
+    return {"changes": items, "cursor": str(next_cursor), "more": len(items) == limit}
+
+@app.get(
+    "/changes/stream",
+    tags=["Directorios"],
+    summary="Cambios en vivo (SSE)",
+    description="Igual que /changes pero como Server-Sent Events: un evento `change` por cambio, con el cursor como `id` (admite reanudar con `Last-Event-ID`).",
+    dependencies=[Depends(require_api_key)]
+)
+def changes_stream(
+    since: Optional[str] = Query(None, description="Cursor desde el que empezar; por defecto, el actual"),
+    prefix: Optional[str] = Query(None, description="Solo cambios bajo este directorio (relativo a BASE_DIR)"),
+    last_event_id: Optional[str] = Header(None, alias="Last-Event-ID")
+):
+    index = get_index()
+    if index is None:
+        raise HTTPException(503, "Índice deshabilitado (configura INDEX_DB)")
+    rel_prefix = relative_path(prefix) if prefix else None
+    cursor = parse_cursor(index, last_event_id or since)
+
+    # Generador async: entre cambios espera en el event loop, sin ocupar un thread del pool
+    async def events():
+        nonlocal cursor
+        yield f"retry: 5000\nevent: cursor\ndata: {cursor}\n\n"
+        while True:
+            items, cursor = await asyncio.to_thread(read_changes, index, cursor, 1000, rel_prefix)
+            for item in items:
+                yield f"id: {item['cursor']}\nevent: change\ndata: {json.dumps(item)}\n\n"
+            if not items and not await index.wait_for_changes_async(cursor, 15):
+                yield ": keepalive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.get(
+    "/stat",
+    tags=["Archivos"],
+    summary="Metadatos de un archivo o directorio",
+    description="Retorna tamaño, permisos, tipo y timestamp de una ruta sin descargarla.",
+    dependencies=[Depends(require_api_key)]
+)
+def stat_path(path: str = Query(..., description="Ruta relativa a BASE_DIR", example="/uploads/document.pdf")):
+    settings = get_settings()
+    target = safe_join(settings.BASE_DIR, path)
+    info = stat_entry(relative_path(path))
+    if not info["is_dir"]:
+        info["etag"] = file_etag(info["size"], info["mtime"])
+    return {"path": target, **info}
+
+@app.get(
+    "/checksum",
+    tags=["Archivos"],
+    summary="Checksum de un archivo remoto",
+    description="Calcula el hash de un archivo sin descargarlo: usa la extensión SFTP `check-file` o `<algo>sum` remoto cuando el servidor lo permite; si no, lo calcula en la API con lecturas pipelineadas. Cacheado por (path, tamaño, mtime).",
+    dependencies=[Depends(require_api_key)]
+)
+def checksum(
+    path: str = Query(..., description="Ruta del archivo (relativa a BASE_DIR)", example="/uploads/document.pdf"),
+    algorithm: str = Query("sha256", description="md5, sha1, sha256 o sha512")
+):
+    algorithm = validate_algorithm(algorithm)
+    rel = relative_path(path)
+    backend = get_router().backend_for(rel)
+
+    def compute(sftp, target):
+        st = sftp.stat(target)
+        if pystat.S_ISDIR(st.st_mode):
+            raise HTTPException(400, "Es un directorio")
+        key = (backend.name, rel, st.st_size, st.st_mtime, algorithm)
+        digest = _checksum_cache.get(key)
+        if digest is not None:
+            return target, st, digest, "cache"
+        digest, method = remote_checksum(sftp, target, algorithm, st.st_size)
+        _checksum_cache.set(key, digest)
+        return target, st, digest, method
+
+    try:
+        target, st, digest, method = backend.read(rel, compute)
+    except FileNotFoundError:
+        raise HTTPException(404, "No existe")
+    metrics.incr(f"checksum.{method}")
+    return {
+        "path": target,
+        "algorithm": algorithm,
+        "checksum": digest,
+        "size": st.st_size,
+        "mtime": st.st_mtime,
+        "method": method,
+        "cached": method == "cache",
+    }
+
+@app.post(
+    "/mkdir",
+    tags=["Directorios"],
+    summary="Crear directorio",
+    description="Crea un directorio recursivamente (equivalente a `mkdir -p`). Si los directorios padre no existen, se crean automáticamente.",
+    dependencies=[Depends(require_api_key)]
+)
+def mkdir(path: str = Form(..., description="Directorio a crear (relativo a BASE_DIR)", example="/uploads/2025")):
+    settings = get_settings()
+    target = safe_join(settings.BASE_DIR, path)
+    rel = relative_path(path)
+
+    make_dirs(rel)
+    return {"ok": True, "created": target}
+
+@app.post(
+    "/upload",
+    tags=["Archivos"],
+    summary="Subir archivo",
+    description="Sube UN archivo al servidor SFTP. Solo acepta archivos individuales, no directorios. La ruta NO debe terminar en `/`.",
+    dependencies=[Depends(require_api_key)]
+)
+def upload(
+    response: Response,
+    remote_path: str = Form(..., description="Ruta destino del archivo (relativa a BASE_DIR)", example="/uploads/document.pdf"),
+    file: UploadFile = File(..., description="Archivo a subir"),
+    checksum: Optional[str] = Form(None, description="Algoritmo para calcular el hash mientras se sube (md5, sha1, sha256, sha512)", example="sha256"),
+    content_hash: Optional[str] = Form(None, description="Hash del archivo según el cliente, `algoritmo:hex`. Si el remoto ya lo tiene no se transfiere; si no, el contenido subido se verifica contra él", example="sha256:9f86d081884c7d659a2feaa0c55ad015a3bf4f1b2b0b822cd15d6c15b0f00a08"),
+    if_match: Optional[str] = Header(None, description="Solo sobrescribir si el ETag remoto coincide (`*` = si existe)"),
+    if_none_match: Optional[str] = Header(None, description="`*` = solo crear, nunca sobrescribir"),
+    idempotency_key: Optional[str] = Header(None, description="Un reintento con la misma clave recibe el resultado original sin volver a subir"),
+    x_transfer_id: Optional[str] = Header(None, description="Id elegido por el cliente para seguir el avance en /transfers/{id}/progress"),
+):
+    if remote_path.endswith("/"):
+        raise HTTPException(400, "remote_path debe ser un ARCHIVO (no terminar en /)")
+    algorithm = validate_algorithm(checksum) if checksum else None
+    expected = parse_content_hash(content_hash) if content_hash else None
+    rel = relative_path(remote_path)
+    idempotent = bool(idempotency_key) and get_settings().IDEMPOTENCY_TTL > 0
+    with track_transfer(x_transfer_id, "upload", rel, file.size):
+        if idempotent:
+            fingerprint = f"{rel}|{file.size}|{content_hash or ''}|{algorithm or ''}|{if_match or ''}|{if_none_match or ''}"
+            replay = _idempotency.begin(idempotency_key, fingerprint)
+            if replay is not None:
+                response.headers["Idempotent-Replayed"] = "true"
+                return replay
+        result = None
+        try:
+            result = check_upload_preconditions(rel, file.size, if_match, if_none_match, expected,
+                                                [algorithm] if algorithm else [])
+            if result is None:
+                with upload_pipeline(posixpath.basename(rel), [algorithm] if algorithm else [], file.size,
+                                     dict([expected]) if expected else None) as pipeline:
+                    _, target, info = store_file(rel, file.file, pipeline, size=file.size)
+                result = {"ok": True, "path": target, **info}
+            if algorithm:
+                result.update({"algorithm": algorithm, "checksum": result["hashes"].get(algorithm)})
+        finally:
+            if idempotent:
+                _idempotency.finish(idempotency_key, fingerprint, result)
+        return result
+
+@app.post(
+    "/upload/delta/plan",
+    tags=["Archivos"],
+    summary="Planificar subida delta",
+    description="Recibe las firmas por bloque (adler32 + hash fuerte) del archivo nuevo y retorna los índices de bloques que difieren del archivo remoto. Solo esos bloques deben enviarse a `/upload/delta`.",
+    dependencies=[Depends(require_api_key)]
+)
+def upload_delta_plan(
+    remote_path: str = Form(..., description="Ruta del archivo a actualizar (relativa a BASE_DIR)", example="/uploads/big.bin"),
+    manifest: str = Form(..., description='JSON: {"block_size": 1048576, "size": ..., "algorithm": "sha256", "blocks": [{"weak": ..., "strong": "..."}]}')
+):
+    if remote_path.endswith("/"):
+        raise HTTPException(400, "remote_path debe ser un ARCHIVO (no terminar en /)")
+    manifest = parse_delta_manifest(manifest)
+    rel = relative_path(remote_path)
+    backend = get_router().backend_for(rel)
+    target = backend.join(rel)
+    with backend.session() as sftp:
+        try:
+            st = sftp.stat(target)
+        except FileNotFoundError:
+            st = None
+        if st is not None and pystat.S_ISDIR(st.st_mode):
+            raise HTTPException(400, "remote_path apunta a un directorio; usa un nombre de archivo")
+        if st is None:
+            missing = list(range(len(manifest.blocks)))
+        else:
+            missing = diff_blocks(sftp, target, manifest, st.st_size)
+    metrics.incr("delta.blocks_total", len(manifest.blocks))
+    metrics.incr("delta.blocks_missing", len(missing))
+    return {
+        "path": target,
+        "block_size": manifest.block_size,
+        "size": manifest.size,
+        "remote_size": st.st_size if st else None,
+        "remote_mtime": st.st_mtime if st else None,
+        "missing": missing,
+        "transfer_bytes": sum(block_length(manifest, i) for i in missing),
+    }
+
+@app.post(
+    "/upload/delta",
+    tags=["Archivos"],
+    summary="Aplicar subida delta",
+    description="Escribe en su offset solo los bloques indicados en `blocks` (concatenados en `file`, en el mismo orden) y trunca el archivo al tamaño nuevo. Cada bloque se verifica contra el manifest antes de escribirse. Con `if_size`/`if_mtime` (de la respuesta del plan) responde 409 si el archivo remoto cambió entretanto.",
+    dependencies=[Depends(require_api_key)]
+)
+def upload_delta(
+    remote_path: str = Form(..., description="Ruta del archivo a actualizar (relativa a BASE_DIR)", example="/uploads/big.bin"),
+    manifest: str = Form(..., description="Mismo manifest enviado al plan"),
+    blocks: str = Form(..., description="Lista JSON de índices de bloque incluidos en `file`", example="[0, 7]"),
+    file: UploadFile = File(..., description="Bloques concatenados"),
+    if_size: Optional[int] = Form(None, description="remote_size retornado por el plan"),
+    if_mtime: Optional[float] = Form(None, description="remote_mtime retornado por el plan")
+):
+    if remote_path.endswith("/"):
+        raise HTTPException(400, "remote_path debe ser un ARCHIVO (no terminar en /)")
+    manifest = parse_delta_manifest(manifest)
+    indices = parse_block_indices(blocks, manifest)
+    rel = relative_path(remote_path)
+    backend = get_router().backend_for(rel)
+    target = backend.join(rel)
+    with backend.session() as sftp:
+        try:
+            st = sftp.stat(target)
+        except FileNotFoundError:
+            st = None
+        if st is not None and pystat.S_ISDIR(st.st_mode):
+            raise HTTPException(400, "remote_path apunta a un directorio; usa un nombre de archivo")
+        if (if_size is not None and (st is None or st.st_size != if_size)) or \
+                (if_mtime is not None and (st is None or st.st_mtime != if_mtime)):
+            raise HTTPException(409, "El archivo remoto cambió desde el plan; vuelve a planificar")
+        if st is None:
+            if indices != list(range(len(manifest.blocks))):
+                raise HTTPException(400, "El archivo no existe: hay que enviar todos los bloques")
+            mkdirs_sftp(sftp, posixpath.dirname(target))
+        # Se escribe en el lugar: todos los bloques se verifican antes de tocar el archivo,
+        # así un bloque inválido no deja mezclado contenido viejo y nuevo
+        for index in indices:
+            length = block_length(manifest, index)
+            data = file.file.read(length)
+            if len(data) != length or not block_matches(data, manifest.blocks[index], manifest.algorithm):
+                raise HTTPException(400, f"El bloque {index} no coincide con el manifest")
+        if file.file.read(1):
+            raise HTTPException(400, "file trae más datos que los bloques indicados")
+        file.file.seek(0)
+        written = 0
+        with sftp.open(target, "r+b" if st is not None else "wb") as dst, Shaper() as shaper:
+            for index in indices:
+                length = block_length(manifest, index)
+                data = file.file.read(length)
+                shaper.throttle(length)
+                dst.seek(index * manifest.block_size)
+                dst.write(data)
+                written += length
+        if st is None or st.st_size != manifest.size:
+            sftp.truncate(target, manifest.size)
+        sftp.chmod(target, 0o640)
+        index_written(rel, sftp.stat(target))
+    metrics.incr("delta.bytes_written", written)
+    return {"ok": True, "path": target, "size": manifest.size, "written_blocks": len(indices), "written_bytes": written}
+
+@app.get(
+    "/download",
+    tags=["Archivos"],
+    summary="Descargar archivo",
+    description="Descarga un archivo del servidor SFTP. Retorna el archivo como stream. Los archivos de texto (COMPRESSION_TYPES) de al menos COMPRESSION_MIN_BYTES se comprimen al vuelo con la codificación negociada por `Accept-Encoding` (zstd, br o gzip).",
+    dependencies=[Depends(require_api_key)]
+)
+def download(
+    remote_path: str = Query(..., description="Ruta del archivo a descargar (relativa a BASE_DIR)", example="/uploads/document.pdf"),
+    accept_encoding: Optional[str] = Header(None, alias="Accept-Encoding"),
+    x_transfer_id: Optional[str] = Header(None, description="Id elegido por el cliente para seguir el avance en /transfers/{id}/progress")
+):
+    rel = relative_path(remote_path)
+    # El progreso lo cierra el stream de la respuesta al terminar (`shaped`)
+    with track_transfer(x_transfer_id, "download", rel, finish=False) as progress:
+        return download_response(rel, accept_encoding, progress)
+
+def download_response(rel: str, accept_encoding: Optional[str], progress: Optional[TransferProgress] = None) -> Response:
     settings = get_settings()
-    sftp = sftp_connect()
+    backend = get_router().backend_for(rel)
+    target = backend.join(rel)
+    filename = posixpath.basename(target)
+    local_mirror = backend.local_path(rel)
+    if local_mirror is not None:
+        return local_download(local_mirror, filename, accept_encoding)
+    headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
+
+    # El stat solo se paga si el archivo es candidato a compresión o a transfer worker
+    encoding = negotiate_encoding(accept_encoding) if compressible(filename) else None
+    transfers = get_transfer_pool() if backend.offloadable else None
+    info = stat_entry(rel) if encoding or transfers is not None or progress is not None else None
+    if progress is not None:
+        progress.total = info["size"]
+    if encoding and info["size"] < settings.COMPRESSION_MIN_BYTES:
+        encoding = None
+    variant = None
+    if encoding:
+        headers.update({"Content-Encoding": encoding, "Vary": "Accept-Encoding"})
+        if settings.COMPRESSION_CACHE_VARIANTS and settings.FILE_CACHE_DIR and info["size"] <= settings.FILE_CACHE_MAX_BYTES:
+            os.makedirs(settings.FILE_CACHE_DIR, exist_ok=True)
+            variant = f"{file_cache_path(backend, rel, info)}.{encoding}"
+            if os.path.exists(variant):
+                metrics.incr("cache.compressed_hits")
+                f = open(variant, "rb")
+                return TransferResponse(
+                    shaped(SharedStream(f, settings.DOWNLOAD_CHUNK_SIZE, on_close=f.close).subscribe(), Shaper()),
+                    media_type="application/octet-stream",
+                    headers=headers
+                )
+
+    def encode(body):
+        return compressed(body, encoding, variant) if encoding else body
+
+    local = cached_file(rel)
+    if local is not None:
+        metrics.incr("cache.file_hits")
+        f = open(local, "rb")
+        return TransferResponse(
+            shaped(encode(SharedStream(f, settings.DOWNLOAD_CHUNK_SIZE, on_close=f.close).subscribe()), Shaper()),
+            media_type="application/octet-stream",
+            headers=headers
+        )
+
+    offload = transfers is not None and info["size"] >= settings.TRANSFER_MIN_BYTES
+
+    def opener():
+        if offload:
+            opened = transfers.open_read(backend, rel, settings.DOWNLOAD_CHUNK_SIZE)
+            if opened is not None:
+                return opened
+        return read_ahead(*backend.open_read(rel), settings.DOWNLOAD_CHUNK_SIZE)
+
+    def reopen(offset: int):
+        # Un suscriptor que se quedó COALESCE_MAX_LAG atrás sigue con su propia lectura
+        f, cleanup = backend.open_read(rel)
+        try:
+            f.seek(offset)
+        except BaseException:
+            cleanup()
+            raise
+        return read_ahead(f, cleanup, settings.DOWNLOAD_CHUNK_SIZE)
+
+    try:
+        if settings.COALESCE_READS:
+            max_lag = math.ceil(settings.COALESCE_MAX_LAG / settings.DOWNLOAD_CHUNK_SIZE)
+            body = _download_flights.open((backend.name, target), opener, settings.DOWNLOAD_CHUNK_SIZE, max_lag, reopen)
+        else:
+            f, cleanup = opener()
+            body = SharedStream(f, settings.DOWNLOAD_CHUNK_SIZE, on_close=cleanup).subscribe()
+    except FileNotFoundError:
+        raise HTTPException(404, "No existe")
+    return TransferResponse(
+        shaped(encode(body), Shaper()),
+        media_type="application/octet-stream",
+        headers=headers
+    )
+
+@app.delete(
+    "/delete-file",
+    tags=["Archivos"],
+    summary="Eliminar archivo",
+    description="Elimina un archivo del servidor SFTP. Si la ruta apunta a un directorio, retorna error.",
+    dependencies=[Depends(require_api_key)]
+)
+def delete_file(remote_path: str = Query(..., description="Ruta del archivo a eliminar (relativa a BASE_DIR)", example="/uploads/document.pdf")):
+    rel = relative_path(remote_path)
+    backend = get_router().backend_for(rel)
+    target = backend.join(rel)
     try:
-        target = safe_join(settings.BASE_DIR, remote_path)
-        if is_dir(sftp, target):
-            raise HTTPException(400, "Es un directorio. Usa /delete-dir.")
-        sftp.remove(target)
+        with backend.session() as sftp:
+            if is_dir(sftp, target):
+                raise HTTPException(400, "Es un directorio. Usa /delete-dir.")
+            sftp.remove(target)
+        index_removed(rel)
         return {"ok": True, "deleted": target}
     except FileNotFoundError:
         raise HTTPException(404, "No existe")
-    finally:
-        sftp.close()
 
 @app.delete(
     "/delete-dir",
@@ -278,20 +5460,165 @@ def delete_file(remote_path: str = Query(..., description="Ruta del archivo a el
 )
 def delete_dir(
     remote_path: str = Query(..., description="Ruta del directorio a eliminar (relativa a BASE_DIR)", example="/uploads/2025"),
-    recursive: bool = Query(False, description="Eliminar recursivamente (incluyendo todo el contenido)")
+    recursive: bool = Query(False, description="Eliminar recursivamente (incluyendo todo el contenido)"),
+    x_transfer_id: Optional[str] = Header(None, description="Id elegido por el cliente para seguir el avance en /transfers/{id}/progress")
+):
+    settings = get_settings()
+    target = safe_join(settings.BASE_DIR, remote_path)
+    rel = relative_path(remote_path)
+    with track_transfer(x_transfer_id, "delete", rel) as progress:
+        return remove_dir(rel, target, recursive, progress)
+
+def remove_dir(rel: str, target: str, recursive: bool, progress: Optional[TransferProgress] = None) -> dict:
+    backends = get_router().backends_for_dir(rel)
+
+    def inspect(backend):
+        # None = no existe en este backend; si no, (es_dir, vacío)
+        with backend.session() as sftp:
+            try:
+                if not is_dir(sftp, backend.join(rel)):
+                    return False, False
+                return True, not sftp.listdir(backend.join(rel))
+            except FileNotFoundError:
+                return None
+
+    states = fan_out(backends, inspect)
+    present = [(b, st) for b, st in zip(backends, states) if st is not None]
+    if not present:
+        raise HTTPException(404, "No existe")
+    if any(not dir_ for _, (dir_, _) in present):
+        raise HTTPException(400, "No es un directorio")
+    if not recursive and not all(empty for _, (_, empty) in present):
+        raise HTTPException(400, "Directorio no vacío (usa ?recursive=true)")
+
+    def remove_one(backend):
+        with backend.session() as sftp:
+            if recursive:
+                rmtree_sftp(sftp, backend.join(rel), backend.base_dir, progress)
+            else:
+                sftp.rmdir(backend.join(rel))
+                if progress is not None:
+                    progress.add_item()
+
+    fan_out([b for b, _ in present], remove_one)
+    index_removed(rel)
+    return {"ok": True, "deleted": target, "recursive": recursive}
+
+@app.get(
+    "/transfers/{transfer_id}/progress",
+    tags=["Archivos"],
+    summary="Progreso de una transferencia (SSE)",
+    description="Server-Sent Events con el avance de un `/upload`, `/download` o `/delete-dir` enviado con `X-Transfer-Id`: un evento `progress` cada PROGRESS_INTERVAL (bytes, items, total, tasa y ETA) y al final `done` o `error`. Se puede abrir antes de iniciar la transferencia; el estado final se conserva PROGRESS_RETENTION segundos.",
+    dependencies=[Depends(require_api_key)]
+)
+async def transfer_progress(
+    transfer_id: str,
+    wait: float = Query(30, ge=0, le=300, description="Segundos a esperar a que empiece una transferencia con ese id")
+):
+    progress = await _transfers.get(validate_transfer_id(transfer_id), wait)
+    if progress is None:
+        raise HTTPException(404, "No hay una transferencia con ese id")
+    interval = get_settings().PROGRESS_INTERVAL
+
+    def event(name: str, last: Tuple[int, float]) -> Tuple[str, Tuple[int, float]]:
+        """El evento y el punto (bytes, instante) del snapshot, base de la tasa del siguiente."""
+        snapshot = progress.snapshot()
+        now = time.monotonic()
+        elapsed = now - last[1]
+        rate = (snapshot["bytes"] - last[0]) / elapsed if elapsed > 0 else 0
+        snapshot["rate"] = round(rate)
+        if progress.total and rate > 0 and not snapshot["done"]:
+            snapshot["eta"] = round(max(progress.total - snapshot["bytes"], 0) / rate, 1)
+        return f"event: {name}\ndata: {json.dumps(snapshot)}\n\n", (snapshot["bytes"], now)
+
+    # Generador async: entre eventos espera en el event loop, sin ocupar un thread del pool
+    async def events():
+        # La tasa de cada evento es la del último intervalo; la del primero y el final, desde el inicio
+        last = (0, progress.started)
+        while not progress.done.is_set():
+            text, last = event("progress", last)
+            yield text
+            await progress.wait_done(interval)
+        yield event("error" if progress.error else "done", (0, progress.started))[0]
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+@app.post(
+    "/sync/plan",
+    tags=["Sync"],
+    summary="Planificar mirror de un árbol local",
+    description="Recibe el manifest del árbol local (path, size, mtime, hash opcional) y, tras recorrer en paralelo el árbol remoto bajo `root`, retorna el mínimo de uploads, deletes y mkdirs para dejarlo igual. Un archivo se sube si falta, cambió de tamaño, es más nuevo localmente o su hash difiere del cacheado.",
+    dependencies=[Depends(require_api_key)]
+)
+def sync_plan(request: SyncPlanRequest):
+    settings = get_settings()
+    request.algorithm = validate_algorithm(request.algorithm)
+    root_rel = relative_path(request.root)
+    start = time.monotonic()
+    remote = walk_remote(root_rel, settings.SYNC_WALK_CONCURRENCY)
+    plan = compute_sync_plan(root_rel, request, remote)
+    return {
+        **plan.model_dump(),
+        "remote_entries": len(remote),
+        "local_entries": len(request.entries),
+        "elapsed_ms": round((time.monotonic() - start) * 1000, 1),
+    }
+
+@app.post(
+    "/sync/apply",
+    tags=["Sync"],
+    summary="Aplicar un plan de sync",
+    description="Ejecuta un plan de `/sync/plan`: primero deletes, luego mkdirs y por último uploads, con paralelismo acotado sobre el pool de conexiones. Cada archivo de `uploads` se envía en `files` con su path relativo a `root` como filename.",
+    dependencies=[Depends(require_api_key)]
+)
+def sync_apply(
+    plan: str = Form(..., description='JSON: {"root": "/", "deletes": [{"path": ..., "is_dir": ...}], "mkdirs": [...], "uploads": [...]}'),
+    files: List[UploadFile] = File([], description="Archivos a subir; filename = path relativo a root")
 ):
     settings = get_settings()
-    sftp = sftp_connect()
     try:
-        target = safe_join(settings.BASE_DIR, remote_path)
-        if not is_dir(sftp, target):
-            raise HTTPException(400, "No es un directorio")
-        if recursive:
-            rmtree_sftp(sftp, target)
+        plan = SyncPlan.model_validate_json(plan)
+    except ValueError as exc:
+        raise HTTPException(400, f"Plan inválido: {exc}")
+    root_rel = relative_path(plan.root)
+    key = _client_key.get()  # los threads del pool no heredan el contexto del request
+
+    def full(path):
+        return relative_path(posixpath.join(root_rel, sync_relpath(path)))
+
+    by_path = {sync_relpath(f.filename or ""): f for f in files}
+    uploads = {sync_relpath(p) for p in plan.uploads}
+    unexpected = sorted(set(by_path) - uploads)
+    if unexpected:
+        raise HTTPException(400, f"Archivos que no están en el plan: {unexpected[:10]}")
+
+    errors = []
+    counts = {"deleted": 0, "created": 0, "uploaded": 0}
+    lock = threading.Lock()
+
+    def run(op, path, fn):
+        try:
+            fn()
+        except Exception as exc:
+            detail = exc.detail if isinstance(exc, HTTPException) else (str(exc) or type(exc).__name__)
+            with lock:
+                errors.append({"op": op, "path": path, "error": detail})
         else:
-            if sftp.listdir(target):
-                raise HTTPException(400, "Directorio no vacío (usa ?recursive=true)")
-            sftp.rmdir(target)
-        return {"ok": True, "deleted": target, "recursive": recursive}
-    finally:
-        sftp.close()
+            with lock:
+                counts[op] += 1
+
+    def upload_one(path):
+        fileobj = by_path.get(path)
+        if fileobj is None:
+            raise HTTPException(400, "Falta el archivo en la request")
+        store_file(full(path), fileobj.file, shaper=Shaper(key), size=fileobj.size)
+
+    phases = [
+        ("deleted", [(d.path, lambda d=d: remove_path(full(d.path), d.is_dir)) for d in plan.deletes]),
+        ("created", [(p, lambda p=p: make_dirs(full(p))) for p in plan.mkdirs]),
+        ("uploaded", [(p, lambda p=p: upload_one(sync_relpath(p))) for p in plan.uploads]),
+    ]
+    with ThreadPoolExecutor(max_workers=settings.SYNC_APPLY_PARALLELISM, thread_name_prefix="sftp-sync") as pool:
+        for op, tasks in phases:
+            list(pool.map(lambda task: run(op, task[0], task[1]), tasks))
+    return {"ok": not errors, **counts, "errors": errors}
@@ -0,0 +1,715 @@
+#!/usr/bin/env python3
+"""
+Benchmarks de la API SFTP.
+Usa el mismo entorno que test_suite.py (driver de storage "local" sobre el filesystem
+local y TestClient de FastAPI), así mide el costo de la API y no el de la red.
+
+Uso: python benchmark.py [filtro]
+"""
+
+import os
+import sys
+import json
+import time
+import heapq
+import hashlib
+import shutil
+import socket
+import threading
+from io import BytesIO
+
+# Agregar el directorio actual al path para imports
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app as app_module
+from test_config import TestSettings
+from test_suite import TestRunner
+
+
+def timed(func, repeat):
+    """Mejor tiempo (segundos) de `repeat` ejecuciones de `func`."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+class LatencyProxy:
+    """Proxy TCP que retrasa cada segmento `rtt / 2` por sentido, para simular red."""
+
+    def __init__(self, target_port, rtt=0.0):
+        self.target_port = target_port
+        self.delay = rtt / 2
+        self.sock = socket.create_server(("127.0.0.1", 0))
+        self.port = self.sock.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            upstream = socket.create_connection(("127.0.0.1", self.target_port))
+            for src, dst in ((client, upstream), (upstream, client)):
+                threading.Thread(target=self._pump, args=(src, dst), daemon=True).start()
+
+    def _pump(self, src, dst):
+        # Lector y escritor separados: el retraso es latencia, no límite de throughput
+        pending, cond, done = [], threading.Condition(), []
+
+        def writer():
+            while True:
+                with cond:
+                    while not pending and not done:
+                        cond.wait()
+                    if not pending:
+                        break
+                    due, _, data = pending[0]
+                    wait = due - time.monotonic()
+                    if wait > 0:
+                        cond.wait(wait)
+                        continue
+                    heapq.heappop(pending)
+                try:
+                    dst.sendall(data)
+                except OSError:
+                    break
+            try:
+                dst.shutdown(socket.SHUT_WR)
+            except OSError:
+                pass
+
+        threading.Thread(target=writer, daemon=True).start()
+        seq = 0
+        while True:
+            try:
+                data = src.recv(256 * 1024)
+            except OSError:
+                data = b""
+            with cond:
+                if not data:
+                    done.append(True)
+                    cond.notify()
+                    return
+                seq += 1
+                heapq.heappush(pending, (time.monotonic() + self.delay, seq, data))
+                cond.notify()
+
+    def close(self):
+        self.sock.close()
+
+
+class BenchmarkRunner:
+    """Ejecuta los benchmarks y reporta una fila por medición."""
+
+    def __init__(self):
+        self.env = TestRunner()
+        self.results = []
+
+    def setup(self):
+        self.env.setup()
+        self.client = self.env.client
+        self.headers = {"X-API-Key": TestSettings.API_KEY}
+
+    def teardown(self):
+        self.env.teardown()
+
+    def report(self, name, value, unit, baseline=None):
+        overhead = f"{(value / baseline - 1) * 100:+.1f}%" if baseline else ""
+        self.results.append((name, value, unit, overhead))
+        print(f"   {name:<45} {value:>12.2f} {unit:<8} {overhead}")
+
+    # ------------- Ancho de banda -------------
+    def bench_shaper_throttle(self):
+        """Costo por chunk de Shaper.throttle, sin límites y con límites que no llegan a frenar."""
+        calls = 200_000
+
+        def run():
+            shaper = app_module.Shaper("valid")
+            for _ in range(calls):
+                shaper.throttle(1024)
+            shaper.close()
+
+        base = timed(run, 3) / calls * 1e9
+        self.report("throttle() sin límites", base, "ns/call")
+        with self.env._override_settings(BANDWIDTH_PER_TRANSFER=10**12, BANDWIDTH_PER_KEY=10**12, BANDWIDTH_GLOBAL=10**12):
+            shaped = timed(run, 3) / calls * 1e9
+        self.report("throttle() transfer+key+global", shaped, "ns/call", base)
+        token = app_module._transfer_progress.set(app_module.TransferProgress("bench", "upload", "/"))
+        try:
+            tracked = timed(run, 3) / calls * 1e9
+        finally:
+            app_module._transfer_progress.reset(token)
+        self.report("throttle() con X-Transfer-Id", tracked, "ns/call", base)
+
+    def bench_transfer_shaping(self):
+        """Throughput de /upload y /download con y sin shaping (límites altos: solo overhead)."""
+        size = 32 * 1024 * 1024
+        data = os.urandom(size)
+        limits = {"BANDWIDTH_PER_TRANSFER": 10**12, "BANDWIDTH_PER_KEY": 10**12, "BANDWIDTH_GLOBAL": 10**12}
+
+        def upload():
+            response = self.client.post(
+                "/upload", headers=self.headers, data={"remote_path": "/bench/data.bin"},
+                files={"file": ("data.bin", BytesIO(data), "application/octet-stream")}
+            )
+            assert response.status_code == 200
+
+        def download():
+            response = self.client.get("/download?remote_path=/bench/data.bin", headers=self.headers)
+            assert len(response.content) == size
+
+        try:
+            mb = size / (1024 * 1024)
+            for name, func in (("upload", upload), ("download", download)):
+                with self.env._override_settings(DOWNLOAD_CHUNK_SIZE=256 * 1024):
+                    base = mb / timed(func, 3)
+                with self.env._override_settings(DOWNLOAD_CHUNK_SIZE=256 * 1024, **limits):
+                    shaped = mb / timed(func, 3)
+                self.report(f"{name} 32 MiB sin shaping", base, "MiB/s")
+                self.report(f"{name} 32 MiB con shaping", shaped, "MiB/s", base)
+        finally:
+            shutil.rmtree(self.env.base_dir / "bench", ignore_errors=True)
+
+    # ------------- Espejo local -------------
+    def bench_local_mirror(self):
+        """
+        /download y /upload de 32 MiB por el cliente SFTP vs directo al montaje local.
+        El driver local ya lee del disco, así que esto mide solo el overhead de la API;
+        contra un servidor real se ahorra además el cifrado SSH (ver "Transporte SSH").
+        """
+        size = 32 * 1024 * 1024
+        data = os.urandom(size)
+        folder = self.env.base_dir / "bench"
+        folder.mkdir(exist_ok=True)
+        (folder / "data.bin").write_bytes(data)
+        mb = size / (1024 * 1024)
+
+        def upload():
+            response = self.client.post(
+                "/upload", headers=self.headers, data={"remote_path": "/bench/up.bin"},
+                files={"file": ("up.bin", BytesIO(data), "application/octet-stream")}
+            )
+            assert response.status_code == 200
+
+        def download():
+            response = self.client.get("/download?remote_path=/bench/data.bin", headers=self.headers)
+            assert len(response.content) == size
+
+        try:
+            for name, func in (("upload", upload), ("download", download)):
+                with self.env._override_settings(DOWNLOAD_CHUNK_SIZE=256 * 1024):
+                    base = mb / timed(func, 3)
+                with self.env._override_settings(DOWNLOAD_CHUNK_SIZE=256 * 1024, SFTP_LOCAL_DIR=str(self.env.base_dir)):
+                    local = mb / timed(func, 3)
+                self.report(f"{name} 32 MiB por SFTP", base, "MiB/s")
+                self.report(f"{name} 32 MiB espejo local", local, "MiB/s", base)
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # ------------- Pipeline de upload -------------
+    def bench_upload_pipeline(self):
+        """
+        /upload de 32 MiB con distintas etapas del pipeline, contra el flujo anterior:
+        subir y después pedir el hash. Con el driver local esa relectura sale del page
+        cache; contra un servidor SFTP es otra descarga completa por la red.
+        """
+        size = 32 * 1024 * 1024
+        data = os.urandom(size)
+        mb = size / (1024 * 1024)
+
+        def upload(**form):
+            response = self.client.post(
+                "/upload", headers=self.headers, data={"remote_path": "/bench-pipe/up.bin", **form},
+                files={"file": ("up.bin", BytesIO(data), "application/octet-stream")}
+            )
+            assert response.status_code == 200, response.text
+
+        def upload_then_hash():
+            upload()
+            response = self.client.get("/checksum?path=/bench-pipe/up.bin&algorithm=sha256", headers=self.headers)
+            assert response.status_code == 200, response.text
+
+        cases = [
+            ("sin etapas", {"UPLOAD_SNIFF": False}, lambda: upload()),
+            ("size + sniff (default)", {}, lambda: upload()),
+            ("+ sha256 inline", {}, lambda: upload(checksum="sha256")),
+            ("+ sha256 y md5 inline", {"UPLOAD_HASHES": ["md5"]}, lambda: upload(checksum="sha256")),
+            ("+ antivirus por stdin (cat)", {"UPLOAD_SCAN_COMMAND": "sh -c 'cat > /dev/null'"}, lambda: upload()),
+            ("upload y después /checksum", {}, upload_then_hash),
+        ]
+        try:
+            baseline = None
+            for label, overrides, func in cases:
+                with self.env._override_settings(**overrides):
+                    value = mb / timed(func, 3)
+                self.report(f"upload 32 MiB {label}", value, "MiB/s", baseline)
+                baseline = baseline or value
+        finally:
+            shutil.rmtree(self.env.base_dir / "bench-pipe", ignore_errors=True)
+
+    def bench_conditional_upload(self):
+        """
+        Reintento de un /upload de 32 MiB que ya llegó: subir de nuevo, con content_hash
+        (el hash quedó cacheado por el primer upload) y con Idempotency-Key. El cliente
+        igual envía el cuerpo; lo que se ahorra es la escritura al backend.
+        """
+        size = 32 * 1024 * 1024
+        data = os.urandom(size)
+        digest = hashlib.sha256(data).hexdigest()
+
+        def upload(extra=None, **form):
+            response = self.client.post(
+                "/upload", headers={**self.headers, **(extra or {})}, data={"remote_path": "/bench-cond/up.bin", **form},
+                files={"file": ("up.bin", BytesIO(data), "application/octet-stream")}
+            )
+            assert response.status_code == 200, response.text
+            return response.json()
+
+        try:
+            baseline = 1000 * timed(lambda: upload(), 3)
+            self.report("reintento 32 MiB re-subiendo", baseline, "ms")
+            # El upload que llega con content_hash deja el hash en cache para los reintentos
+            upload(content_hash=f"sha256:{digest}")
+            assert upload(content_hash=f"sha256:{digest}")["skipped"]
+            self.report("reintento 32 MiB con content_hash", 1000 * timed(lambda: upload(content_hash=f"sha256:{digest}"), 3), "ms", baseline)
+            upload({"Idempotency-Key": "bench"})
+            self.report("reintento 32 MiB con Idempotency-Key", 1000 * timed(lambda: upload({"Idempotency-Key": "bench"}), 3), "ms", baseline)
+        finally:
+            shutil.rmtree(self.env.base_dir / "bench-cond", ignore_errors=True)
+
+    # ------------- Storage drivers -------------
+    def bench_storage_drivers(self):
+        """Ciclo upload/stat/download/delete de 64 KiB con el driver local vs memory (costo propio de la API)."""
+        data = os.urandom(64 * 1024)
+
+        def cycle():
+            for i in range(50):
+                path = f"/bench-drivers/f{i}.bin"
+                response = self.client.post(
+                    "/upload", headers=self.headers, data={"remote_path": path},
+                    files={"file": ("f.bin", BytesIO(data), "application/octet-stream")}
+                )
+                assert response.status_code == 200
+                assert self.client.get(f"/stat?path={path}", headers=self.headers).status_code == 200
+                assert len(self.client.get(f"/download?remote_path={path}", headers=self.headers).content) == len(data)
+                assert self.client.delete(f"/delete-file?remote_path={path}", headers=self.headers).status_code == 200
+
+        try:
+            base = None
+            for driver in ("local", "memory"):
+                with self.env._override_settings(SFTP_DRIVER=driver, BASE_DIR=str(self.env.base_dir)):
+                    value = timed(cycle, 3) / 50 * 1000
+                self.report(f"ciclo 64 KiB driver {driver}", value, "ms", base)
+                base = base or value
+        finally:
+            shutil.rmtree(self.env.base_dir / "bench-drivers", ignore_errors=True)
+
+    # ------------- Listados -------------
+    def bench_listing_formats(self):
+        """/list de un directorio de 100k entradas (desde el cache de listados): CPU y tamaño por formato."""
+        from fastapi.encoders import jsonable_encoder
+
+        entries = int(os.getenv("BENCH_LIST_ENTRIES", "100000"))
+        folder = self.env.base_dir / "bench"
+        folder.mkdir(exist_ok=True)
+        for i in range(entries):
+            (folder / f"registro-{i:06d}.csv").touch()
+        try:
+            with self.env._override_settings(METADATA_CACHE_TTL=3600):
+                items = app_module.list_directory("bench")
+                payload = {"path": "/bench", "items": items}
+
+                # Lo que hacía FastAPI con el dict retornado: jsonable_encoder + json.dumps
+                def encoder():
+                    body = json.dumps(jsonable_encoder(payload), ensure_ascii=False, separators=(",", ":")).encode()
+                    sizes["jsonable_encoder"] = len(body)
+
+                sizes = {}
+                baseline = timed(encoder, 3) * 1000
+                self.report("jsonable_encoder + json (antes)", baseline, "ms")
+                self.report("jsonable_encoder + json tamaño", sizes["jsonable_encoder"] / 1024, "KiB")
+
+                formats = ["objects", "columnar"] + (["msgpack"] if app_module.msgpack is not None else [])
+                for fmt in formats:
+                    def request():
+                        response = self.client.get(f"/list?path=/bench&format={fmt}",
+                                                   headers={**self.headers, "Accept-Encoding": "identity"})
+                        assert response.status_code == 200
+                        sizes[fmt] = len(response.content)
+
+                    def serialize():
+                        app_module.listing_response({"path": "/bench"}, items, fmt, None)
+
+                    self.report(f"serialización {fmt}", timed(serialize, 3) * 1000, "ms", baseline)
+                    self.report(f"/list {fmt} (request completo)", timed(request, 3) * 1000, "ms")
+                    self.report(f"/list {fmt} tamaño", sizes[fmt] / 1024, "KiB", sizes["jsonable_encoder"] / 1024)
+
+                orjson, app_module.orjson = app_module.orjson, None
+                try:
+                    value = timed(lambda: app_module.listing_response({"path": "/bench"}, items, "objects", None), 3) * 1000
+                    self.report("serialización objects sin orjson", value, "ms", baseline)
+                finally:
+                    app_module.orjson = orjson
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # ------------- Compresión HTTP -------------
+    def bench_compression(self):
+        """/download de un CSV de 32 MiB: throughput y bytes en el cable por codificación."""
+        row = b"12345,paciente-12345,2025-01-01T10:00:00,consulta,ok,0.75\n"
+        data = row * (32 * 1024 * 1024 // len(row))
+        folder = self.env.base_dir / "bench"
+        folder.mkdir(exist_ok=True)
+        (folder / "data.csv").write_bytes(data)
+        mb = len(data) / (1024 * 1024)
+        try:
+            baseline = None
+            for encoding in ["identity", *app_module.ENCODERS]:
+                headers = {**self.headers, "Accept-Encoding": encoding}
+                sizes = []
+
+                def download():
+                    response = self.client.get("/download?remote_path=/bench/data.csv", headers=headers)
+                    assert response.content == data
+                    sizes.append(response.num_bytes_downloaded)
+
+                with self.env._override_settings(DOWNLOAD_CHUNK_SIZE=256 * 1024):
+                    value = mb / timed(download, 3)
+                self.report(f"download CSV {encoding}", value, "MiB/s", baseline)
+                self.report(f"download CSV {encoding} en el cable", sizes[-1] / (1024 * 1024), "MiB")
+                baseline = baseline or value
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    # ------------- Transporte SSH -------------
+    def bench_ssh_matrix(self):
+        """Throughput de put/get por SFTP real (servidor mock) para varias configuraciones de transporte.
+
+        BENCH_SSH_RTT_MS simula latencia de red con un proxy (default 0: loopback).
+        Ojo: el servidor mock es Python puro; en loopback mide sobre todo CPU de cifrado.
+        """
+        from mock_sftp_server import MockSFTPServer, get_free_port
+
+        size = int(os.getenv("BENCH_SSH_MB", "16")) * 1024 * 1024
+        rtt = float(os.getenv("BENCH_SSH_RTT_MS", "0")) / 1000
+        data = os.urandom(size // 2) + bytes(size - size // 2)  # mitad comprimible
+        matrix = [
+            ("defaults de Paramiko", {}, False),
+            ("aes128-ctr", {"SSH_CIPHERS": ["aes128-ctr"]}, False),
+            ("aes256-ctr", {"SSH_CIPHERS": ["aes256-ctr"]}, False),
+            ("aes128-gcm", {"SSH_CIPHERS": ["aes128-gcm@openssh.com"]}, False),
+            ("aes256-gcm", {"SSH_CIPHERS": ["aes256-gcm@openssh.com"]}, False),
+            ("aes128-ctr + etm", {"SSH_CIPHERS": ["aes128-ctr"], "SSH_MACS": ["hmac-sha2-256-etm@openssh.com"]}, False),
+            ("aes128-gcm + zlib", {"SSH_CIPHERS": ["aes128-gcm@openssh.com"], "SSH_COMPRESSION": True}, True),
+            ("aes128-gcm + ventana 8 MiB", {"SSH_CIPHERS": ["aes128-gcm@openssh.com"],
+                                            "SSH_WINDOW_SIZE": 8 * 1024 * 1024, "SSH_MAX_PACKET_SIZE": 32768}, False),
+        ]
+        mb = size / (1024 * 1024)
+        baseline = {}
+        for label, overrides, compression in matrix:
+            server = MockSFTPServer(port=get_free_port(), compression=compression)
+            server.start()
+            proxy = LatencyProxy(server.port, rtt)
+            config = app_module.BackendConfig(host="127.0.0.1", port=proxy.port, user=server.username, password=server.password)
+            try:
+                with self.env._override_settings(**overrides):
+                    start = time.perf_counter()
+                    sftp = app_module.sftp_connect(config)
+                    handshake = time.perf_counter() - start
+                    try:
+                        start = time.perf_counter()
+                        with sftp.open("/bench.bin", "wb") as f:
+                            f.set_pipelined(True)
+                            for offset in range(0, size, 256 * 1024):
+                                f.write(data[offset:offset + 256 * 1024])
+                        put = mb / (time.perf_counter() - start)
+                        start = time.perf_counter()
+                        with sftp.open("/bench.bin", "rb") as f:
+                            f.prefetch(size)
+                            received = f.read()
+                        get = mb / (time.perf_counter() - start)
+                        assert len(received) == size
+                    finally:
+                        sftp.get_channel().get_transport().close()
+            finally:
+                proxy.close()
+                server.stop()
+            for name, value in (("put", put), ("get", get)):
+                self.report(f"{label} {name}", value, "MiB/s", baseline.get(name))
+                baseline.setdefault(name, value)
+            self.report(f"{label} handshake", handshake * 1000, "ms")
+
+    def bench_ring_buffer(self):
+        """
+        /upload y /download por SFTP real (servidor mock detrás del proxy de latencia)
+        con el lado HTTP simulado: lectura y escritura en lockstep vs con el ring de
+        TRANSFER_RING_SLOTS buffers. En lockstep los tiempos de los dos lados se suman;
+        con el ring se solapan. Por defecto el lado HTTP va a la velocidad medida del
+        lado SFTP (el peor caso del lockstep); BENCH_RING_HTTP_MBPS la fija. El download
+        se mide además sin lado HTTP, donde solo pesa lo que cuesta leer por adelantado:
+        ReadAhead (lo que usa /download) contra RingReader, que copia cada slot a bytes
+        propios para SharedStream.
+        """
+        from mock_sftp_server import MockSFTPServer, get_free_port
+
+        size = int(os.getenv("BENCH_RING_MB", "2")) * 1024 * 1024
+        rtt = float(os.getenv("BENCH_RING_RTT_MS", "2")) / 1000
+        http_mbps = float(os.getenv("BENCH_RING_HTTP_MBPS", "0"))
+        per_mib = 0.0
+        chunk_size = 256 * 1024  # varios chunks en pocos MiB: el llenado/vaciado del ring no domina
+        data = os.urandom(size)
+        mb = size / (1024 * 1024)
+
+        class SlowBody(BytesIO):
+            """Body de un request que llega a la velocidad simulada del lado HTTP."""
+
+            def readinto(self, buffer):
+                n = super().readinto(buffer)
+                time.sleep(n / (1024 * 1024) * per_mib)
+                return n
+
+            def read(self, size=-1):
+                chunk = super().read(size)
+                time.sleep(len(chunk) / (1024 * 1024) * per_mib)
+                return chunk
+
+        def upload():
+            # El loop de store_file (el mock no implementa chmod)
+            backend = app_module.get_router().backend_for("/ring.bin")
+            with backend.session() as sftp, sftp.open("/ring.bin", "wb") as dst, \
+                    app_module.body_chunks(SlowBody(data), chunk_size) as chunks:
+                for chunk in chunks:
+                    dst.write(chunk)
+
+        def download(reader=None):
+            backend = app_module.get_router().backend_for("/ring.bin")
+            if reader is None:
+                f, cleanup = app_module.read_ahead(*backend.open_read("/ring.bin"), chunk_size)
+            else:
+                source, close = backend.open_read("/ring.bin")
+                f = reader(source, chunk_size, 4)
+
+                def cleanup():
+                    source.close()
+                    close()
+            received = 0
+            for chunk in app_module.SharedStream(f, chunk_size, on_close=cleanup).subscribe():
+                received += len(chunk)
+                time.sleep(len(chunk) / (1024 * 1024) * per_mib)  # cliente HTTP
+            assert received == size
+
+        server = MockSFTPServer(port=get_free_port())
+        server.start()
+        proxy = LatencyProxy(server.port, rtt)
+        connection = {"SFTP_DRIVER": "sftp", "SFTP_HOST": "127.0.0.1", "SFTP_PORT": proxy.port,
+                      "SFTP_USER": server.username, "SFTP_PASS": server.password, "BASE_DIR": "/"}
+        try:
+            for name, func in (("upload", upload), ("download", download)):
+                per_mib = 0.0
+                with self.env._override_settings(TRANSFER_RING_SLOTS=0, **connection):
+                    sftp_only = mb / timed(func, 1)
+                self.report(f"{name} {int(mb)} MiB solo lado SFTP", sftp_only, "MiB/s")
+                per_mib = 1 / (http_mbps or sftp_only)
+                baseline = None
+                for label, slots in (("lockstep", 0), ("ring 4 slots", 4)):
+                    with self.env._override_settings(TRANSFER_RING_SLOTS=slots, **connection):
+                        value = mb / timed(func, 2)
+                    self.report(f"{name} {int(mb)} MiB {label}", value, "MiB/s", baseline)
+                    baseline = baseline or value
+            per_mib = 0.0
+            with self.env._override_settings(TRANSFER_RING_SLOTS=0, **connection):
+                baseline = mb / timed(download, 3)
+                self.report(f"download {int(mb)} MiB sin HTTP lockstep", baseline, "MiB/s")
+                for label, reader in (("RingReader (copia)", app_module.RingReader),
+                                      ("ReadAhead", app_module.ReadAhead)):
+                    value = mb / timed(lambda: download(reader), 3)
+                    self.report(f"download {int(mb)} MiB sin HTTP {label}", value, "MiB/s", baseline)
+        finally:
+            app_module.reset_backends()
+            proxy.close()
+            server.stop()
+
+    def bench_ssh_handshake(self):
+        """Tiempo de conexión (TCP + KEX + auth + canal SFTP) con password vs clave, con y sin host key fijada."""
+        import tempfile
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from mock_sftp_server import MockSFTPServer, get_free_port
+
+        repeat = int(os.getenv("BENCH_SSH_HANDSHAKES", "10"))
+        rtt = float(os.getenv("BENCH_SSH_RTT_MS", "0")) / 1000
+        tmp = tempfile.mkdtemp(prefix="bench_keys_")
+        try:
+            def ed25519_file(name, passphrase=None):
+                encryption = (serialization.BestAvailableEncryption(passphrase) if passphrase
+                              else serialization.NoEncryption())
+                key = ed25519.Ed25519PrivateKey.generate()
+                path = os.path.join(tmp, name)
+                with open(path, "wb") as f:
+                    f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH, encryption))
+                return path
+
+            client_path = ed25519_file("id_ed25519", b"bench")
+            client_key = app_module.paramiko.PKey.from_path(client_path, b"bench")
+            host_key = app_module.paramiko.PKey.from_path(ed25519_file("host_ed25519"))
+            pinned = f"{host_key.get_name()} {host_key.get_base64()}"
+
+            # Parseo de la clave (bcrypt KDF): lo que se ahorra cada conexión gracias al cache
+            parse = timed(lambda: app_module.paramiko.PKey.from_path(client_path, b"bench"), 3) * 1000
+            self.report("parseo clave Ed25519 cifrada", parse, "ms")
+            cached = timed(lambda: app_module.load_private_key(client_path, "bench"), 1000) * 1e6
+            self.report("load_private_key cacheada", cached, "µs")
+
+            server = MockSFTPServer(port=get_free_port(), authorized_keys=[client_key], host_key=host_key)
+            server.start()
+            proxy = LatencyProxy(server.port, rtt)
+            config = app_module.BackendConfig(host="127.0.0.1", port=proxy.port, user=server.username, password=server.password)
+            matrix = [
+                ("password", {}),
+                ("password + host key fijada", {"SFTP_HOST_KEY": pinned}),
+                ("clave Ed25519", {"SFTP_KEY_FILE": client_path, "SFTP_KEY_PASSPHRASE": "bench"}),
+                ("clave Ed25519 + host key fijada", {"SFTP_KEY_FILE": client_path, "SFTP_KEY_PASSPHRASE": "bench",
+                                                     "SFTP_HOST_KEY": pinned}),
+            ]
+            baseline = None
+            try:
+                for label, overrides in matrix:
+                    with self.env._override_settings(**overrides):
+                        node = config.model_copy(update={
+                            "key_file": overrides.get("SFTP_KEY_FILE", ""), "host_key": overrides.get("SFTP_HOST_KEY", ""),
+                        })
+                        app_module.preload_ssh_credentials()
+                        samples = []
+                        for _ in range(repeat):
+                            start = time.perf_counter()
+                            sftp = app_module.sftp_connect(node)
+                            samples.append(time.perf_counter() - start)
+                            sftp.get_channel().get_transport().close()
+                            time.sleep(0.2)  # el mock atiende una conexión a la vez
+                    value = sorted(samples)[len(samples) // 2] * 1000
+                    self.report(f"handshake {label}", value, "ms p50", baseline)
+                    baseline = baseline or value
+            finally:
+                proxy.close()
+                server.stop()
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    # ------------- Arranque -------------
+    def bench_startup(self):
+        """
+        Arranque en frío, cada medición en un intérprete nuevo: desglose de `import app`
+        (-X importtime: cuerpo del módulo e imports directos) y tiempo hasta el primer
+        /healthz con y sin LAZY_STARTUP, con una clave SSH cifrada y 2 transfer workers.
+        """
+        import subprocess
+        import tempfile
+        from cryptography.hazmat.primitives import serialization
+        from cryptography.hazmat.primitives.asymmetric import ed25519
+        from mock_sftp_server import get_free_port
+
+        runs = int(os.getenv("BENCH_STARTUP_RUNS", "5"))
+        here = os.path.dirname(os.path.abspath(__file__))
+        tmp = tempfile.mkdtemp(prefix="bench_startup_")
+
+        def python(code, env=None, flags=()):
+            # cwd vacío: que Settings no lea un .env del repo
+            result = subprocess.run(
+                [sys.executable, *flags, "-c", code], cwd=tmp, capture_output=True, text=True, timeout=120,
+                env={**os.environ, "PYTHONPATH": here, **(env or {})},
+            )
+            assert result.returncode == 0, result.stderr
+            return result
+
+        try:
+            breakdown = {}
+            for _ in range(runs):
+                for line in python("import app", flags=("-X", "importtime")).stderr.splitlines():
+                    if not line.startswith("import time:") or line.endswith("| imported package"):
+                        continue
+                    self_us, cumulative_us, name = line[len("import time:"):].split("|")
+                    if name.strip() == "app":
+                        key, value = "app (cuerpo del módulo)", int(self_us)
+                    elif name.startswith("   ") and not name.startswith("    "):
+                        key, value = name.strip(), int(cumulative_us)  # import directo de app
+                    else:
+                        continue
+                    breakdown[key] = min(breakdown.get(key, value), value)
+            total = timed(lambda: python("import app"), runs) * 1000
+            self.report("import app (proceso completo)", total, "ms")
+            for name, value in sorted(breakdown.items(), key=lambda kv: -kv[1])[:8]:
+                self.report(f"  {name}", value / 1000, "ms")
+            lazy = json.loads(python(
+                "import time, json; start = time.perf_counter(); import app; imported = time.perf_counter()\n"
+                "app.paramiko.Transport; print(json.dumps([imported - start, time.perf_counter() - imported]))"
+            ).stdout)
+            self.report("  paramiko (diferido al primer uso)", lazy[1] * 1000, "ms")
+
+            key_path = os.path.join(tmp, "id_ed25519")
+            with open(key_path, "wb") as f:
+                f.write(ed25519.Ed25519PrivateKey.generate().private_bytes(
+                    serialization.Encoding.PEM, serialization.PrivateFormat.OpenSSH,
+                    serialization.BestAvailableEncryption(b"bench"),
+                ))
+            env = {
+                "SFTP_PORT": str(get_free_port()), "SFTP_KEY_FILE": key_path, "SFTP_KEY_PASSPHRASE": "bench",
+                "TRANSFER_WORKERS": "2", "WARMUP_INTERVAL": "0",
+            }
+            first_healthz = (
+                "import time; start = time.perf_counter()\n"
+                "import app\n"
+                "from fastapi.testclient import TestClient\n"
+                "with TestClient(app.app) as client:\n"
+                "    assert client.get('/healthz').status_code == 200\n"
+                "    print(time.perf_counter() - start)\n"
+            )
+            baseline = None
+            for label, lazy_startup in (("arranque completo", "false"), ("LAZY_STARTUP", "true")):
+                samples = [float(python(first_healthz, {**env, "LAZY_STARTUP": lazy_startup}).stdout) for _ in range(runs)]
+                value = min(samples) * 1000
+                self.report(f"primer /healthz {label}", value, "ms", baseline)
+                baseline = baseline or value
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def run_all_benchmarks(self, selected=None):
+        benchmarks = [
+            ("Ancho de banda - Shaper", self.bench_shaper_throttle),
+            ("Ancho de banda - Upload/Download", self.bench_transfer_shaping),
+            ("Espejo local - Upload/Download", self.bench_local_mirror),
+            ("Storage - Drivers local/memory", self.bench_storage_drivers),
+            ("Upload - Pipeline 32 MiB", self.bench_upload_pipeline),
+            ("Upload - Reintentos condicionales", self.bench_conditional_upload),
+            ("Listados - Formatos 100k entradas", self.bench_listing_formats),
+            ("Compresión - Download CSV", self.bench_compression),
+            ("Transporte SSH - Matriz", self.bench_ssh_matrix),
+            ("Transporte SSH - Handshake", self.bench_ssh_handshake),
+            ("Transporte SSH - Ring de buffers", self.bench_ring_buffer),
+            ("Arranque - Import y primer /healthz", self.bench_startup),
+        ]
+        for name, func in benchmarks:
+            if selected and selected.lower() not in name.lower():
+                continue
+            print(f"\n⏱️  {name}")
+            func()
+        return self.results
+
+
+def main():
+    """Función principal."""
+    runner = BenchmarkRunner()
+    try:
+        runner.setup()
+        runner.run_all_benchmarks(sys.argv[1] if len(sys.argv) > 1 else None)
+        return 0
+    finally:
+        runner.teardown()
+
+
+if __name__ == "__main__":
+    exit(main())
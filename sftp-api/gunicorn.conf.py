@@ -0,0 +1,22 @@
+# Configuración de gunicorn para correr la API con varios workers uvicorn.
+# Uso: gunicorn -c gunicorn.conf.py app:app
+#
+# Cada worker es un proceso con su propio pool SFTP: fija SFTP_SESSION_BUDGET
+# para repartir un total de sesiones por nodo entre los WEB_CONCURRENCY workers,
+# y METADATA_CACHE_SHARED para que compartan el cache de listados/stats.
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '8080')}"
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+
+# Sin preload: Paramiko abre sockets y threads que no deben heredarse por fork
+preload_app = False
+
+# Descargas grandes pueden tardar; el timeout solo aplica a workers colgados
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = 30
+keepalive = 5
+
+accesslog = "-"
+errorlog = "-"
@@ -211,14 +211,23 @@ class MockSFTPServerInterface(paramiko.SFTPServerInterface):
 class MockSSHServer(paramiko.ServerInterface):
     """Servidor SSH para el mock SFTP."""
     
-    def __init__(self, username, password):
+    def __init__(self, username, password, authorized_keys=()):
         self.username = username
         self.password = password
-    
+        self.authorized_keys = authorized_keys
+
+    def get_allowed_auths(self, username):
+        return "password,publickey" if self.authorized_keys else "password"
+
     def check_auth_password(self, username, password):
         if username == self.username and password == self.password:
             return paramiko.AUTH_SUCCESSFUL
         return paramiko.AUTH_FAILED
+
+    def check_auth_publickey(self, username, key):
+        if username == self.username and any(key.asbytes() == k.asbytes() for k in self.authorized_keys):
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
     
     def check_channel_request(self, kind, chanid):
         if kind == 'session':
@@ -229,11 +238,14 @@ class MockSSHServer(paramiko.ServerInterface):
 class MockSFTPServer:
     """Servidor SFTP mock que corre en thread separado."""
     
-    def __init__(self, host="127.0.0.1", port=2222, username="testuser", password="testpass"):
+    def __init__(self, host="127.0.0.1", port=2222, username="testuser", password="testpass", compression=False,
+                 authorized_keys=(), host_key=None):
         self.host = host
         self.port = port
         self.username = username
         self.password = password
+        self.compression = compression
+        self.authorized_keys = list(authorized_keys)
         self.thread = None
         self.running = False
         self._stop_event = threading.Event()
@@ -241,8 +253,8 @@ class MockSFTPServer:
         self._interface_instances = []
         self.base_dir = None
         
-        # Generar claves RSA para el servidor
-        self.host_key = paramiko.RSAKey.generate(2048)
+        # Generar claves RSA para el servidor (o usar la recibida)
+        self.host_key = host_key or paramiko.RSAKey.generate(2048)
 
     def start(self):
         """Inicia el servidor SFTP en un thread separado."""
@@ -304,11 +316,13 @@ class MockSFTPServer:
                     try:
                         transport = paramiko.Transport(client)
                         transport.add_server_key(self.host_key)
+                        transport.use_compression(self.compression)
 
                         # Configurar servidor SSH
                         ssh_server = MockSSHServer(
                             self.username,
                             self.password,
+                            self.authorized_keys,
                         )
                         transport.set_subsystem_handler(
                             "sftp",
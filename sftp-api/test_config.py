@@ -20,6 +20,128 @@ class TestSettings:
     SFTP_USER = "testuser"
     SFTP_PASS = "testpass"
     BASE_DIR = "/test"  # Ruta en el mock server
+    SFTP_DRIVER = "local"  # la suite corre sobre un directorio temporal
+    SFTP_KEY_FILE = ""
+    SFTP_KEY_PASSPHRASE = ""
+    SFTP_USE_AGENT = False
+    SFTP_HOST_KEY = ""
+    SFTP_KNOWN_HOSTS = ""
+    SFTP_LOCAL_DIR = ""
+
+    # Coalescing de lecturas
+    COALESCE_READS = True
+    COALESCE_MAX_LAG = 16 * 1024 * 1024
+    DOWNLOAD_CHUNK_SIZE = 32768
+
+    # Backends SFTP
+    SFTP_BACKENDS = {}
+    SFTP_ROUTING = "prefix"
+    SFTP_ROUTES = {}
+    SFTP_DEFAULT_BACKEND = "default"
+    SFTP_POOL_SIZE = 4
+    SFTP_POOL_TIMEOUT = 5.0
+    SSH_CIPHERS = []
+    SSH_KEX = []
+    SSH_MACS = []
+    SSH_COMPRESSION = False
+    SSH_WINDOW_SIZE = 0
+    SSH_MAX_PACKET_SIZE = 0
+    WEB_CONCURRENCY = 1
+    SFTP_SESSION_BUDGET = 0
+    TRANSFER_WORKERS = 0
+    TRANSFER_MIN_BYTES = 64 * 1024
+    TRANSFER_RING_SLOTS = 4
+    TRANSFER_RING_POOL = 8
+    SFTP_HEALTHCHECK_INTERVAL = 0
+    SFTP_REPLICAS = []
+    SFTP_READ_STRATEGY = "least_outstanding"
+    SFTP_READ_FROM_PRIMARY = True
+    SFTP_BREAKER_THRESHOLD = 3
+    SFTP_BREAKER_COOLDOWN = 30.0
+
+    # Checksums
+    CHECKSUM_REMOTE_EXEC = True
+    CHECKSUM_EXEC_TIMEOUT = 5.0
+
+    # Subidas delta
+    DELTA_MIN_BLOCK_SIZE = 1024
+    DELTA_MAX_BLOCK_SIZE = 16 * 1024 * 1024
+
+    # Sync
+    SYNC_WALK_CONCURRENCY = 4
+    SYNC_APPLY_PARALLELISM = 4
+    SYNC_MTIME_TOLERANCE = 2.0
+
+    # Índice de metadatos
+    INDEX_DB = ""
+    INDEX_CRAWL_INTERVAL = 0
+    INDEX_CRAWL_CONCURRENCY = 4
+    INDEX_INCREMENTAL_INTERVAL = 0
+    CHANGES_RETENTION = 1000
+    CHANGES_MAX_WAIT = 5.0
+
+    # Warmup y cachés
+    WARMUP_POOL_CONNECTIONS = 1
+    WARMUP_PATHS = []
+    WARMUP_FILES = []
+    WARMUP_INTERVAL = 0
+    LAZY_STARTUP = False
+    OPENAPI_SCHEMA_FILE = ""
+    METADATA_CACHE_TTL = 0
+    METADATA_CACHE_SHARED = ""
+    FILE_CACHE_DIR = ""
+    FILE_CACHE_MAX_BYTES = 10 * 1024 * 1024
+
+    # Readiness
+    READYZ_PROBE_INTERVAL = 5.0
+    READYZ_PROBE_TIMEOUT = 0.5
+    READYZ_WINDOW = 60.0
+    READYZ_MIN_SAMPLES = 20
+    READYZ_MAX_P99_MS = 2000.0
+    READYZ_MAX_ERROR_RATE = 0.25
+    READYZ_MAX_POOL_SATURATION = 1.0
+
+    # Admission control
+    ADMISSION_ENABLED = True
+    ADMISSION_META_CONCURRENCY = 32
+    ADMISSION_META_QUEUE = 128
+    ADMISSION_META_RATE = 0.0
+    ADMISSION_META_BURST = 100
+    ADMISSION_BULK_CONCURRENCY = 4
+    ADMISSION_BULK_PER_KEY = 4
+    ADMISSION_BULK_QUEUE = 16
+    ADMISSION_BULK_RATE = 0.0
+    ADMISSION_BULK_BURST = 20
+    ADMISSION_STREAM_PER_KEY = 8
+    ADMISSION_QUEUE_TIMEOUT = 5.0
+
+    # Ancho de banda
+    BANDWIDTH_PER_TRANSFER = 0
+    BANDWIDTH_PER_KEY = 0
+    BANDWIDTH_GLOBAL = 0
+    BANDWIDTH_INTERACTIVE_BYTES = 1024 * 1024
+    BANDWIDTH_BULK_SHARE = 0.2
+
+    # Compresión HTTP
+    COMPRESSION_ENABLED = True
+    COMPRESSION_ENCODINGS = ["zstd", "br", "gzip"]
+    COMPRESSION_MIN_BYTES = 4096
+    COMPRESSION_TYPES = ["text/", "application/json"]
+    COMPRESSION_CACHE_VARIANTS = False
+
+    # Pipeline de /upload
+    UPLOAD_HASHES = []
+    UPLOAD_SNIFF = True
+    UPLOAD_MAX_BYTES = 0
+    UPLOAD_SCAN_COMMAND = ""
+    UPLOAD_SCAN_TIMEOUT = 10.0
+    UPLOAD_SIDECAR_SUFFIX = ""
+    UPLOAD_REMOTE_CHECKSUM = True
+    IDEMPOTENCY_TTL = 86400.0
+
+    # Progreso de transferencias
+    PROGRESS_INTERVAL = 0.05
+    PROGRESS_RETENTION = 300.0
     
     @classmethod
     def get_free_port(cls):
@@ -1,16 +1,21 @@
 #!/usr/bin/env python3
 """
 Suite completa de tests automatizados para la API SFTP.
-Usa un cliente SFTP fake (filesystem local) y TestClient de FastAPI.
+Usa el driver de storage "local" (un directorio temporal) y TestClient de FastAPI.
 """
 
 import os
 import sys
 import time
+import json
+import types
+import hashlib
 import tempfile
 import shutil
+import threading
 from pathlib import Path
 from io import BytesIO
+from contextlib import contextmanager
 
 # Agregar el directorio actual al path para imports
 sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
@@ -23,89 +28,6 @@ from app import app, set_settings_for_testing
 from test_config import TestSettings
 
 
-class FakeSFTPFile:
-    """Wrapper simple para manejar archivos en el fake client."""
-
-    def __init__(self, path, mode):
-        self._file = open(path, mode)
-
-    def read(self, *args, **kwargs):
-        return self._file.read(*args, **kwargs)
-
-    def write(self, data):
-        return self._file.write(data)
-
-    def close(self):
-        self._file.close()
-
-    def __enter__(self):
-        return self
-
-    def __exit__(self, exc_type, exc, tb):
-        self.close()
-
-    def __iter__(self):
-        self._file.seek(0)
-        return self
-
-    def __next__(self):
-        chunk = self._file.read(32768)
-        if not chunk:
-            raise StopIteration
-        return chunk
-
-
-class FakeSFTPClient:
-    """Implementación mínima de SFTP sobre el filesystem local."""
-
-    def __init__(self, base_dir):
-        self.base_dir = Path(base_dir)
-
-    def _resolve(self, path):
-        local = Path(path)
-        if not local.is_absolute():
-            local = self.base_dir / path.lstrip("/")
-        return local
-
-    def listdir(self, path):
-        return os.listdir(self._resolve(path))
-
-    def listdir_attr(self, path):
-        local = self._resolve(path)
-        items = []
-        for entry in os.scandir(local):
-            attrs = paramiko.SFTPAttributes.from_stat(entry.stat(follow_symlinks=False))
-            attrs.filename = entry.name
-            items.append(attrs)
-        return items
-
-    def stat(self, path):
-        local = self._resolve(path)
-        stat_result = local.stat()
-        attrs = paramiko.SFTPAttributes.from_stat(stat_result)
-        attrs.filename = local.name
-        return attrs
-
-    def mkdir(self, path):
-        self._resolve(path).mkdir()
-
-    def rmdir(self, path):
-        self._resolve(path).rmdir()
-
-    def remove(self, path):
-        self._resolve(path).unlink()
-
-    def chmod(self, path, mode):
-        os.chmod(self._resolve(path), mode)
-
-    def open(self, path, mode):
-        local = self._resolve(path)
-        local.parent.mkdir(parents=True, exist_ok=True)
-        return FakeSFTPFile(local, mode)
-
-    def close(self):
-        pass
-
 class TestRunner:
     """Ejecutor de tests con reporte detallado."""
     
@@ -114,7 +36,6 @@ class TestRunner:
         self.tests_failed = 0
         self.failed_tests = []
         self.base_dir = None
-        self.original_sftp_connect = None
         self.client = None
         
     def setup(self):
@@ -133,15 +54,6 @@ class TestRunner:
         test_settings = TestSettings()
         set_settings_for_testing(test_settings)
 
-        # Parchear sftp_connect para usar el fake client
-        import app as app_module
-        self.original_sftp_connect = app_module.sftp_connect
-
-        def fake_connect():
-            return FakeSFTPClient(self.base_dir)
-
-        app_module.sftp_connect = fake_connect
-
         # Crear cliente HTTP de testing
         self.client = TestClient(app)
         
@@ -150,8 +62,7 @@ class TestRunner:
     def teardown(self):
         """Limpia el entorno de testing."""
         import app as app_module
-        if self.original_sftp_connect:
-            app_module.sftp_connect = self.original_sftp_connect
+        app_module.reset_backends()
         if self.base_dir and self.base_dir.exists():
             shutil.rmtree(self.base_dir, ignore_errors=True)
         print("🧹 Entorno limpiado")
@@ -396,6 +307,1663 @@ class TestRunner:
         data = response.json()
         assert "No se puede eliminar BASE_DIR" in data["detail"]
     
+    def _slow_listing(self, delay, counter):
+        """Envuelve el cliente de storage para simular latencia en listdir_attr y contar llamadas."""
+        import app as app_module
+        fake_connect = app_module.storage_connect
+
+        def slow_connect(config=None):
+            client = fake_connect(config)
+            listdir_attr = client.listdir_attr
+
+            def slow_listdir_attr(path):
+                counter.append(path)
+                time.sleep(delay)
+                return listdir_attr(path)
+
+            client.listdir_attr = slow_listdir_attr
+            return client
+
+        return fake_connect, slow_connect
+
+    def _run_concurrently(self, func, n):
+        results = [None] * n
+
+        def worker(i):
+            results[i] = func(i)
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_list_coalesced(self):
+        """Test: Listados concurrentes idénticos comparten una sola conexión SFTP."""
+        import app as app_module
+        listings = []
+        original, slow = self._slow_listing(0.3, listings)
+        app_module.storage_connect = slow
+        app_module.reset_backends()
+        try:
+            responses = self._run_concurrently(
+                lambda i: self.client.get("/list?path=/test", headers={"X-API-Key": TestSettings.API_KEY}), 5
+            )
+        finally:
+            app_module.storage_connect = original
+            app_module.reset_backends()
+        assert all(r.status_code == 200 for r in responses)
+        names = {tuple(sorted(i["name"] for i in r.json()["items"])) for r in responses}
+        assert names == {("file1.txt", "file2.txt")}
+        assert len(listings) < 5, f"se esperaban lecturas agrupadas, hubo {len(listings)} listados"
+
+    def test_download_coalesced(self):
+        """Test: Suscriptores de un SharedStream reciben el archivo completo con una sola lectura."""
+        from app import SharedStream
+
+        class CountingSource(BytesIO):
+            reads = 0
+
+            def read(self, *args):
+                CountingSource.reads += 1
+                return super().read(*args)
+
+        payload = os.urandom(10000)
+        closed = []
+        stream = SharedStream(CountingSource(payload), 1000, on_close=lambda: closed.append(True))
+        subs = [stream.subscribe() for _ in range(3)]
+        outputs = self._run_concurrently(lambda i: b"".join(subs[i]), 3)
+        assert outputs == [payload] * 3
+        assert CountingSource.reads == 11  # 10 chunks + EOF, compartidos
+        assert closed == [True]
+        assert stream.subscribe() is None
+
+        # Buffer acotado: quien no avanza se desprende y sigue con su propia lectura desde su offset
+        reopened = []
+
+        def reopen(offset):
+            reopened.append(offset)
+            return BytesIO(payload[offset:]), None
+
+        stream = SharedStream(BytesIO(payload), 1000, max_lag=3, reopen=reopen)
+        fast, slow = stream.subscribe(), stream.subscribe()
+        first = next(slow)
+        received, peak = [], 0
+        for chunk in fast:
+            received.append(chunk)
+            peak = max(peak, len(stream._chunks))
+        assert b"".join(received) == payload and peak <= 3
+        assert first + b"".join(slow) == payload and reopened == [1000]
+
+        # Sin reopen, quien lee espera al rezagado (contrapresión)
+        stream = SharedStream(BytesIO(payload), 1000, max_lag=2)
+        subs, peaks = [stream.subscribe(), stream.subscribe()], []
+
+        def consume(i):
+            out = []
+            for chunk in subs[i]:
+                out.append(chunk)
+                peaks.append(len(stream._chunks))
+                if i == 1:
+                    time.sleep(0.01)
+            return b"".join(out)
+
+        assert self._run_concurrently(consume, 2) == [payload] * 2 and max(peaks) <= 2
+
+    def test_download_coalesced_slow_client(self):
+        """Test: Por /download, un cliente que no lee se desprende de la lectura compartida y el otro no acumula el archivo."""
+        import httpx
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        data = os.urandom(32 * 1024 * 1024)
+        (self.base_dir / "big").mkdir()
+        (self.base_dir / "big" / "shared.bin").write_bytes(data)
+        original = app_module.read_ahead
+
+        def delayed(f, cleanup, chunk_size):
+            # La primera lectura tarda: los dos clientes alcanzan a unirse a la misma lectura
+            source, close = original(f, cleanup, chunk_size)
+
+            class Delayed:
+                first = True
+
+                def read(self, size):
+                    if self.first:
+                        self.first = False
+                        time.sleep(0.5)
+                    return source.read(size)
+
+                def close(self):
+                    source.close()
+
+            return Delayed(), close
+
+        app_module.read_ahead = delayed
+        try:
+            with self._override_settings(DOWNLOAD_CHUNK_SIZE=64 * 1024, COALESCE_MAX_LAG=1024 * 1024), \
+                    self._live_server() as url, httpx.Client(base_url=url, headers=headers, timeout=30) as http:
+                before = app_module.metrics.get("coalesced.detached")
+                with http.stream("GET", "/download?remote_path=/big/shared.bin") as slow:
+                    fast = http.get("/download?remote_path=/big/shared.bin")
+                    assert fast.status_code == 200 and fast.content == data
+                    assert app_module.metrics.get("coalesced.detached") > before
+                    assert b"".join(slow.iter_bytes()) == data
+        finally:
+            app_module.read_ahead = original
+            shutil.rmtree(self.base_dir / "big", ignore_errors=True)
+
+    def test_metrics_coalesced(self):
+        """Test: /metrics expone contadores de coalescing."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+
+        def counters():
+            response = self.client.get("/metrics", headers=headers)
+            assert response.status_code == 200
+            return response.json()["counters"]
+
+        before = counters()
+        original, slow = self._slow_listing(0.3, [])
+        app_module.storage_connect = slow
+        try:
+            # Settings nuevos: backends y cache de listados vacíos, cada /list va al storage
+            with self._override_settings():
+                responses = self._run_concurrently(lambda i: self.client.get("/list?path=/test", headers=headers), 4)
+        finally:
+            app_module.storage_connect = original
+            app_module.reset_backends()
+        assert all(r.status_code == 200 for r in responses)
+        after = counters()
+        assert after.get("flights.list", 0) - before.get("flights.list", 0) >= 1
+        assert after.get("coalesced.list", 0) - before.get("coalesced.list", 0) >= 1
+
+    @contextmanager
+    def _override_settings(self, **overrides):
+        """Aplica temporalmente settings distintos a TestSettings."""
+        settings = TestSettings()
+        for key, value in overrides.items():
+            setattr(settings, key, value)
+        set_settings_for_testing(settings)
+        try:
+            yield settings
+        finally:
+            set_settings_for_testing(TestSettings())
+
+    @contextmanager
+    def _live_server(self):
+        """La app servida por uvicorn en un thread: TestClient junta el body entero y no sirve para streams sin fin."""
+        import uvicorn
+        port = TestSettings.get_free_port()
+        server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning", lifespan="off", timeout_graceful_shutdown=2
+        ))
+        thread = threading.Thread(target=server.run, daemon=True)
+        thread.start()
+        deadline = time.monotonic() + 10
+        while not server.started:
+            assert time.monotonic() < deadline and thread.is_alive(), "uvicorn no arrancó"
+            time.sleep(0.02)
+        try:
+            yield f"http://127.0.0.1:{port}"
+        finally:
+            server.should_exit = True
+            thread.join(10)
+
+    def _make_shard_dirs(self, *names):
+        dirs = {}
+        for name in names:
+            path = self.base_dir.parent / f"{self.base_dir.name}-{name}"
+            path.mkdir(exist_ok=True)
+            dirs[name] = path
+        return dirs
+
+    def test_sharding_hash(self):
+        """Test: En modo hash los archivos se reparten entre shards y /list los combina."""
+        from app import BackendConfig
+        shards = self._make_shard_dirs("a", "b")
+        backends = {name: BackendConfig(driver="local", host="fake", base_dir=str(path)) for name, path in shards.items()}
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        try:
+            with self._override_settings(SFTP_BACKENDS=backends, SFTP_ROUTING="hash", SFTP_DEFAULT_BACKEND="a"):
+                names = [f"f{i}.txt" for i in range(20)]
+                for name in names:
+                    response = self.client.post(
+                        "/upload", headers=headers, data={"remote_path": f"/shard/{name}"},
+                        files={"file": (name, BytesIO(name.encode()), "text/plain")}
+                    )
+                    assert response.status_code == 200
+                listed = self.client.get("/list?path=/shard", headers=headers).json()["items"]
+                assert sorted(item["name"] for item in listed) == sorted(names)
+                per_shard = [len(list((path / "shard").glob("*.txt"))) for path in shards.values()]
+                assert all(count > 0 for count in per_shard), per_shard
+                response = self.client.get("/download?remote_path=/shard/f7.txt", headers=headers)
+                assert response.content == b"f7.txt"
+                response = self.client.delete("/delete-dir?remote_path=/shard&recursive=true", headers=headers)
+                assert response.status_code == 200
+                assert not any((path / "shard").exists() for path in shards.values())
+        finally:
+            for path in shards.values():
+                shutil.rmtree(path, ignore_errors=True)
+
+    def test_routing_prefix(self):
+        """Test: Un prefijo ruteado va a su backend y aparece en el listado del padre."""
+        from app import BackendConfig
+        shards = self._make_shard_dirs("cold")
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        try:
+            with self._override_settings(
+                SFTP_BACKENDS={"cold": BackendConfig(driver="local", host="fake", base_dir=str(shards["cold"]))},
+                SFTP_ROUTES={"/archive/2024": "cold"},
+            ):
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/archive/2024/old.txt"},
+                    files={"file": ("old.txt", BytesIO(b"old"), "text/plain")}
+                )
+                assert response.status_code == 200
+                assert (shards["cold"] / "archive" / "2024" / "old.txt").read_bytes() == b"old"
+                assert not (self.base_dir / "archive").exists()
+                listed = self.client.get("/list?path=/", headers=headers).json()["items"]
+                assert any(item["name"] == "archive" and item["is_dir"] for item in listed)
+                backends = self.client.get("/backends", headers=headers).json()
+                assert backends["routes"] == {"/archive/2024": "cold"}
+                assert {b["name"] for b in backends["backends"]} == {"default", "cold"}
+        finally:
+            shutil.rmtree(shards["cold"], ignore_errors=True)
+
+    def test_replicas_failover(self):
+        """Test: Lecturas van a réplicas (saltando las caídas) y escrituras al primario."""
+        import app as app_module
+        from app import ReplicaConfig
+        mirror = self._make_shard_dirs("mirror")["mirror"]
+        (mirror / "only-on-replica.txt").write_text("replica")
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        fake_connect = app_module.storage_connect
+
+        def connect(config=None):
+            if config is not None and config.host == "down":
+                raise ConnectionRefusedError("replica caída")
+            return fake_connect(config)
+
+        app_module.storage_connect = connect
+        try:
+            with self._override_settings(
+                SFTP_REPLICAS=[ReplicaConfig(host="down"), ReplicaConfig(host="mirror", base_dir=str(mirror))],
+                SFTP_READ_FROM_PRIMARY=False,
+                SFTP_BREAKER_THRESHOLD=1,
+            ):
+                for _ in range(20):
+                    response = self.client.get("/stat?path=/only-on-replica.txt", headers=headers)
+                    assert response.status_code == 200, response.text
+                    assert response.json()["size"] == len("replica")
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/written.txt"},
+                    files={"file": ("w.txt", BytesIO(b"primary"), "text/plain")}
+                )
+                assert response.status_code == 200
+                assert (self.base_dir / "written.txt").read_bytes() == b"primary"
+                assert not (mirror / "written.txt").exists()
+                nodes = self.client.get("/backends", headers=headers).json()["backends"][0]["nodes"]
+                states = {node["host"]: node["breaker"] for node in nodes}
+                assert states["down"] == "open", states
+                assert states["mirror"] == "closed", states
+        finally:
+            app_module.storage_connect = fake_connect
+            shutil.rmtree(mirror, ignore_errors=True)
+
+    def test_circuit_breaker(self):
+        """Test: El breaker se abre tras N fallas y permite un solo intento en half-open."""
+        from app import CircuitBreaker
+        breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+        breaker.record_failure()
+        assert breaker.allow()
+        breaker.record_failure()
+        assert breaker.state == "open" and not breaker.allow()
+        time.sleep(0.06)
+        assert breaker.allow()
+        assert not breaker.allow()
+        breaker.record_success()
+        assert breaker.state == "closed" and breaker.allow()
+
+        # Un primario sano pero con el pool agotado está ocupado: el health check no abre su breaker
+        import app as app_module
+        with self._override_settings(SFTP_POOL_SIZE=1, READYZ_PROBE_TIMEOUT=0.05):
+            node = app_module.get_router().default.primary
+            client = node.pool.acquire()
+            try:
+                node.check_health()
+                assert node.breaker.state == "closed" and node.last_error is None
+            finally:
+                node.pool.release(client)
+            node.check_health()
+            assert node.breaker.state == "closed" and node.latency_ms is not None
+
+    def test_checksum(self):
+        """Test: /upload calcula el hash inline y /checksum lo calcula/cachea sin descargar."""
+        import hashlib
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        payload = os.urandom(200000)
+        expected = hashlib.sha256(payload).hexdigest()
+        response = self.client.post(
+            "/upload", headers=headers, data={"remote_path": "/sums/data.bin", "checksum": "sha256"},
+            files={"file": ("data.bin", BytesIO(payload), "application/octet-stream")}
+        )
+        assert response.status_code == 200
+        assert response.json()["checksum"] == expected
+
+        from app import _checksum_cache
+        _checksum_cache.clear()
+        first = self.client.get("/checksum?path=/sums/data.bin", headers=headers).json()
+        assert first["checksum"] == expected and first["method"] == "stream"
+        second = self.client.get("/checksum?path=/sums/data.bin", headers=headers).json()
+        assert second["checksum"] == expected and second["cached"] is True
+        md5 = self.client.get("/checksum?path=/sums/data.bin&algorithm=md5", headers=headers).json()
+        assert md5["checksum"] == hashlib.md5(payload).hexdigest()
+
+    def test_checksum_errors(self):
+        """Test: /checksum rechaza algoritmos desconocidos, directorios y archivos inexistentes."""
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        assert self.client.get("/checksum?path=/test/file1.txt&algorithm=crc", headers=headers).status_code == 400
+        assert self.client.get("/checksum?path=/test", headers=headers).status_code == 400
+        assert self.client.get("/checksum?path=/nope.bin", headers=headers).status_code == 404
+
+    def test_checksum_unsupported_marking(self):
+        """Test: Solo un "no soportado" explícito descarta check-file para el host, y vence."""
+        import errno
+        import app as app_module
+
+        class FakeFile:
+            def __init__(self, error):
+                self.error = error
+            def __enter__(self):
+                return self
+            def __exit__(self, *exc):
+                return False
+            def check(self, algorithm):
+                raise self.error
+
+        class FakeSFTP:
+            def __init__(self, error):
+                self.error = error
+                self.opened = 0
+            def open(self, path, mode):
+                self.opened += 1
+                return FakeFile(self.error)
+
+        with self._override_settings(CHECKSUM_REMOTE_EXEC=False):
+            # Permisos: transitorio, el siguiente intento vuelve a probar check-file
+            denied = FakeSFTP(IOError(errno.EACCES, "Permission denied"))
+            assert app_module.remote_checksum(denied, "/x", "sha256", 0, stream=False) == (None, "none")
+            app_module.remote_checksum(denied, "/x", "sha256", 0, stream=False)
+            assert denied.opened == 2
+
+            unsupported = FakeSFTP(IOError("Operation unsupported"))
+            app_module.remote_checksum(unsupported, "/x", "sha256", 0, stream=False)
+            app_module.remote_checksum(unsupported, "/x", "sha256", 0, stream=False)
+            assert unsupported.opened == 1
+
+            # Al vencer el TTL se vuelve a probar
+            with app_module._checksum_unsupported_lock:
+                for key in app_module._checksum_unsupported:
+                    app_module._checksum_unsupported[key] = time.monotonic() - 1
+            app_module.remote_checksum(unsupported, "/x", "sha256", 0, stream=False)
+            assert unsupported.opened == 2
+
+    def _delta_manifest(self, data, block_size):
+        import hashlib
+        import json
+        import zlib
+        blocks = [data[i:i + block_size] for i in range(0, len(data), block_size)]
+        return blocks, json.dumps({
+            "block_size": block_size,
+            "size": len(data),
+            "blocks": [{"weak": zlib.adler32(b), "strong": hashlib.sha256(b).hexdigest()} for b in blocks],
+        })
+
+    def test_upload_delta(self):
+        """Test: Solo los bloques modificados viajan y el archivo remoto queda igual al nuevo."""
+        import json
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        block_size = 1024
+        original = os.urandom(block_size * 10)
+        # Con cache de metadatos (sin índice), el /stat posterior ve el archivo nuevo
+        with self._override_settings(METADATA_CACHE_TTL=60):
+            response = self.client.post(
+                "/upload", headers=headers, data={"remote_path": "/delta/big.bin"},
+                files={"file": ("big.bin", BytesIO(original), "application/octet-stream")}
+            )
+            assert response.status_code == 200
+            updated = bytearray(original[:block_size * 9 + 100])
+            updated[block_size * 3 + 5] ^= 0xFF
+            updated = bytes(updated)
+            blocks, manifest = self._delta_manifest(updated, block_size)
+
+            plan = self.client.post(
+                "/upload/delta/plan", headers=headers, data={"remote_path": "/delta/big.bin", "manifest": manifest}
+            ).json()
+            assert plan["missing"] == [3, 9], plan
+            assert plan["transfer_bytes"] == block_size + 100
+            assert self.client.get("/stat?path=/delta/big.bin", headers=headers).json()["size"] == len(original)
+
+            body = b"".join(blocks[i] for i in plan["missing"])
+            response = self.client.post(
+                "/upload/delta", headers=headers,
+                data={"remote_path": "/delta/big.bin", "manifest": manifest, "blocks": json.dumps(plan["missing"]),
+                      "if_size": plan["remote_size"], "if_mtime": plan["remote_mtime"]},
+                files={"file": ("blocks", BytesIO(body), "application/octet-stream")}
+            )
+            assert response.status_code == 200, response.text
+            assert response.json()["written_bytes"] == block_size + 100
+            assert (self.base_dir / "delta" / "big.bin").read_bytes() == updated
+            assert self.client.get("/stat?path=/delta/big.bin", headers=headers).json()["size"] == len(updated)
+
+    def test_upload_delta_rejects_bad_block(self):
+        """Test: Un bloque que no coincide con el manifest se rechaza; un plan viejo da 409."""
+        import json
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        data = os.urandom(4096)
+        _, manifest = self._delta_manifest(data, 1024)
+        response = self.client.post(
+            "/upload/delta", headers=headers,
+            data={"remote_path": "/delta/new.bin", "manifest": manifest, "blocks": json.dumps([0, 1, 2, 3])},
+            files={"file": ("blocks", BytesIO(os.urandom(4096)), "application/octet-stream")}
+        )
+        assert response.status_code == 400
+        assert "no coincide" in response.json()["detail"]
+        assert not (self.base_dir / "delta" / "new.bin").exists()
+
+        # Un bloque bueno seguido de uno malo (o de datos de más): el archivo existente queda intacto
+        (self.base_dir / "delta").mkdir(exist_ok=True)
+        (self.base_dir / "delta" / "keep.bin").write_bytes(data)
+        updated = os.urandom(2048) + data[2048:]
+        blocks, updated_manifest = self._delta_manifest(updated, 1024)
+        for body in (blocks[0] + os.urandom(1024), blocks[0] + blocks[1] + b"x"):
+            response = self.client.post(
+                "/upload/delta", headers=headers,
+                data={"remote_path": "/delta/keep.bin", "manifest": updated_manifest, "blocks": "[0, 1]"},
+                files={"file": ("blocks", BytesIO(body), "application/octet-stream")}
+            )
+            assert response.status_code == 400, response.text
+            assert (self.base_dir / "delta" / "keep.bin").read_bytes() == data
+
+        response = self.client.post(
+            "/upload/delta", headers=headers,
+            data={"remote_path": "/test/file1.txt", "manifest": manifest, "blocks": "[0]", "if_size": 999},
+            files={"file": ("blocks", BytesIO(data[:1024]), "application/octet-stream")}
+        )
+        assert response.status_code == 409
+
+    def test_sync_plan_apply(self):
+        """Test: /sync/plan calcula el mínimo de operaciones y /sync/apply deja el remoto igual al manifest."""
+        import json
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        remote = self.base_dir / "mirror"
+        (remote / "keep").mkdir(parents=True)
+        (remote / "keep" / "same.txt").write_text("same")
+        (remote / "keep" / "changed.txt").write_text("old")
+        (remote / "gone" / "deep").mkdir(parents=True)
+        (remote / "gone" / "deep" / "x.txt").write_text("x")
+        (remote / "stale.txt").write_text("stale")
+        same_mtime = (remote / "keep" / "same.txt").stat().st_mtime
+
+        manifest = {
+            "root": "/mirror",
+            "entries": [
+                {"path": "keep/same.txt", "size": 4, "mtime": same_mtime},
+                {"path": "keep/changed.txt", "size": 7, "mtime": time.time()},
+                {"path": "new/sub/file.txt", "size": 3, "mtime": time.time()},
+                {"path": "empty/dir", "is_dir": True},
+            ],
+        }
+        plan = self.client.post("/sync/plan", headers=headers, json=manifest).json()
+        assert plan["uploads"] == ["keep/changed.txt", "new/sub/file.txt"], plan
+        assert plan["mkdirs"] == ["empty/dir"], plan
+        assert plan["deletes"] == [{"path": "gone", "is_dir": True}, {"path": "stale.txt", "is_dir": False}], plan
+
+        files = [
+            ("files", ("keep/changed.txt", BytesIO(b"changed"), "text/plain")),
+            ("files", ("new/sub/file.txt", BytesIO(b"new"), "text/plain")),
+        ]
+        response = self.client.post("/sync/apply", headers=headers, data={"plan": json.dumps(plan)}, files=files)
+        assert response.status_code == 200, response.text
+        result = response.json()
+        assert result == {"ok": True, "deleted": 2, "created": 1, "uploaded": 2, "errors": []}, result
+        assert (remote / "keep" / "changed.txt").read_text() == "changed"
+        assert (remote / "new" / "sub" / "file.txt").read_text() == "new"
+        assert (remote / "empty" / "dir").is_dir()
+        assert not (remote / "gone").exists() and not (remote / "stale.txt").exists()
+
+        again = self.client.post("/sync/plan", headers=headers, json=manifest).json()
+        assert again["uploads"] == [] and again["deletes"] == [] and again["mkdirs"] == [], again
+
+    def test_sync_rejects_escape(self):
+        """Test: El manifest no puede salir de root."""
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        response = self.client.post(
+            "/sync/plan", headers=headers, json={"root": "/", "entries": [{"path": "../etc/passwd", "size": 1}]}
+        )
+        assert response.status_code == 400
+
+    def test_metadata_index(self):
+        """Test: El crawler llena el índice, las escrituras lo actualizan y /search lo consulta."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        db_path = str(self.base_dir.parent / f"{self.base_dir.name}-index.db")
+        (self.base_dir / "reports" / "2025").mkdir(parents=True)
+        (self.base_dir / "reports" / "2025" / "jan.csv").write_text("a,b\n1,2\n")
+        (self.base_dir / "reports" / "notes.txt").write_text("notes")
+        try:
+            with self._override_settings(INDEX_DB=db_path):
+                app_module.crawl_index()
+                found = self.client.get("/search?glob=*.csv", headers=headers).json()["items"]
+                assert [item["path"] for item in found] == ["/reports/2025/jan.csv"], found
+
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/reports/2025/feb.csv"},
+                    files={"file": ("feb.csv", BytesIO(b"x" * 5000), "text/csv")}
+                )
+                assert response.status_code == 200
+                found = self.client.get("/search?prefix=/reports&glob=*.csv&min_size=1000", headers=headers).json()["items"]
+                assert [item["path"] for item in found] == ["/reports/2025/feb.csv"], found
+
+                self.client.delete("/delete-dir?remote_path=/reports/2025&recursive=true", headers=headers)
+                found = self.client.get("/search?prefix=/reports", headers=headers).json()["items"]
+                assert [item["path"] for item in found] == ["/reports/notes.txt"], found
+
+                # /list con max_age responde desde el índice sin tocar SFTP
+                self.client.get("/list?path=/reports", headers=headers)
+                (self.base_dir / "reports" / "unseen.txt").write_text("x")
+                cached = self.client.get("/list?path=/reports&max_age=60", headers=headers).json()
+                assert cached["source"] == "index"
+                assert [item["name"] for item in cached["items"]] == ["notes.txt"]
+                fresh = self.client.get("/list?path=/reports", headers=headers).json()
+                assert "unseen.txt" in {item["name"] for item in fresh["items"]}
+
+            # Un /list servido por el cache de metadatos no reescribe el índice ni mueve listed_at
+            with self._override_settings(INDEX_DB=db_path, METADATA_CACHE_TTL=60):
+                index = app_module.get_index()
+                before = time.time()
+                self.client.get("/list?path=/reports", headers=headers)
+                listed_at = index.dir_state("/reports")[1]
+                assert listed_at >= before - 1
+                (self.base_dir / "reports" / "later.txt").write_text("x")
+                time.sleep(0.05)
+                hit = self.client.get("/list?path=/reports", headers=headers).json()
+                assert "later.txt" not in {item["name"] for item in hit["items"]}
+                assert index.dir_state("/reports")[1] == listed_at
+                cached = self.client.get("/list?path=/reports&max_age=60", headers=headers).json()
+                assert cached["indexed_at"] == listed_at
+        finally:
+            shutil.rmtree(self.base_dir / "reports", ignore_errors=True)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    def test_changes_feed(self):
+        """Test: /changes refleja escrituras de la API y cambios externos vistos por el crawler incremental."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        db_path = str(self.base_dir.parent / f"{self.base_dir.name}-changes.db")
+        feed = self.base_dir / "feed"
+        feed.mkdir()
+        (feed / "a.txt").write_text("a")
+
+        def age_dirs():
+            old = time.time() - 3600
+            for path, _, _ in os.walk(self.base_dir):
+                os.utime(path, (old, old))
+
+        def ops(since):
+            body = self.client.get(f"/changes?since={since}", headers=headers).json()
+            return {(c["op"], c["path"], c["source"]) for c in body["changes"]}, body["cursor"]
+
+        try:
+            with self._override_settings(INDEX_DB=db_path):
+                age_dirs()
+                app_module.crawl_index()
+                cursor = self.client.get("/changes", headers=headers).json()["cursor"]
+                assert ops(cursor)[0] == set()  # el primer crawl es la línea base
+
+                self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/feed/b.txt"},
+                    files={"file": ("b.txt", BytesIO(b"b"), "text/plain")}
+                )
+                changed, cursor = ops(cursor)
+                assert changed == {("created", "/feed/b.txt", "api")}, changed
+
+                (feed / "c.txt").write_text("c")
+                (feed / "a.txt").unlink()
+                app_module.crawl_index_incremental()
+                changed, cursor = ops(cursor)
+                assert changed == {("created", "/feed/c.txt", "crawl"), ("deleted", "/feed/a.txt", "crawl")}, changed
+
+                # Directorios sin cambio de mtime no se vuelven a listar
+                age_dirs()
+                app_module.crawl_index_incremental()
+                before = app_module.metrics.get("index.incremental_relisted")
+                app_module.crawl_index_incremental()
+                assert app_module.metrics.get("index.incremental_relisted") == before
+
+                body = self.client.get(f"/changes?since={cursor}&wait=0.2", headers=headers).json()
+                assert body["changes"] == [] and body["cursor"] == cursor
+                assert self.client.get("/changes?since=999999", headers=headers).status_code == 410
+                assert self.client.get("/changes?since=abc", headers=headers).status_code == 400
+
+            # El long-poll espera en el event loop y fuera del gate meta: /stat sigue respondiendo
+            with self._override_settings(INDEX_DB=db_path, ADMISSION_META_CONCURRENCY=1, ADMISSION_META_QUEUE=0):
+                def run(i):
+                    if i == 0:
+                        return self.client.get(f"/changes?since={cursor}&wait=5", headers=headers)
+                    time.sleep(0.3)
+                    stat = self.client.get("/stat?path=/feed", headers=headers)
+                    app_module.index_written("/feed/live", None)
+                    return stat
+                poll, stat = self._run_concurrently(run, 2)
+                assert stat.status_code == 200
+                assert [c["path"] for c in poll.json()["changes"]] == ["/feed/live"]
+        finally:
+            shutil.rmtree(feed, ignore_errors=True)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    def test_changes_stream(self):
+        """Test: /changes/stream entrega los cambios en vivo; entre cambios espera en el event loop."""
+        import httpx
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        db_path = str(self.base_dir.parent / f"{self.base_dir.name}-stream.db")
+        try:
+            with self._override_settings(INDEX_DB=db_path), self._live_server() as url, \
+                    httpx.Client(base_url=url, headers=headers, timeout=10) as http:
+                with http.stream("GET", "/changes/stream") as response:
+                    assert response.status_code == 200
+                    lines = response.iter_lines()
+                    assert next(lines).startswith("retry:") and next(lines) == "event: cursor"
+                    time.sleep(0.2)
+                    assert len(app_module.get_index()._async_waiters) == 1
+                    started = time.monotonic()
+                    # La escritura llega por otro thread: el waiter async del stream se despierta al instante
+                    threading.Timer(0.2, lambda: app_module.index_written("/live.txt", None)).start()
+                    while next(lines) != "event: change":
+                        pass
+                    change = json.loads(next(lines).split(": ", 1)[1])
+                    assert time.monotonic() - started < 1.0
+                    assert change["path"] == "/live.txt" and change["op"] == "created"
+        finally:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    def test_warmup_readiness(self):
+        """Test: /readyz espera al warmup, que abre el pool y llena los cachés de listados, stats y archivos."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        cache_dir = self.base_dir.parent / f"{self.base_dir.name}-filecache"
+        hot = self.base_dir / "hot"
+        hot.mkdir()
+        (hot / "a.txt").write_text("aaa")
+        (hot / "big.bin").write_bytes(b"z" * 4096)
+        try:
+            with self._override_settings(
+                WARMUP_PATHS=["/hot"], WARMUP_FILES=["/hot/big.bin", "/hot/missing.bin"],
+                METADATA_CACHE_TTL=60, FILE_CACHE_DIR=str(cache_dir),
+            ):
+                assert self.client.get("/readyz").status_code == 503
+                app_module.run_warmup()
+                ready = self.client.get("/readyz")
+                assert ready.status_code == 200
+                assert len(ready.json()["warmup"]["errors"]) == 1  # missing.bin no bloquea
+                assert app_module.get_router().default.primary.pool.stats()["idle"] >= 1
+
+                # Listado y stats salen del cache hasta que la API escribe
+                (hot / "external.txt").write_text("x")
+                (hot / "a.txt").write_text("changed")
+                hits = app_module.metrics.get("cache.list_hits")
+                names = {i["name"] for i in self.client.get("/list?path=/hot", headers=headers).json()["items"]}
+                assert "external.txt" not in names and app_module.metrics.get("cache.list_hits") == hits + 1
+                assert self.client.get("/stat?path=/hot/a.txt", headers=headers).json()["size"] == 3
+                self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/hot/new.txt"},
+                    files={"file": ("new.txt", BytesIO(b"n"), "text/plain")}
+                )
+                names = {i["name"] for i in self.client.get("/list?path=/hot", headers=headers).json()["items"]}
+                assert {"external.txt", "new.txt"} <= names
+
+                # Descarga servida desde el cache local mientras el remoto no cambie
+                file_hits = app_module.metrics.get("cache.file_hits")
+                response = self.client.get("/download?remote_path=/hot/big.bin", headers=headers)
+                assert response.content == b"z" * 4096
+                assert app_module.metrics.get("cache.file_hits") == file_hits + 1
+        finally:
+            shutil.rmtree(hot, ignore_errors=True)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_lazy_startup(self):
+        """Test: Importar la app no carga Paramiko ni settings; con LAZY_STARTUP /healthz responde antes de estar listo."""
+        import subprocess
+        import app as app_module
+        probe = "import sys, app; assert 'paramiko.transport' not in sys.modules and app._settings_instance is None"
+        result = subprocess.run([sys.executable, "-c", probe], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+
+        release = threading.Event()
+        original = app_module.preload_ssh_credentials
+        app_module.preload_ssh_credentials = lambda: release.wait(10) or None
+        try:
+            with self._override_settings(LAZY_STARTUP=True):
+                with TestClient(app) as client:
+                    assert client.get("/healthz").status_code == 200
+                    assert client.get("/readyz").status_code == 503
+                    release.set()
+                    deadline = time.monotonic() + 10
+                    while client.get("/readyz").status_code != 200:
+                        assert time.monotonic() < deadline, "no quedó listo tras la preparación"
+                        time.sleep(0.05)
+
+            def broken():
+                raise ValueError("clave inválida")
+
+            app_module.preload_ssh_credentials = broken
+            with self._override_settings(LAZY_STARTUP=True):
+                with TestClient(app) as client:
+                    deadline = time.monotonic() + 10
+                    while not client.get("/readyz").json()["warmup"]["errors"]:
+                        assert time.monotonic() < deadline
+                        time.sleep(0.05)
+                    ready = client.get("/readyz")
+                    assert ready.status_code == 503
+                    assert ready.json()["warmup"]["errors"] == ["startup: clave inválida"]
+        finally:
+            app_module.preload_ssh_credentials = original
+
+        # Schema OpenAPI pregenerado
+        schema_file = self.base_dir.parent / f"{self.base_dir.name}-openapi.json"
+        app_module.write_openapi_schema(str(schema_file))
+        generated = self.client.get("/openapi.json").json()
+        assert json.loads(schema_file.read_text()) == generated
+        schema_file.write_text(json.dumps({"openapi": "3.1.0", "info": {"title": "prebuilt", "version": "1"}, "paths": {}}))
+        app.openapi_schema = None
+        try:
+            with self._override_settings(OPENAPI_SCHEMA_FILE=str(schema_file)):
+                assert self.client.get("/openapi.json").json()["info"]["title"] == "prebuilt"
+        finally:
+            app.openapi_schema = None
+            schema_file.unlink()
+
+    def test_readyz_thresholds(self):
+        """Test: /readyz cachea el probe SFTP y falla con pool saturado o tasa de error alta."""
+        import app as app_module
+        app_module.run_warmup()
+        ready = self.client.get("/readyz")
+        assert ready.status_code == 200, ready.json()
+        assert ready.json()["backends"]["default"]["ok"]
+        probes = app_module.metrics.get("readyz.probes")
+        self.client.get("/readyz")
+        assert app_module.metrics.get("readyz.probes") == probes  # probe cacheado
+
+        pool = app_module.get_router().default.primary.pool
+        clients = [pool.acquire() for _ in range(pool.size)]
+        try:
+            body = self.client.get("/readyz").json()
+            assert not body["ready"] and any("pool saturado" in f for f in body["failures"]), body
+        finally:
+            for client in clients:
+                pool.release(client)
+        assert self.client.get("/readyz").status_code == 200
+
+        for _ in range(TestSettings.READYZ_MIN_SAMPLES):
+            app_module.sftp_latency.record_error()
+        body = self.client.get("/readyz").json()
+        assert not body["ready"] and body["sftp"]["error_rate"] > 0.25, body
+        app_module.sftp_latency.clear()
+
+    def test_admission_rate_limit(self):
+        """Test: El token bucket por key responde 429 con Retry-After; las keys inválidas comparten bucket."""
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        with self._override_settings(ADMISSION_META_RATE=0.5, ADMISSION_META_BURST=2):
+            codes = [self.client.get("/list?path=/test", headers=headers).status_code for _ in range(3)]
+            assert codes == [200, 200, 429], codes
+            limited = self.client.get("/list?path=/test", headers=headers)
+            assert limited.status_code == 429 and int(limited.headers["Retry-After"]) >= 1
+
+            codes = [self.client.get("/list", headers={"X-API-Key": f"bad-{i}"}).status_code for i in range(3)]
+            assert codes == [401, 401, 429], codes
+            assert self.client.get("/healthz").status_code == 200  # exento
+
+            # Hay una sola API_KEY: los límites "por key" se aplican por dirección del cliente
+            other = TestClient(app, client=("10.0.0.2", 50000))
+            assert other.get("/list?path=/test", headers=headers).status_code == 200
+            assert self.client.get("/list?path=/test", headers=headers).status_code == 429
+
+    def test_admission_queue(self):
+        """Test: Sin lugar en la cola, los requests concurrentes reciben 503 en vez de acumularse."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        listings = []
+        original, slow = self._slow_listing(0.4, listings)
+        app_module.storage_connect = slow
+        try:
+            with self._override_settings(ADMISSION_META_CONCURRENCY=1, ADMISSION_META_QUEUE=1, COALESCE_READS=False):
+                responses = self._run_concurrently(
+                    lambda i: self.client.get(f"/list?path=/test&n={i}", headers=headers), 4
+                )
+                codes = sorted(r.status_code for r in responses)
+                assert codes == [200, 200, 503, 503], codes
+                rejected = [r for r in responses if r.status_code == 503]
+                assert all("Retry-After" in r.headers for r in rejected)
+
+            with self._override_settings(ADMISSION_META_CONCURRENCY=1, ADMISSION_QUEUE_TIMEOUT=0.1, COALESCE_READS=False):
+                responses = self._run_concurrently(
+                    lambda i: self.client.get("/list?path=/test", headers=headers), 2
+                )
+                assert sorted(r.status_code for r in responses) == [200, 503]
+                assert app_module._admission.stats()["meta"] == {"limit": 1, "active": 0, "queued": 0}
+        finally:
+            app_module.storage_connect = original
+            app_module.reset_backends()
+
+    def test_admission_streams(self):
+        """Test: Un stream SSE abierto no ocupa el slot meta; los streams tienen su propio límite por key."""
+        import httpx
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        db_path = str(self.base_dir.parent / f"{self.base_dir.name}-admission.db")
+        try:
+            with self._override_settings(INDEX_DB=db_path, ADMISSION_META_CONCURRENCY=1, ADMISSION_META_QUEUE=0,
+                                         ADMISSION_STREAM_PER_KEY=1), \
+                    self._live_server() as url, httpx.Client(base_url=url, headers=headers, timeout=10) as http:
+                with http.stream("GET", "/changes/stream") as response:
+                    assert response.status_code == 200
+                    lines = response.iter_lines()  # sin referencia, el GC cierra la conexión
+                    assert next(lines).startswith("retry:")
+                    assert http.get("/stat?path=/test").status_code == 200
+                    second = http.get("/changes/stream")
+                    assert second.status_code == 503 and "Retry-After" in second.headers
+        finally:
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    def test_bandwidth_limits(self):
+        """Test: Uploads y downloads respetan el límite por transferencia."""
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        data = os.urandom(500_000)
+        try:
+            with self._override_settings(BANDWIDTH_PER_TRANSFER=200_000):
+                start = time.monotonic()
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/shaped/data.bin"},
+                    files={"file": ("data.bin", BytesIO(data), "application/octet-stream")}
+                )
+                assert response.status_code == 200
+                assert time.monotonic() - start >= 1.2  # 200 KB de ráfaga + 300 KB a 200 KB/s
+
+                start = time.monotonic()
+                response = self.client.get("/download?remote_path=/shaped/data.bin", headers=headers)
+                assert response.content == data
+                assert time.monotonic() - start >= 1.2
+        finally:
+            shutil.rmtree(self.base_dir / "shaped", ignore_errors=True)
+
+    def test_bandwidth_priority(self):
+        """Test: Mientras hay transferencias interactivas, los bytes bulk cuestan más en el bucket global."""
+        import app as app_module
+        with self._override_settings(BANDWIDTH_GLOBAL=10_000_000, BANDWIDTH_INTERACTIVE_BYTES=1000, BANDWIDTH_BULK_SHARE=0.25):
+            small, big = app_module.Shaper("valid"), app_module.Shaper("valid")
+            small.throttle(100)
+            assert small.interactive and app_module._bandwidth.interactive == 1
+            bucket = app_module._bandwidth.global_bucket(10_000_000)
+            before = bucket.tokens
+            big.throttle(2000)  # primer chunk ya supera el umbral: bulk
+            assert not big.interactive
+            assert before - bucket.tokens > 7000  # 2000 bytes * 4
+            small.close()
+            assert app_module._bandwidth.interactive == 0
+            before = bucket.tokens
+            big.throttle(2000)
+            assert before - bucket.tokens < 2100
+            big.close()
+
+    def test_multiworker_shared_cache(self):
+        """Test: El presupuesto de sesiones se reparte entre workers y el cache compartido se ve entre procesos."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        db_path = str(self.base_dir.parent / f"{self.base_dir.name}-shared-cache.db")
+        try:
+            with self._override_settings(WEB_CONCURRENCY=3, SFTP_SESSION_BUDGET=8):
+                assert app_module.get_router().default.primary.pool.size == 2
+            # Los transfer workers retienen una sesión por nodo: salen del mismo presupuesto
+            with self._override_settings(WEB_CONCURRENCY=2, SFTP_SESSION_BUDGET=8, TRANSFER_WORKERS=3):
+                assert app_module.get_router().default.primary.pool.size == 1
+                assert app_module.transfer_worker_count(app_module.get_settings()) == 3
+            with self._override_settings(WEB_CONCURRENCY=3, SFTP_SESSION_BUDGET=8, TRANSFER_WORKERS=4):
+                assert app_module.get_router().default.primary.pool.size == 1
+                assert app_module.transfer_worker_count(app_module.get_settings()) == 1
+
+            with self._override_settings(METADATA_CACHE_TTL=60, METADATA_CACHE_SHARED=db_path):
+                self.client.get("/list?path=/test", headers=headers)
+                # Otro worker (otra conexión al mismo archivo) ve el listado
+                other = app_module.SharedMetadataCache(db_path)
+                _, items = other.get(("list", "/test"))
+                names = {item["name"] for item in items}
+                assert {"file1.txt", "file2.txt"} <= names
+                # ... y una escritura en cualquiera invalida para todos
+                other.invalidate("/test/new.txt")
+                assert app_module.metadata_cache().get(("list", "/test")) is None
+                other.close()
+
+            lock_path = db_path + ".lock"
+            first, second = app_module.WorkerLock(lock_path), app_module.WorkerLock(lock_path)
+            assert first.try_acquire() and not second.try_acquire()
+            first.release()
+            assert second.try_acquire()
+            second.release()
+        finally:
+            for suffix in ("", "-wal", "-shm", ".lock"):
+                if os.path.exists(db_path + suffix):
+                    os.remove(db_path + suffix)
+
+    def _thread_transfer_worker(self):
+        """Transfer worker en un thread (mismo loop y protocolo que el proceso real, con el driver local)."""
+        import multiprocessing
+        import app as app_module
+        parent, child = multiprocessing.Pipe()
+        thread = threading.Thread(target=app_module.transfer_worker_main, args=(child,), daemon=True)
+        thread.start()
+        return app_module._TransferWorker(parent, thread)
+
+    def test_transfer_workers(self):
+        """Test: Uploads y downloads grandes pasan por los transfer workers; los chicos no."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        data = os.urandom(300_000)
+        try:
+            with self._override_settings(TRANSFER_WORKERS=2):
+                app_module.start_transfer_pool(self._thread_transfer_worker)
+                uploads = app_module.metrics.get("transfers.offloaded.upload")
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/offload/big.bin", "checksum": "sha256"},
+                    files={"file": ("big.bin", BytesIO(data), "application/octet-stream")}
+                )
+                assert response.status_code == 200, response.text
+                assert app_module.metrics.get("transfers.offloaded.upload") == uploads + 1
+                assert (self.base_dir / "offload" / "big.bin").read_bytes() == data
+
+                downloads = app_module.metrics.get("transfers.offloaded.download")
+                response = self.client.get("/download?remote_path=/offload/big.bin", headers=headers)
+                assert response.content == data
+                assert self.client.get("/download?remote_path=/test/file1.txt", headers=headers).content == b"Hello World"
+                assert app_module.metrics.get("transfers.offloaded.download") == downloads + 1
+                assert self.client.get("/download?remote_path=/offload/none.bin", headers=headers).status_code == 404
+
+                # Un stream abandonado a la mitad devuelve el worker al pool
+                pool = app_module.get_transfer_pool()
+                backend = app_module.get_router().default
+                reader, close = pool.open_read(backend, "/offload/big.bin", 1024)
+                assert len(reader.read()) == 1024
+                close()
+                for _ in range(3):
+                    reader, close = pool.open_read(backend, "/offload/big.bin", 65536)
+                    assert b"".join(iter(lambda: reader.read(), b"")) == data
+                    close()
+                assert pool._idle.qsize() == 2
+        finally:
+            app_module.stop_transfer_pool()
+            shutil.rmtree(self.base_dir / "offload", ignore_errors=True)
+
+    @contextmanager
+    def _recording_transport(self, accepted_key=None, host_key=None):
+        """Reemplaza paramiko.Transport por uno que registra opciones, host key esperada y autenticación."""
+        calls = {"auth": []}
+        defaults = paramiko.Transport
+
+        class RecordingTransport:
+            def __init__(self, sock, **kwargs):
+                calls["transport"] = kwargs
+                self.options = types.SimpleNamespace(
+                    ciphers=defaults._preferred_ciphers,
+                    kex=defaults._preferred_kex,
+                    digests=defaults._preferred_macs,
+                )
+
+            def get_security_options(self):
+                return self.options
+
+            def use_compression(self, compress=True):
+                calls["compression"] = compress
+
+            def connect(self, hostkey=None):
+                calls["options"] = self.options
+                calls["hostkey"] = hostkey
+                if hostkey is not None and host_key is not None and hostkey.asbytes() != host_key.asbytes():
+                    raise paramiko.SSHException("Bad host key from server")
+
+            def auth_publickey(self, username, key):
+                calls["auth"].append(("publickey", key.get_name()))
+                if accepted_key is None or key.asbytes() != accepted_key.asbytes():
+                    raise paramiko.AuthenticationException("rechazada")
+
+            def auth_password(self, username, password):
+                calls["auth"].append(("password", password))
+
+            def close(self):
+                calls["closed"] = True
+
+        def from_transport(transport, window_size=None, max_packet_size=None):
+            calls["sftp"] = (window_size, max_packet_size)
+            return transport
+
+        original_from_transport = paramiko.SFTPClient.__dict__["from_transport"]
+        paramiko.Transport, paramiko.SFTPClient.from_transport = RecordingTransport, from_transport
+        try:
+            yield calls
+        finally:
+            paramiko.Transport, paramiko.SFTPClient.from_transport = defaults, original_from_transport
+
+    def test_ssh_transport_options(self):
+        """Test: sftp_connect aplica ciphers, KEX, compresión y ventana configurados."""
+        import app as app_module
+        defaults = paramiko.Transport
+        with self._recording_transport() as calls:
+            with self._override_settings(
+                SSH_CIPHERS=["chacha20-poly1305@openssh.com", "aes256-gcm@openssh.com", "aes128-ctr"],
+                SSH_KEX=["curve25519-sha256@libssh.org"], SSH_COMPRESSION=True,
+                SSH_WINDOW_SIZE=8 * 1024 * 1024, SSH_MAX_PACKET_SIZE=32768,
+            ):
+                app_module.sftp_connect()
+                assert calls["options"].ciphers == ("aes256-gcm@openssh.com", "aes128-ctr")
+                assert calls["options"].kex == ("curve25519-sha256@libssh.org",)
+                assert calls["options"].digests == defaults._preferred_macs
+                assert calls["compression"] is True
+                assert calls["transport"] == {"default_window_size": 8 * 1024 * 1024, "default_max_packet_size": 32768}
+                assert calls["sftp"] == (8 * 1024 * 1024, 32768)
+            with self._override_settings(SSH_CIPHERS=["chacha20-poly1305@openssh.com"]):
+                try:
+                    app_module.sftp_connect()
+                    assert False, "se esperaba ValueError"
+                except ValueError as e:
+                    assert "chacha20" in str(e)
+            calls.clear()
+            calls["auth"] = []
+            app_module.sftp_connect()
+            assert calls["transport"] == {} and calls["sftp"] == (None, None) and calls["compression"] is False
+            assert calls["hostkey"] is None and calls["auth"] == [("password", TestSettings.SFTP_PASS)]
+
+    def test_ssh_key_auth(self):
+        """Test: Clave privada cacheada, host key fijada / known_hosts y fallback a password."""
+        import app as app_module
+        tmp = Path(tempfile.mkdtemp(prefix="ssh_keys_"))
+        try:
+            client_key = paramiko.ECDSAKey.generate()
+            client_key.write_private_key_file(str(tmp / "id_ecdsa"), password="secreto")
+            server_key = paramiko.ECDSAKey.generate()
+            pinned = f"{server_key.get_name()} {server_key.get_base64()}"
+            (tmp / "known_hosts").write_text(f"[{TestSettings.SFTP_HOST}]:{TestSettings.SFTP_PORT} {pinned}\n")
+
+            with self._recording_transport(accepted_key=client_key, host_key=server_key) as calls:
+                with self._override_settings(SFTP_KEY_FILE=str(tmp / "id_ecdsa"), SFTP_KEY_PASSPHRASE="secreto",
+                                             SFTP_HOST_KEY=pinned):
+                    app_module.preload_ssh_credentials()
+                    key = app_module.load_private_key(str(tmp / "id_ecdsa"), "secreto")
+                    app_module.sftp_connect()
+                    assert calls["hostkey"].asbytes() == server_key.asbytes()
+                    assert calls["auth"] == [("publickey", client_key.get_name())]
+                    # La clave se parsea una sola vez por proceso
+                    app_module.sftp_connect()
+                    assert app_module.load_private_key(str(tmp / "id_ecdsa"), "secreto") is key
+
+                with self._override_settings(SFTP_KNOWN_HOSTS=str(tmp / "known_hosts")):
+                    calls["auth"].clear()
+                    app_module.sftp_connect()
+                    assert calls["hostkey"].asbytes() == server_key.asbytes()
+                    assert calls["auth"] == [("password", TestSettings.SFTP_PASS)]
+                    # Host que no figura en known_hosts: falla antes de conectar
+                    config = app_module.default_backend_config().model_copy(update={"host": "otro-host"})
+                    try:
+                        app_module.sftp_connect(config)
+                        assert False, "se esperaba SSHException"
+                    except paramiko.SSHException as e:
+                        assert "otro-host" in str(e)
+
+                # Host key distinta a la fijada: se cierra el transporte
+                other = paramiko.ECDSAKey.generate()
+                with self._override_settings(SFTP_HOST_KEY=f"{other.get_name()} {other.get_base64()}"):
+                    calls.pop("closed", None)
+                    try:
+                        app_module.sftp_connect()
+                        assert False, "se esperaba SSHException"
+                    except paramiko.SSHException:
+                        assert calls["closed"]
+
+            # Clave rechazada por el servidor: se intenta password
+            with self._recording_transport() as calls:
+                with self._override_settings(SFTP_KEY_FILE=str(tmp / "id_ecdsa"), SFTP_KEY_PASSPHRASE="secreto"):
+                    app_module.sftp_connect()
+                    assert calls["auth"] == [("publickey", client_key.get_name()), ("password", TestSettings.SFTP_PASS)]
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+
+    def test_compression(self):
+        """Test: Content-Encoding negociado en /download y /list, con umbral, tipos y variantes cacheadas."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        folder = self.base_dir / "zip"
+        folder.mkdir()
+        cache_dir = self.base_dir.parent / f"{self.base_dir.name}-zipcache"
+        data = b"".join(b"%d,paciente-%d,2025-01-01,ok\n" % (i, i) for i in range(5000))
+        (folder / "data.csv").write_bytes(data)
+        (folder / "data.bin").write_bytes(data)
+        (folder / "small.csv").write_bytes(b"a,b\n")
+        for i in range(200):
+            (folder / f"item-{i:04d}.txt").write_text("x")
+        try:
+            gzip_headers = {**headers, "Accept-Encoding": "gzip"}
+            response = self.client.get("/download?remote_path=/zip/data.csv", headers=gzip_headers)
+            assert response.headers["content-encoding"] == "gzip"
+            assert response.headers["vary"] == "Accept-Encoding"
+            assert response.content == data
+            assert response.num_bytes_downloaded < len(data) / 4
+
+            # Sin aceptación, tipo no comprimible o debajo del umbral: sin Content-Encoding
+            for path, accept in (("/zip/data.csv", "identity"), ("/zip/data.csv", "gzip;q=0, br;q=0"),
+                                 ("/zip/data.bin", "gzip"), ("/zip/small.csv", "gzip")):
+                response = self.client.get(f"/download?remote_path={path}", headers={**headers, "Accept-Encoding": accept})
+                assert "content-encoding" not in response.headers, (path, accept)
+            assert self.client.get("/download?remote_path=/zip/none.csv", headers=gzip_headers).status_code == 404
+            assert app_module.negotiate_encoding("br;q=0.5, *;q=0.1") in ("zstd", "br", "gzip")
+            with self._override_settings(COMPRESSION_ENABLED=False):
+                response = self.client.get("/download?remote_path=/zip/data.csv", headers=gzip_headers)
+                assert "content-encoding" not in response.headers and response.content == data
+
+            listing = self.client.get("/list?path=/zip", headers=gzip_headers)
+            assert listing.headers["content-encoding"] == "gzip"
+            assert len(listing.json()["items"]) == 203
+
+            # Variante comprimida guardada en FILE_CACHE_DIR y servida en la siguiente descarga
+            with self._override_settings(COMPRESSION_CACHE_VARIANTS=True, FILE_CACHE_DIR=str(cache_dir)):
+                assert self.client.get("/download?remote_path=/zip/data.csv", headers=gzip_headers).content == data
+                assert len(list(cache_dir.glob("*.gzip"))) == 1
+                hits = app_module.metrics.get("cache.compressed_hits")
+                response = self.client.get("/download?remote_path=/zip/data.csv", headers=gzip_headers)
+                assert response.content == data and response.headers["content-encoding"] == "gzip"
+                assert app_module.metrics.get("cache.compressed_hits") == hits + 1
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            shutil.rmtree(cache_dir, ignore_errors=True)
+
+    def test_list_formats(self):
+        """Test: /list en formato columnar y msgpack con los mismos datos que el formato de objetos."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        folder = self.base_dir / "cols"
+        folder.mkdir()
+        (folder / "sub").mkdir()
+        for i in range(30):
+            (folder / f"f{i:02d}.txt").write_text("x" * i)
+        try:
+            objects = self.client.get("/list?path=/cols", headers=headers).json()["items"]
+            data = self.client.get("/list?path=/cols&format=columnar", headers=headers).json()
+            assert data["format"] == "columnar" and data["count"] == len(objects) == 31
+            assert data["names"] == [i["name"] for i in objects]
+            assert data["sizes"] == [i["size"] for i in objects]
+            assert data["mtimes"] == [i["mtime"] for i in objects]
+            assert data["modes"] == [int(i["mode"], 8) for i in objects]
+            assert data["dirs"] == [i["is_dir"] for i in objects]
+            assert self.client.get("/list?path=/cols&format=xml", headers=headers).status_code == 400
+
+            response = self.client.get("/list?path=/cols&format=msgpack", headers=headers)
+            if app_module.msgpack is None:
+                assert response.status_code == 406
+            else:
+                assert response.headers["content-type"] == "application/msgpack"
+                assert app_module.msgpack.unpackb(response.content)["names"] == data["names"]
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_local_mirror(self):
+        """Test: Con SFTP_LOCAL_DIR, /download y /upload van directo al disco con el mismo contrato."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        folder = self.base_dir / "local"
+        folder.mkdir()
+        outside = self.base_dir.parent / f"{self.base_dir.name}-outside"
+        outside.mkdir()
+        (outside / "secret.txt").write_text("no")
+        (folder / "escape").symlink_to(outside)
+        data = os.urandom(3 * 1024 * 1024)
+        (folder / "data.bin").write_bytes(data)
+        try:
+            with self._override_settings(SFTP_LOCAL_DIR=str(self.base_dir)):
+                hits = app_module.metrics.get("local.file_responses")
+                response = self.client.get("/download?remote_path=/local/data.bin", headers=headers)
+                assert response.content == data
+                assert response.headers["content-disposition"] == 'attachment; filename="data.bin"'
+                assert app_module.metrics.get("local.file_responses") == hits + 1
+                partial = self.client.get("/download?remote_path=/local/data.bin", headers={**headers, "Range": "bytes=10-19"})
+                assert partial.status_code == 206 and partial.content == data[10:20]
+                assert self.client.get("/download?remote_path=/local/none.bin", headers=headers).status_code == 404
+                assert self.client.get("/download?remote_path=/local", headers=headers).status_code == 400
+                assert self.client.get("/download?remote_path=/local/escape/secret.txt", headers=headers).status_code == 400
+
+                # Upload grande (UploadFile en disco): copy_file_range; con checksum: lectura por chunks
+                copies = app_module.metrics.get("local.copy_file_range")
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/local/new/up.bin"},
+                    files={"file": ("up.bin", BytesIO(data), "application/octet-stream")}
+                )
+                assert response.status_code == 200, response.text
+                assert response.json()["path"].endswith("/local/new/up.bin")
+                assert (folder / "new" / "up.bin").read_bytes() == data
+                assert ((folder / "new" / "up.bin").stat().st_mode & 0o777) == 0o640
+                if hasattr(os, "copy_file_range"):
+                    assert app_module.metrics.get("local.copy_file_range") == copies + 1
+                response = self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/local/small.txt", "checksum": "sha256"},
+                    files={"file": ("small.txt", BytesIO(b"hola"), "text/plain")}
+                )
+                assert response.json()["checksum"] == hashlib.sha256(b"hola").hexdigest()
+                assert self.client.post(
+                    "/upload", headers=headers, data={"remote_path": "/local/new"},
+                    files={"file": ("x", BytesIO(b"x"), "text/plain")}
+                ).status_code == 400
+
+                # Con límites de ancho de banda se usa el pipeline de streaming
+                with self._override_settings(SFTP_LOCAL_DIR=str(self.base_dir), BANDWIDTH_PER_TRANSFER=10**12):
+                    hits = app_module.metrics.get("local.file_responses")
+                    assert self.client.get("/download?remote_path=/local/data.bin", headers=headers).content == data
+                    assert app_module.metrics.get("local.file_responses") == hits
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            shutil.rmtree(outside, ignore_errors=True)
+
+    def test_memory_driver(self):
+        """Test: Con SFTP_DRIVER=memory la API funciona completa sin red ni disco."""
+        import app as app_module
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        with self._override_settings(SFTP_DRIVER="memory", BASE_DIR="/srv", TRANSFER_WORKERS=2):
+            assert self.client.post("/mkdir", headers=headers, data={"path": "/docs"}).status_code == 200
+            response = self.client.post(
+                "/upload", headers=headers, data={"remote_path": "/docs/a.txt", "checksum": "sha256"},
+                files={"file": ("a.txt", BytesIO(b"memoria"), "text/plain")}
+            )
+            assert response.status_code == 200, response.text
+            assert response.json()["checksum"] == hashlib.sha256(b"memoria").hexdigest()
+            assert not (self.base_dir / "docs").exists()
+
+            items = self.client.get("/list?path=/docs", headers=headers).json()["items"]
+            assert [(i["name"], i["size"], i["is_dir"]) for i in items] == [("a.txt", 7, False)]
+            assert self.client.get("/stat?path=/docs/a.txt", headers=headers).json()["size"] == 7
+            assert self.client.get("/download?remote_path=/docs/a.txt", headers=headers).content == b"memoria"
+            assert self.client.get("/download?remote_path=/docs/none.txt", headers=headers).status_code == 404
+            assert self.client.delete("/delete-dir?remote_path=/docs", headers=headers).status_code == 400
+            assert self.client.delete("/delete-file?remote_path=/docs/a.txt", headers=headers).status_code == 200
+            assert self.client.delete("/delete-dir?remote_path=/docs", headers=headers).status_code == 200
+            assert self.client.get("/stat?path=/docs", headers=headers).status_code == 404
+
+            # Los transfer workers son otros procesos: el store en memoria no se les delega
+            app_module.start_transfer_pool(self._thread_transfer_worker)
+            offloaded = app_module.metrics.get("transfers.offloaded.upload")
+            data = os.urandom(200_000)
+            response = self.client.post(
+                "/upload", headers=headers, data={"remote_path": "/big.bin"},
+                files={"file": ("big.bin", BytesIO(data), "application/octet-stream")}
+            )
+            assert response.status_code == 200, response.text
+            assert self.client.get("/download?remote_path=/big.bin", headers=headers).content == data
+            assert app_module.metrics.get("transfers.offloaded.upload") == offloaded
+
+            # El cliente cumple la interfaz de storage fuera de los endpoints
+            sftp = app_module.storage_connect(app_module.BackendConfig(driver="memory", host="unit", base_dir="/b"))
+            sftp.mkdir("/b/d")
+            with sftp.open("/b/d/f.bin", "wb") as f:
+                f.write(b"abc")
+            sftp.rename("/b/d", "/b/e")
+            assert sftp.listdir("/b") == ["e"]
+            with sftp.open("/b/e/f.bin", "rb") as f:
+                assert f.read() == b"abc"
+            for call, args, error in (
+                (sftp.mkdir, ("/b/e",), FileExistsError),
+                (sftp.rmdir, ("/b/e",), OSError),
+                (sftp.remove, ("/b/e",), IsADirectoryError),
+                (sftp.open, ("/x/y.bin", "wb"), FileNotFoundError),
+            ):
+                try:
+                    call(*args)
+                    assert False, f"{call.__name__}{args} debía fallar"
+                except error:
+                    pass
+            with self._override_settings(SFTP_DRIVER="nfs"):
+                try:
+                    app_module.get_router()
+                    assert False, "driver inválido aceptado"
+                except ValueError:
+                    pass
+
+    def test_upload_pipeline(self):
+        """Test: /upload hashea, detecta tipo, limita tamaño y pasa por el antivirus en la misma pasada."""
+        import shlex
+        import app as app_module
+        from fastapi import HTTPException
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        folder = self.base_dir / "pipe"
+        scanner = self.base_dir.parent / f"{self.base_dir.name}-scan.py"
+        scanner.write_text(
+            "import sys\n"
+            "data = sys.stdin.buffer.read()\n"
+            "print('stdin: Eicar-Test-Signature FOUND' if b'EICAR' in data else 'stdin: OK')\n"
+            "sys.exit(1 if b'EICAR' in data else 0)\n"
+        )
+        png = b"\x89PNG\r\n\x1a\n" + os.urandom(5000)
+
+        def upload(path, data, **form):
+            return self.client.post(
+                "/upload", headers=headers, data={"remote_path": path, **form},
+                files={"file": (path.rsplit("/", 1)[-1], BytesIO(data), "application/octet-stream")}
+            )
+
+        try:
+            body = upload("/pipe/image.bin", png).json()
+            assert body["size"] == len(png) and body["content_type"] == "image/png"
+            assert upload("/pipe/notes.csv", b"a,b\n1,2\n").json()["content_type"] == "text/csv"
+            assert upload("/pipe/readme", "ñandú\n".encode()).json()["content_type"] == "text/plain"
+            assert app_module.sniff_content_type(b"PK\x03\x04rest", "report.docx").endswith("wordprocessingml.document")
+            assert app_module.sniff_content_type(b"\x00\x01\x02", "x.txt") == "application/octet-stream"
+
+            with self._override_settings(UPLOAD_HASHES=["sha256", "md5"], UPLOAD_SIDECAR_SUFFIX=".meta.json"):
+                body = upload("/pipe/data.bin", png, checksum="sha1").json()
+                assert body["hashes"] == {
+                    "sha1": hashlib.sha1(png).hexdigest(), "sha256": hashlib.sha256(png).hexdigest(),
+                    "md5": hashlib.md5(png).hexdigest(),
+                }
+                assert body["checksum"] == hashlib.sha1(png).hexdigest()
+                sidecar = json.loads((folder / "data.bin.meta.json").read_text())
+                assert sidecar == {k: body[k] for k in ("size", "hashes", "content_type")}
+                response = self.client.get("/checksum?path=/pipe/data.bin&algorithm=md5", headers=headers)
+                assert response.json()["checksum"] == hashlib.md5(png).hexdigest()
+
+            # Rechazos: el archivo existente queda intacto y no quedan temporales
+            (folder / "keep.txt").write_bytes(b"original")
+            command = f"{shlex.quote(sys.executable)} {shlex.quote(str(scanner))}"
+            with self._override_settings(UPLOAD_MAX_BYTES=100, UPLOAD_SCAN_COMMAND=command):
+                assert upload("/pipe/keep.txt", b"x" * 101).status_code == 413
+                try:
+                    # Sin tamaño declarado el límite se aplica mientras se copia
+                    with app_module.upload_pipeline("keep.txt") as pipeline:
+                        app_module.store_file("/pipe/keep.txt", BytesIO(b"y" * 150), pipeline)
+                    assert False, "se esperaba 413"
+                except HTTPException as exc:
+                    assert exc.status_code == 413
+                response = upload("/pipe/keep.txt", b"X5O!P%@AP EICAR")
+                assert response.status_code == 422 and "Eicar-Test-Signature FOUND" in response.json()["detail"]
+                assert (folder / "keep.txt").read_bytes() == b"original"
+                body = upload("/pipe/keep.txt", b"limpio").json()
+                assert body["scan"] == "clean" and (folder / "keep.txt").read_bytes() == b"limpio"
+            assert not [p.name for p in folder.iterdir() if p.name.startswith(".")]
+
+            # Reemplazo vía temporal en el driver en memoria (rename no pisa destinos)
+            with self._override_settings(SFTP_DRIVER="memory", BASE_DIR="/srv", UPLOAD_MAX_BYTES=100):
+                assert upload("/m.txt", b"uno").status_code == 200
+                assert upload("/m.txt", b"dos").status_code == 200
+                assert self.client.get("/download?remote_path=/m.txt", headers=headers).content == b"dos"
+                names = [i["name"] for i in self.client.get("/list?path=/", headers=headers).json()["items"]]
+                assert names == ["m.txt"], names
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+            scanner.unlink()
+
+    def test_conditional_upload(self):
+        """Test: If-Match/If-None-Match, content_hash que evita re-subir y replays por Idempotency-Key."""
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        folder = self.base_dir / "cond"
+        data = os.urandom(20000)
+        digest = hashlib.sha256(data).hexdigest()
+
+        def upload(path, payload, extra=None, **form):
+            return self.client.post(
+                "/upload", headers={**headers, **(extra or {})}, data={"remote_path": path, **form},
+                files={"file": (path.rsplit("/", 1)[-1], BytesIO(payload), "application/octet-stream")}
+            )
+
+        try:
+            first = upload("/cond/a.bin", data, {"If-None-Match": "*"}, checksum="sha256").json()
+            etag = first["etag"]
+            assert self.client.get("/stat?path=/cond/a.bin", headers=headers).json()["etag"] == etag
+            assert upload("/cond/a.bin", data, {"If-None-Match": "*"}).status_code == 412
+            assert upload("/cond/a.bin", b"nuevo", {"If-Match": '"0-0"'}).status_code == 412
+            assert upload("/cond/new.bin", b"nuevo", {"If-Match": "*"}).status_code == 412
+            assert not (folder / "new.bin").exists() and (folder / "a.bin").read_bytes() == data
+
+            # Mismo contenido: el hash cacheado del upload anterior evita la transferencia
+            mtime = (folder / "a.bin").stat().st_mtime_ns
+            body = upload("/cond/a.bin", data, {"If-Match": f"W/{etag}"}, content_hash=f"sha256:{digest}").json()
+            assert body["skipped"] and body["etag"] == etag and body["hashes"] == {"sha256": digest}
+            assert (folder / "a.bin").stat().st_mtime_ns == mtime
+            # `checksum` con otro algoritmo: sin ese hash no se salta (se sube y se calcula); después, sí
+            md5 = hashlib.md5(data).hexdigest()
+            body = upload("/cond/a.bin", data, content_hash=f"sha256:{digest}", checksum="md5").json()
+            assert body["algorithm"] == "md5" and body["checksum"] == md5
+            etag = body["etag"]
+            body = upload("/cond/a.bin", data, content_hash=f"sha256:{digest}", checksum="md5").json()
+            assert body["skipped"] and body["checksum"] == md5 and body["hashes"] == {"sha256": digest, "md5": md5}
+            # Contenido que no coincide con content_hash: 422 y el archivo queda intacto
+            response = upload("/cond/a.bin", b"otro", content_hash=f"sha256:{digest}")
+            assert response.status_code == 422 and (folder / "a.bin").read_bytes() == data
+            assert upload("/cond/a.bin", data, content_hash="sha256:abc").status_code == 400
+            changed = os.urandom(100)
+            body = upload("/cond/a.bin", changed, {"If-Match": etag},
+                          content_hash=f"sha256:{hashlib.sha256(changed).hexdigest()}").json()
+            assert "skipped" not in body and body["etag"] != etag
+            assert (folder / "a.bin").read_bytes() == changed
+
+            # Idempotency-Key: el reintento recibe el resultado original sin volver a escribir
+            key = {"Idempotency-Key": "req-1"}
+            original = upload("/cond/b.bin", b"v1", key)
+            assert original.status_code == 200 and "Idempotent-Replayed" not in original.headers
+            (folder / "b.bin").write_bytes(b"cambiado afuera")
+            replay = upload("/cond/b.bin", b"v1", key)
+            assert replay.headers["Idempotent-Replayed"] == "true" and replay.json() == original.json()
+            assert (folder / "b.bin").read_bytes() == b"cambiado afuera"
+            assert upload("/cond/otro.bin", b"v1", key).status_code == 422
+            # Solo se recuerdan los éxitos
+            assert upload("/cond/b.bin", b"v2", {"Idempotency-Key": "req-2", "If-Match": '"1-1"'}).status_code == 412
+            assert upload("/cond/b.bin", b"v2", {"Idempotency-Key": "req-2"}).status_code == 200
+            assert (folder / "b.bin").read_bytes() == b"v2"
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_transfer_progress(self):
+        """Test: /transfers/{id}/progress emite el avance de upload, download y delete-dir por SSE."""
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        folder = self.base_dir / "progress"
+        data = os.urandom(1024 * 1024 + 256 * 1024)
+
+        def events(transfer_id, wait=5):
+            response = self.client.get(f"/transfers/{transfer_id}/progress?wait={wait}", headers=headers)
+            assert response.status_code == 200, response.text
+            parsed = []
+            for block in response.text.strip().split("\n\n"):
+                fields = dict(line.split(": ", 1) for line in block.splitlines())
+                parsed.append((fields["event"], json.loads(fields["data"])))
+            return parsed
+
+        try:
+            # El cliente abre el stream antes de empezar el upload (más lento por el límite de ancho de banda)
+            with self._override_settings(BANDWIDTH_PER_TRANSFER=512 * 1024):
+                def run(i):
+                    if i == 0:
+                        return events("up-1")
+                    time.sleep(0.1)
+                    return self.client.post(
+                        "/upload", headers={**headers, "X-Transfer-Id": "up-1"}, data={"remote_path": "/progress/a.bin"},
+                        files={"file": ("a.bin", BytesIO(data), "application/octet-stream")}
+                    )
+                stream, response = self._run_concurrently(run, 2)
+            assert response.status_code == 200, response.text
+            kind, final = stream[-1]
+            assert kind == "done" and final["bytes"] == final["total"] == len(data) and final["kind"] == "upload"
+            partial = [e for k, e in stream if k == "progress" and 0 < e["bytes"] < len(data)]
+            assert partial and "eta" in partial[0] and partial[0]["rate"] > 0, stream
+            assert [e["bytes"] for _, e in stream] == sorted(e["bytes"] for _, e in stream)
+
+            response = self.client.get("/download?remote_path=/progress/a.bin", headers={**headers, "X-Transfer-Id": "down-1"})
+            assert response.content == data
+            kind, final = events("down-1")[-1]
+            assert kind == "done" and final["bytes"] == final["total"] == len(data)
+
+            (folder / "sub").mkdir()
+            (folder / "sub" / "b.txt").write_bytes(b"x" * 100)
+            response = self.client.delete("/delete-dir?remote_path=/progress&recursive=true", headers={**headers, "X-Transfer-Id": "rm-1"})
+            assert response.status_code == 200
+            kind, final = events("rm-1")[-1]
+            assert kind == "done" and final["items"] == 4 and final["bytes"] == len(data) + 100
+
+            # Un error cierra el progreso con el detalle
+            self.client.post("/upload", headers=headers, data={"remote_path": "/progress/c.txt"}, files={"file": ("c.txt", BytesIO(b"1"))})
+            response = self.client.post(
+                "/upload", headers={**headers, "X-Transfer-Id": "up-2", "If-None-Match": "*"},
+                data={"remote_path": "/progress/c.txt"}, files={"file": ("c.txt", BytesIO(b"2"))}
+            )
+            assert response.status_code == 412
+            kind, final = events("up-2")[-1]
+            assert kind == "error" and final["error"] == "El archivo remoto ya existe"
+
+            assert self.client.get("/transfers/nada/progress?wait=0", headers=headers).status_code == 404
+            assert self.client.get("/transfers/mal id/progress?wait=0", headers=headers).status_code == 400
+            # Los streams esperando no son gratis: cuentan contra el límite por key de la clase stream
+            with self._override_settings(ADMISSION_STREAM_PER_KEY=1):
+                responses = self._run_concurrently(
+                    lambda i: self.client.get(f"/transfers/nada-{i}/progress?wait=0.5", headers=headers), 2
+                )
+                assert sorted(r.status_code for r in responses) == [404, 503]
+
+            # Cliente que se desconecta antes de que empiece el body: el progreso se cierra igual
+            import asyncio
+            import app as app_module
+            scope = {
+                "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+                "method": "GET", "scheme": "http", "path": "/download", "raw_path": b"/download", "root_path": "",
+                "query_string": b"remote_path=/test/file1.txt", "client": ("127.0.0.1", 1), "server": ("testserver", 80),
+                "headers": [(b"x-api-key", TestSettings.API_KEY.encode()), (b"x-transfer-id", b"gone-1")],
+            }
+
+            async def receive():
+                return {"type": "http.request", "body": b"", "more_body": False}
+
+            async def send(message):
+                raise OSError("cliente desconectado")
+
+            try:
+                asyncio.run(app(scope, receive, send))
+            except Exception:
+                pass
+            progress = app_module._transfers._transfers["gone-1"]
+            assert progress.done.is_set() and progress.error == "Transferencia interrumpida"
+            response = self.client.get("/download?remote_path=/test/file1.txt", headers={**headers, "X-Transfer-Id": "gone-1"})
+            assert response.status_code == 200
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+
+    def test_ring_buffer(self):
+        """Test: RingReader y ReadAhead leen por adelantado y propagan errores de la fuente y de on_chunk."""
+        import app as app_module
+        from fastapi import HTTPException
+        data = os.urandom(10 * 1024 + 123)
+
+        class Failing(BytesIO):
+            def readinto(self, buffer):
+                if self.tell() >= 4096:
+                    raise ConnectionError("conexión perdida")
+                return super().readinto(buffer)
+
+            def read(self, size=-1):
+                if self.tell() >= 4096:
+                    raise ConnectionError("conexión perdida")
+                return super().read(size)
+
+        seen = []
+        with app_module.RingReader(BytesIO(data), 1024, 3, on_chunk=lambda c: seen.append(bytes(c))) as reader:
+            views = list(reader.chunks())
+            ring = reader._ring
+        assert b"".join(seen) == data and len(views) == 11
+        # Los buffers vuelven al pool y la siguiente transferencia los reusa
+        reader = app_module.RingReader(BytesIO(data), 1024, 3)
+        assert reader._ring is ring
+        assert b"".join(iter(lambda: reader.read(1000), b"")) == data
+        reader.close()
+
+        reader = app_module.RingReader(Failing(data), 1024, 2)
+        try:
+            for _ in reader.chunks():
+                pass
+            assert False, "se esperaba ConnectionError"
+        except ConnectionError:
+            pass
+        finally:
+            reader.close()
+
+        def reject(chunk):
+            raise HTTPException(413, "grande")
+        with app_module.RingReader(BytesIO(data), 1024, 2, on_chunk=reject) as reader:
+            try:
+                reader.read()
+                assert False, "se esperaba 413"
+            except HTTPException as exc:
+                assert exc.status_code == 413
+
+        # Cerrar a mitad de camino detiene el lector aunque la fuente no se haya agotado
+        reader = app_module.RingReader(BytesIO(data), 1024, 2)
+        assert len(reader.read()) == 1024
+        reader.close()
+        assert not reader._thread.is_alive()
+
+        # ReadAhead entrega los bytes de la fuente tal cual (sin copiar) y propaga sus errores
+        chunks = []
+
+        class Recording(BytesIO):
+            def read(self, size=-1):
+                chunk = super().read(size)
+                chunks.append(chunk)
+                return chunk
+        with app_module.ReadAhead(Recording(data), 1024, 2) as reader:
+            first = reader.read(1024)
+            assert first is chunks[0]
+            assert first + b"".join(iter(lambda: reader.read(1000), b"")) == data
+        reader = app_module.ReadAhead(Failing(data), 1024, 2)
+        try:
+            while reader.read(1024):
+                pass
+            assert False, "se esperaba ConnectionError"
+        except ConnectionError:
+            pass
+        finally:
+            reader.close()
+        reader = app_module.ReadAhead(BytesIO(data), 256, 1)
+        assert len(reader.read()) == 256
+        reader.close()
+        assert not reader._thread.is_alive()
+
+        # Upload y download por la API con y sin ring dan los mismos bytes
+        headers = {"X-API-Key": TestSettings.API_KEY}
+        payload = os.urandom(3 * 1024 * 1024 + 7)
+        try:
+            for slots in (0, 2):
+                with self._override_settings(TRANSFER_RING_SLOTS=slots, UPLOAD_HASHES=["sha256"]):
+                    response = self.client.post(
+                        "/upload", headers=headers, data={"remote_path": f"/ring/{slots}.bin"},
+                        files={"file": ("r.bin", BytesIO(payload), "application/octet-stream")}
+                    )
+                    assert response.json()["hashes"]["sha256"] == hashlib.sha256(payload).hexdigest()
+                    response = self.client.get(f"/download?remote_path=/ring/{slots}.bin", headers=headers)
+                    assert response.content == payload
+        finally:
+            shutil.rmtree(self.base_dir / "ring", ignore_errors=True)
+
+    def test_search_disabled(self):
+        """Test: /search sin índice configurado responde 503."""
+        response = self.client.get("/search?glob=*", headers={"X-API-Key": TestSettings.API_KEY})
+        assert response.status_code == 503
+
     def run_all_tests(self):
         """Ejecuta todos los tests y reporta resultados."""
         print("🧪 Iniciando suite completa de tests...")
@@ -417,6 +1985,45 @@ class TestRunner:
             ("Delete Dir - Vacío", self.test_delete_dir_empty),
             ("Delete Dir - Con archivos", self.test_delete_dir_with_files),
             ("Protección BASE_DIR", self.test_delete_base_dir_protection),
+            ("Coalescing - List concurrente", self.test_list_coalesced),
+            ("Coalescing - Stream compartido", self.test_download_coalesced),
+            ("Coalescing - Cliente lento se desprende", self.test_download_coalesced_slow_client),
+            ("Coalescing - Métricas", self.test_metrics_coalesced),
+            ("Backends - Sharding hash", self.test_sharding_hash),
+            ("Backends - Routing por prefijo", self.test_routing_prefix),
+            ("Réplicas - Failover de lecturas", self.test_replicas_failover),
+            ("Réplicas - Circuit breaker", self.test_circuit_breaker),
+            ("Checksum - Inline y endpoint", self.test_checksum),
+            ("Checksum - Errores", self.test_checksum_errors),
+            ("Checksum - Marcado de no soportado", self.test_checksum_unsupported_marking),
+            ("Delta - Plan y aplicación", self.test_upload_delta),
+            ("Delta - Bloque inválido y plan viejo", self.test_upload_delta_rejects_bad_block),
+            ("Sync - Plan y aplicación", self.test_sync_plan_apply),
+            ("Sync - Path fuera de root", self.test_sync_rejects_escape),
+            ("Índice - Crawl, write-through y búsqueda", self.test_metadata_index),
+            ("Índice - Deshabilitado", self.test_search_disabled),
+            ("Changes - API y crawler incremental", self.test_changes_feed),
+            ("Warmup - Readiness y cachés", self.test_warmup_readiness),
+            ("Arranque - Lazy startup y OpenAPI pregenerado", self.test_lazy_startup),
+            ("Readyz - Probe y umbrales", self.test_readyz_thresholds),
+            ("Admisión - Rate limit por key", self.test_admission_rate_limit),
+            ("Admisión - Cola acotada", self.test_admission_queue),
+            ("Admisión - Streams fuera del gate meta", self.test_admission_streams),
+            ("Ancho de banda - Límite por transferencia", self.test_bandwidth_limits),
+            ("Ancho de banda - Prioridad interactiva", self.test_bandwidth_priority),
+            ("Multi-worker - Presupuesto y cache compartido", self.test_multiworker_shared_cache),
+            ("Transfer workers - Upload y download", self.test_transfer_workers),
+            ("Transporte SSH - Ciphers, compresión y ventana", self.test_ssh_transport_options),
+            ("Transporte SSH - Auth por clave y host keys", self.test_ssh_key_auth),
+            ("Compresión - Download y listados", self.test_compression),
+            ("List - Formatos columnar y msgpack", self.test_list_formats),
+            ("Espejo local - Download y upload", self.test_local_mirror),
+            ("Storage - Driver en memoria", self.test_memory_driver),
+            ("Upload - Pipeline de hashes, tipo, límite y antivirus", self.test_upload_pipeline),
+            ("Upload - Condicional e idempotente", self.test_conditional_upload),
+            ("Transferencias - Progreso por SSE", self.test_transfer_progress),
+            ("Transferencias - Ring de buffers", self.test_ring_buffer),
+            ("Índice - Cambios en vivo (SSE)", self.test_changes_stream),
         ]
         
         # Ejecutar cada test